@@ -1,18 +1,48 @@
-from flask import Flask, render_template, request, jsonify, redirect, url_for, flash, session
+from flask import Flask, render_template, request, jsonify, redirect, url_for, flash, session, Response, make_response, abort, g, has_request_context
 from flask_sqlalchemy import SQLAlchemy
+import click
 from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user
-from werkzeug.security import generate_password_hash, check_password_hash
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload
+from sqlalchemy.pool import QueuePool
+from werkzeug.exceptions import ClientDisconnected
+from werkzeug.security import generate_password_hash, check_password_hash, safe_join
 from werkzeug.utils import secure_filename
 import os
 import re
-from datetime import datetime
+import csv
+import fcntl
+import gzip
+import hashlib
+import json
+import math
+import mimetypes
+import mmap
+import struct
+import ipaddress
+import queue
+import shutil
+import sqlite3
+import subprocess
+import threading
+import atexit
+import glob
+from bisect import insort
+from collections import OrderedDict
+from functools import lru_cache
+from datetime import datetime, timedelta
+from time import monotonic, sleep
+from types import SimpleNamespace
 import uuid
 
-app = Flask(__name__)
+# FLASK_INSTANCE_PATH 可把版本号文件、播放量日志等运行时文件放到其他目录（须为绝对路径，测试时使用）
+app = Flask(__name__, instance_path=os.getenv('FLASK_INSTANCE_PATH') or None)
 app.config['SECRET_KEY'] = 'your-secret-key-here'
 # 数据库配置
 import os
-from urllib.parse import quote_plus
+from urllib.parse import quote, quote_plus
 
 # 获取环境变量，如果没有则使用默认值
 MYSQL_HOST = os.getenv('MYSQL_HOST', 'localhost')
@@ -21,8 +51,10 @@ MYSQL_DATABASE = os.getenv('MYSQL_DATABASE', 'wanli_video')
 MYSQL_USER = os.getenv('MYSQL_USER', 'wanli_user')
 MYSQL_PASSWORD = os.getenv('MYSQL_PASSWORD', 'wanli123456')
 
-# 构建数据库URI
-if os.getenv('FLASK_ENV') == 'production':
+# 构建数据库URI（设置 DATABASE_URL 时直接使用，便于测试或外部数据库）
+if os.getenv('DATABASE_URL'):
+    DATABASE_URI = os.getenv('DATABASE_URL')
+elif os.getenv('FLASK_ENV') == 'production':
     # 生产环境使用MySQL
     DATABASE_URI = f"mysql+pymysql://{MYSQL_USER}:{quote_plus(MYSQL_PASSWORD)}@{MYSQL_HOST}:{MYSQL_PORT}/{MYSQL_DATABASE}?charset=utf8mb4"
 else:
@@ -31,27 +63,192 @@ else:
 
 app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URI
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# 连接池（MySQL）：每个 gunicorn worker 各有一个池，DB_POOL_SIZE + DB_MAX_OVERFLOW 应接近 worker 线程数，
+# 乘以 worker 数后不超过 MySQL max_connections；DB_POOL_RECYCLE 需小于服务端 wait_timeout
+app.config['DB_POOL_SIZE'] = int(os.getenv('DB_POOL_SIZE', '10'))
+app.config['DB_MAX_OVERFLOW'] = int(os.getenv('DB_MAX_OVERFLOW', '20'))
+app.config['DB_POOL_TIMEOUT'] = int(os.getenv('DB_POOL_TIMEOUT', '30'))
+app.config['DB_POOL_RECYCLE'] = int(os.getenv('DB_POOL_RECYCLE', '1800'))
+app.config['DB_POOL_PRE_PING'] = os.getenv('DB_POOL_PRE_PING', '1').lower() in ('1', 'true', 'yes', 'on')
+# SQLite（开发环境）：WAL 让读写互不阻塞，busy_timeout（毫秒）让写锁冲突时等待而不是直接报 database is locked
+app.config['SQLITE_BUSY_TIMEOUT'] = int(os.getenv('SQLITE_BUSY_TIMEOUT', '5000'))
+app.config['SQLITE_SYNCHRONOUS'] = os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL').upper()  # WAL 下 NORMAL 不会损坏数据库
+if not DATABASE_URI.startswith('sqlite'):
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        'pool_size': app.config['DB_POOL_SIZE'],
+        'max_overflow': app.config['DB_MAX_OVERFLOW'],
+        'pool_timeout': app.config['DB_POOL_TIMEOUT'],
+        'pool_recycle': app.config['DB_POOL_RECYCLE'],
+        'pool_pre_ping': app.config['DB_POOL_PRE_PING'],
+    }
 app.config['UPLOAD_FOLDER'] = 'static/uploads'
 app.config['AVATAR_FOLDER'] = 'static/avatars'
 app.config['THUMBNAIL_FOLDER'] = 'static/thumbnails'
 app.config['SITE_ASSET_FOLDER'] = 'static/site'
 app.config['MAX_CONTENT_LENGTH'] = None  # 禁用文件大小限制
+app.config['VIDEO_MAX_SIZE'] = 500 * 1024 * 1024  # 500MB
+# 分片上传：建议分片大小、单片上限、未完成会话的过期秒数
+app.config['CHUNK_UPLOAD_SIZE'] = int(os.getenv('CHUNK_UPLOAD_SIZE', str(8 * 1024 * 1024)))
+app.config['CHUNK_UPLOAD_MAX_CHUNK'] = int(os.getenv('CHUNK_UPLOAD_MAX_CHUNK', str(32 * 1024 * 1024)))
+app.config['CHUNK_UPLOAD_EXPIRE'] = int(os.getenv('CHUNK_UPLOAD_EXPIRE', str(24 * 3600)))
+# 视频文件服务：设置 nginx internal location 前缀后改用 X-Accel-Redirect，由 nginx 直接发送文件
+app.config['MEDIA_X_ACCEL_PREFIX'] = os.getenv('MEDIA_X_ACCEL_PREFIX')  # 例如 /_media/uploads
+app.config['MEDIA_MAX_AGE'] = int(os.getenv('MEDIA_MAX_AGE', str(7 * 24 * 3600)))
+# 弹幕分段：每段覆盖的秒数、进程内缓存的段数上限及过期时间（多 worker 间的最大不一致窗口）
+app.config['DANMAKU_SEGMENT_SECONDS'] = int(os.getenv('DANMAKU_SEGMENT_SECONDS', '60'))
+app.config['DANMAKU_CACHE_MAX_SEGMENTS'] = int(os.getenv('DANMAKU_CACHE_MAX_SEGMENTS', '2048'))
+app.config['DANMAKU_CACHE_TTL'] = float(os.getenv('DANMAKU_CACHE_TTL', '30'))
+# 弹幕实时推送：合并发送间隔、单 worker 订阅上限、单连接最长时长；配置 Redis 地址后多 worker 共享房间
+# gthread 模式下每个推送连接独占一个 worker 线程，订阅上限必须明显小于 gunicorn --threads（Dockerfile 中为 32），
+# 否则热门房间会占满线程、拖垮普通请求；需要更多连接时增加 worker 或改用 gevent worker 并相应调大
+app.config['DANMAKU_PUSH_INTERVAL_MS'] = int(os.getenv('DANMAKU_PUSH_INTERVAL_MS', '500'))
+app.config['DANMAKU_PUSH_MAX_SUBSCRIBERS'] = int(os.getenv('DANMAKU_PUSH_MAX_SUBSCRIBERS', '8'))
+app.config['DANMAKU_PUSH_MAX_SECONDS'] = int(os.getenv('DANMAKU_PUSH_MAX_SECONDS', '300'))
+app.config['DANMAKU_BROKER_URL'] = os.getenv('DANMAKU_BROKER_URL')  # 例如 redis://redis:6379/0
+# 播放量缓冲：内存累加 + 本地追加日志，按间隔批量写库
+app.config['VIEW_FLUSH_INTERVAL'] = float(os.getenv('VIEW_FLUSH_INTERVAL', '5'))
+app.config['VIEW_LOG_FOLDER'] = os.getenv('VIEW_LOG_FOLDER', os.path.join(app.instance_path, 'view_log'))
+# 首页推荐流缓存：渲染结果最多复用的秒数（播放量等统计的最大延迟）
+app.config['FEED_CACHE_TTL'] = int(os.getenv('FEED_CACHE_TTL', '60'))
+# 搜索：auto 按数据库选择（MySQL FULLTEXT / SQLite FTS5），不可用时退回纯 Python 倒排索引
+app.config['SEARCH_BACKEND'] = os.getenv('SEARCH_BACKEND', 'auto')  # auto, mysql, fts5, python
+app.config['SEARCH_PER_PAGE'] = int(os.getenv('SEARCH_PER_PAGE', '20'))
+# 本地 IP 库（flask load-geoip 生成）及查询 LRU 大小
+app.config['GEOIP_DB_PATH'] = os.getenv('GEOIP_DB_PATH', os.path.join(app.instance_path, 'geoip.bin'))
+app.config['GEOIP_CACHE_SIZE'] = int(os.getenv('GEOIP_CACHE_SIZE', '4096'))
+# 后台任务队列：web 进程内的工作线程数（0 表示只由 flask run-jobs 独立进程处理）、轮询间隔、重试次数、超时回收
+app.config['JOB_WORKER_THREADS'] = int(os.getenv('JOB_WORKER_THREADS', '1'))
+app.config['JOB_POLL_INTERVAL'] = float(os.getenv('JOB_POLL_INTERVAL', '2'))
+app.config['JOB_MAX_ATTEMPTS'] = int(os.getenv('JOB_MAX_ATTEMPTS', '5'))
+app.config['JOB_LOCK_TIMEOUT'] = int(os.getenv('JOB_LOCK_TIMEOUT', '300'))  # 执行中每 1/3 超时刷新一次锁，超时即视为消费者已崩溃
+# HLS 转码：输出目录、ffmpeg 路径、单次转码超时，以及 (高度, 视频码率kbps) 档位
+app.config['HLS_FOLDER'] = 'static/hls'
+app.config['FFMPEG_BIN'] = os.getenv('FFMPEG_BIN', 'ffmpeg')
+app.config['FFPROBE_BIN'] = os.getenv('FFPROBE_BIN', 'ffprobe')
+app.config['TRANSCODE_TIMEOUT'] = int(os.getenv('TRANSCODE_TIMEOUT', '3600'))
+app.config['HLS_RENDITIONS'] = [(360, 800), (720, 2500), (1080, 5000)]
+# 封面缩放档位（宽度像素）与拖动预览雪碧图：每 SPRITE_INTERVAL 秒截一帧，最多 SPRITE_MAX_TILES 帧
+app.config['THUMBNAIL_WIDTHS'] = [320, 640, 1280]
+app.config['SPRITE_INTERVAL'] = int(os.getenv('SPRITE_INTERVAL', '10'))
+app.config['SPRITE_MAX_TILES'] = 100
+app.config['SPRITE_TILE_SIZE'] = (160, 90)
+app.config['SPRITE_COLUMNS'] = 10
+# 头像缩略图边长（像素），上传时按内容哈希存储并生成这些尺寸
+app.config['AVATAR_SIZES'] = (48, 96, 192)
+# 视频页每次加载的评论条数
+app.config['COMMENTS_PER_PAGE'] = int(os.getenv('COMMENTS_PER_PAGE', '20'))
+# 每个请求的 SQL 条数：超过 QUERY_BUDGET 打印告警；QUERY_COUNT_HEADER 开启时写入 X-Query-Count 响应头
+app.config['QUERY_BUDGET'] = int(os.getenv('QUERY_BUDGET', '25'))
+app.config['QUERY_COUNT_HEADER'] = os.getenv('QUERY_COUNT_HEADER', '0').lower() in ('1', 'true', 'yes', 'on')
+# 关注/粉丝列表每页人数
+app.config['FOLLOW_PAGE_SIZE'] = int(os.getenv('FOLLOW_PAGE_SIZE', '20'))
+app.config['PROFILE_PAGE_SIZE'] = 12  # 个人中心每个审核状态下每页视频数
+# 关注动态：粉丝数超过 TIMELINE_FANOUT_LIMIT 的作者改为读时合并；新关注时补齐对方最近 TIMELINE_BACKFILL 个视频
+app.config['TIMELINE_FANOUT_LIMIT'] = int(os.getenv('TIMELINE_FANOUT_LIMIT', '5000'))
+app.config['TIMELINE_BACKFILL'] = 20
+app.config['TIMELINE_PAGE_SIZE'] = 12
+# 热门排行：每 HOT_SCORE_INTERVAL 秒重算最近 HOT_WINDOW_DAYS 天内过审视频的热度，HOT_GRAVITY 越大随时间衰减越快
+app.config['HOT_SCORE_INTERVAL'] = int(os.getenv('HOT_SCORE_INTERVAL', '600'))
+app.config['HOT_WINDOW_DAYS'] = int(os.getenv('HOT_WINDOW_DAYS', '7'))
+app.config['HOT_GRAVITY'] = float(os.getenv('HOT_GRAVITY', '1.5'))
+app.config['HOT_WEIGHTS'] = {'views': 1, 'likes': 3, 'triple_likes': 8, 'comments': 4, 'danmaku': 2}
+app.config['HOT_PAGE_SIZE'] = 12
+app.config['HOT_MAX_PAGES'] = 10
 
 # 确保上传目录存在
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+os.makedirs(os.path.join(app.config['UPLOAD_FOLDER'], '.partial'), exist_ok=True)
 os.makedirs(app.config['AVATAR_FOLDER'], exist_ok=True)
 os.makedirs(app.config['THUMBNAIL_FOLDER'], exist_ok=True)
+os.makedirs(os.path.join(app.config['THUMBNAIL_FOLDER'], 'variants'), exist_ok=True)
+os.makedirs(os.path.join(app.config['THUMBNAIL_FOLDER'], 'sprites'), exist_ok=True)
 os.makedirs(app.config['SITE_ASSET_FOLDER'], exist_ok=True)
+os.makedirs(app.config['HLS_FOLDER'], exist_ok=True)
+os.makedirs(app.config['VIEW_LOG_FOLDER'], exist_ok=True)
+os.makedirs(app.instance_path, exist_ok=True)
 
 db = SQLAlchemy(app)
 login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'login'
 
+# ----------- 数据库连接 -----------
+_pool_events = {'connects': 0, 'invalidated': 0}  # 本进程新建/作废的数据库连接数
+
+@event.listens_for(Engine, 'connect')
+def _on_db_connect(dbapi_connection, connection_record):
+    _pool_events['connects'] += 1
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    synchronous = app.config['SQLITE_SYNCHRONOUS']
+    if synchronous not in ('OFF', 'NORMAL', 'FULL', 'EXTRA'):
+        synchronous = 'NORMAL'
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute(f"PRAGMA busy_timeout={int(app.config['SQLITE_BUSY_TIMEOUT'])}")
+    cursor.execute(f'PRAGMA synchronous={synchronous}')
+    cursor.close()
+
+@event.listens_for(Engine, 'invalidate')
+def _on_db_invalidate(dbapi_connection, connection_record, exception):
+    # pool_pre_ping 发现断开的连接、或执行中遇到连接错误时触发
+    _pool_events['invalidated'] += 1
+
+def _db_pool_stats() -> dict:
+    """当前 worker 进程的连接池状态；各 worker 的池相互独立"""
+    engine = db.engine
+    pool = engine.pool
+    stats = {
+        'pid': os.getpid(),
+        'dialect': engine.dialect.name,
+        'pool_class': type(pool).__name__,
+        'status': pool.status(),
+        **_pool_events,
+    }
+    if isinstance(pool, QueuePool):
+        stats.update({
+            'size': pool.size(),
+            'checked_in': pool.checkedin(),
+            'checked_out': pool.checkedout(),
+            'overflow': pool.overflow(),
+        })
+    stats['options'] = app.config.get('SQLALCHEMY_ENGINE_OPTIONS') or {}
+    if engine.dialect.name == 'sqlite':
+        stats['pragmas'] = {
+            name: db.session.execute(db.text(f'PRAGMA {name}')).scalar()
+            for name in ('journal_mode', 'busy_timeout', 'synchronous')
+        }
+    return stats
+
+# ----------- SQL 查询计数 -----------
+@event.listens_for(Engine, 'before_cursor_execute')
+def _count_query(conn, cursor, statement, parameters, context, executemany):
+    # 只统计请求内的语句，后台线程与 CLI 不计
+    if has_request_context():
+        g.query_count = g.get('query_count', 0) + 1
+
+@app.after_request
+def _report_query_count(response):
+    count = g.get('query_count', 0)
+    if app.config['QUERY_COUNT_HEADER']:
+        response.headers['X-Query-Count'] = str(count)
+    if count > app.config['QUERY_BUDGET']:
+        print(f"SQL 查询过多: {request.method} {request.path} 执行了 {count} 条（预算 {app.config['QUERY_BUDGET']}）")
+    return response
+
 # 关注关系表
 follows = db.Table('follows',
     db.Column('follower_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
-    db.Column('followed_id', db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    db.Column('followed_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+    # 主键以 follower_id 开头，查“谁关注了我”需要反向索引
+    db.Index('ix_follows_followed', 'followed_id', 'follower_id')
+)
+
+# 三连记录表：(视频, 用户) 主键保证每人每个视频只能三连一次
+video_triple_likes = db.Table('video_triple_likes',
+    db.Column('video_id', db.Integer, db.ForeignKey('video.id'), primary_key=True),
+    db.Column('user_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+    db.Column('created_at', db.DateTime, default=datetime.utcnow)
 )
 
 # 数据模型
@@ -66,6 +263,10 @@ class User(UserMixin, db.Model):
     password_changed = db.Column(db.Boolean, default=False)  # 是否已修改默认密码
     wanli_coins = db.Column(db.Integer, default=10)  # 万里币，新用户默认10个
     received_likes = db.Column(db.Integer, default=0)  # 收到的赞数量
+    followers_count = db.Column(db.Integer, default=0)  # 粉丝数，由 follow_graph 随关注关系同一事务更新
+    following_count = db.Column(db.Integer, default=0)  # 关注数
+    video_count = db.Column(db.Integer, default=0)  # 已过审视频数，由 creator_stats 随审核/删除同一事务更新
+    total_views = db.Column(db.Integer, default=0)  # 名下视频总播放量，随播放量批次汇总
     last_login_date = db.Column(db.Date)  # 最后登录日期
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     # 地域信息（可选）
@@ -100,13 +301,32 @@ class Video(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     comments = db.relationship('Comment', backref='video', lazy=True)
     
+    # 转码状态（与审核状态 status 相互独立）：none(未转码/无 ffmpeg), queued, processing, ready, failed
+    processing_status = db.Column(db.String(20), default='none')
+    hls_master = db.Column(db.String(200))  # HLS 主播放列表，相对 HLS_FOLDER
+    # 封面缩放图已生成的宽度（逗号分隔），文件位于 thumbnails/variants/<封面文件名>/w<宽>.{jpg,webp}
+    thumbnail_widths = db.Column(db.String(50))
+    preview_sprite = db.Column(db.Text)  # 拖动预览雪碧图信息（JSON）
+    
     # 三连功能
     triple_likes = db.Column(db.Integer, default=0)  # 三连数量
-    triple_users = db.Column(db.Text, default='[]')  # 已三连的用户ID列表（JSON格式）
+    triple_users = db.Column(db.Text, default='[]')  # 旧版三连用户ID列表（JSON），已迁移到 video_triple_likes
+    
+    comment_count = db.Column(db.Integer, default=0)  # 评论数，随发表评论原子累加
+    hot_score = db.Column(db.Float, default=0)  # 热度，由后台任务定期批量重算
     
     # 明确指定外键关系
     reviewer = db.relationship('User', foreign_keys=[reviewed_by], backref='reviewed_videos')
 
+    __table_args__ = (
+        # 关注动态读时合并：按作者取最近过审的视频
+        db.Index('ix_video_author_status_reviewed', 'user_id', 'status', 'reviewed_at'),
+        # 热门排行：status='approved' 上按热度倒序的范围扫描
+        db.Index('ix_video_status_hot', 'status', 'hot_score', 'id'),
+        # 个人中心：按状态分组计数，以及各状态下按上传时间的游标分页
+        db.Index('ix_video_author_status_created', 'user_id', 'status', 'created_at', 'id'),
+    )
+
 class Comment(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     content = db.Column(db.Text, nullable=False)
@@ -114,6 +334,9 @@ class Comment(db.Model):
     video_id = db.Column(db.Integer, db.ForeignKey('video.id'), nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+    # 评论按 (created_at, id) 倒序游标分页
+    __table_args__ = (db.Index('ix_comment_video_created', 'video_id', 'created_at', 'id'),)
+
 class Danmaku(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     content = db.Column(db.Text, nullable=False)
@@ -127,6 +350,89 @@ class Danmaku(db.Model):
     # 添加关系
     author = db.relationship('User', backref='danmakus')
 
+    # 按视频 + 时间点分段读取
+    __table_args__ = (db.Index('ix_danmaku_video_time', 'video_id', 'time'),)
+
+# 已写入数据库的计数批次（播放量/获赞），用于崩溃恢复时避免重复计数
+class CounterFlushBatch(db.Model):
+    __tablename__ = 'counter_flush_batch'
+    id = db.Column(db.String(36), primary_key=True)
+    applied_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
+# 万里币流水：每笔转账/奖励一行，余额变动只通过 CoinLedger 完成
+class CoinTransaction(db.Model):
+    __tablename__ = 'coin_transaction'
+    id = db.Column(db.Integer, primary_key=True)
+    from_user_id = db.Column(db.Integer, db.ForeignKey('user.id'), index=True)  # 为空表示系统发放
+    to_user_id = db.Column(db.Integer, db.ForeignKey('user.id'), index=True)
+    amount = db.Column(db.Integer, nullable=False)
+    kind = db.Column(db.String(20), nullable=False)  # transfer(投币), daily_login(每日登录奖励)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+# 分片上传会话：.part 文件在 UPLOAD_FOLDER/.partial 下，完成后才创建 Video
+class UploadSession(db.Model):
+    __tablename__ = 'upload_session'
+    id = db.Column(db.String(36), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    filename = db.Column(db.String(200), nullable=False)
+    size = db.Column(db.BigInteger, nullable=False)
+    received = db.Column(db.BigInteger, nullable=False, default=0)
+    status = db.Column(db.String(20), default='uploading')  # uploading, completed
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
+# 用户地域分布汇总（管理后台地图使用），未知的国家/省份记为空字符串
+class UserRegionStat(db.Model):
+    __tablename__ = 'user_region_stat'
+    country_code = db.Column(db.String(2), primary_key=True, default='')
+    region_name = db.Column(db.String(100), primary_key=True, default='')
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+# 关注动态收件箱：每个粉丝一行，published_at 为视频过审时间
+class TimelineEntry(db.Model):
+    __tablename__ = 'timeline_entry'
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    video_id = db.Column(db.Integer, db.ForeignKey('video.id'), primary_key=True)
+    author_id = db.Column(db.Integer, nullable=False)
+    published_at = db.Column(db.DateTime, nullable=False)
+    __table_args__ = (
+        db.Index('ix_timeline_user_published', 'user_id', 'published_at', 'video_id'),
+        db.Index('ix_timeline_video', 'video_id'),
+        db.Index('ix_timeline_user_author', 'user_id', 'author_id'),
+    )
+
+# 读时合并的大V：粉丝数越过 TIMELINE_FANOUT_LIMIT 后由后台任务登记，回落后移除
+class TimelineBigAuthor(db.Model):
+    __tablename__ = 'timeline_big_author'
+    author_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+# 每个用户关注的大V列表（follows 的冗余子集），随关注/取关及大V登记变化维护
+class TimelineBigFollow(db.Model):
+    __tablename__ = 'timeline_big_follow'
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    author_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    __table_args__ = (
+        db.Index('ix_timeline_big_follow_author', 'author_id'),
+    )
+
+# 后台任务
+class BackgroundJob(db.Model):
+    __tablename__ = 'background_job'
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(50), nullable=False, index=True)
+    payload = db.Column(db.Text, nullable=False, default='{}')  # JSON
+    # 去重键：排队/执行中的任务唯一，完成或放弃后清空
+    dedupe_key = db.Column(db.String(191), unique=True)
+    status = db.Column(db.String(20), default='pending', index=True)  # pending, running, done, failed
+    attempts = db.Column(db.Integer, default=0)
+    run_after = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    locked_by = db.Column(db.String(64))
+    locked_at = db.Column(db.DateTime)
+    last_error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
 # 站点设置
 class SiteSetting(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -135,6 +441,34 @@ class SiteSetting(db.Model):
     homepage_bg_image = db.Column(db.String(255), nullable=True)  # 首页背景图文件名（相对 static/site）
     homepage_bg_color1 = db.Column(db.String(20), default='#667eea')
     homepage_bg_color2 = db.Column(db.String(20), default='#764ba2')
+    # 地域汇总表最近一次全量重建时间；为空表示尚未从 user 表生成过，增量计数不可信
+    region_stats_built_at = db.Column(db.DateTime, nullable=True)
+
+# ----------- 跨 worker 版本号 -----------
+class VersionStamp:
+    """存放在 instance 目录下的版本号文件。
+
+    bump() 原子替换文件内容；current() 只读一个小文件，不访问数据库，
+    同一台机器上的所有 gunicorn worker 都能据此判断本地缓存是否过期。
+    """
+
+    def __init__(self, name: str):
+        self._path = os.path.join(app.instance_path, f'{name}.version')
+
+    def current(self) -> str:
+        try:
+            with open(self._path, encoding='utf-8') as f:
+                return f.read().strip() or '0'
+        except FileNotFoundError:
+            return '0'
+
+    def bump(self) -> str:
+        value = uuid.uuid4().hex[:12]
+        tmp = f'{self._path}.{os.getpid()}.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            f.write(value)
+        os.replace(tmp, self._path)
+        return value
 
 def get_site_settings() -> SiteSetting:
     settings = SiteSetting.query.first()
@@ -144,10 +478,38 @@ def get_site_settings() -> SiteSetting:
         db.session.commit()
     return settings
 
+class SiteSettingsCache:
+    """站点设置的进程内快照，只有版本号变化时才重新查询 SiteSetting。
+
+    模板只读取快照；修改设置的三个管理接口提交后调用 bump()，
+    其他 worker 在下次渲染时通过版本号文件发现变化。
+    """
+
+    FIELDS = ('site_name', 'page_title', 'homepage_bg_image', 'homepage_bg_color1', 'homepage_bg_color2')
+
+    def __init__(self):
+        self.version = VersionStamp('site_settings')
+        self._entry = None  # (version, snapshot)
+
+    def get(self):
+        version = self.version.current()
+        entry = self._entry
+        if entry and entry[0] == version:
+            return entry[1]
+        settings = get_site_settings()
+        snapshot = SimpleNamespace(**{name: getattr(settings, name) for name in self.FIELDS})
+        self._entry = (version, snapshot)
+        return snapshot
+
+    def bump(self):
+        self.version.bump()
+
+site_settings_cache = SiteSettingsCache()
+
 @app.context_processor
 def inject_site_settings():
     try:
-        settings = get_site_settings()
+        settings = site_settings_cache.get()
     except Exception:
         # 在数据库尚未创建时避免模板渲染失败
         class _Fallback:
@@ -179,11 +541,57 @@ def validate_password(password):
 def load_user(user_id):
     return db.session.get(User, int(user_id))
 
+# ----------- 首页推荐流缓存 -----------
+class HomeFeedCache:
+    """首页视频卡片片段缓存：版本号变化（审核/上传/删除）或超过 FEED_CACHE_TTL 时重新渲染"""
+
+    def __init__(self):
+        self.version = VersionStamp('home_feed')
+        self._lock = threading.Lock()
+        self._entry = None  # (version, bucket, html)
+
+    def bucket(self) -> int:
+        return int(datetime.utcnow().timestamp() // max(app.config['FEED_CACHE_TTL'], 1))
+
+    def etag(self, user_id) -> str:
+        # 站点设置（标题、背景）也渲染在首页上，其版本号一并参与
+        return (f"feed-{self.version.current()}-{site_settings_cache.version.current()}"
+                f"-{self.bucket()}-{user_id or 'anon'}")
+
+    def invalidate(self):
+        self.version.bump()
+
+    def render(self) -> str:
+        version, bucket = self.version.current(), self.bucket()
+        entry = self._entry
+        if entry and entry[0] == version and entry[1] == bucket:
+            return entry[2]
+        videos = (
+            Video.query.options(joinedload(Video.author))
+            .filter_by(status='approved')
+            .order_by(Video.created_at.desc())
+            .limit(12)
+            .all()
+        )
+        html = render_template('_feed_cards.html', videos=videos)
+        with self._lock:
+            self._entry = (version, bucket, html)
+        return html
+
+home_feed = HomeFeedCache()
+
 # 路由
 @app.route('/')
 def index():
-    videos = Video.query.filter_by(status='approved').order_by(Video.created_at.desc()).limit(12).all()
-    return render_template('index.html', videos=videos)
+    # 只读 session cookie 与版本号文件即可判断 304，不触发用户加载和数据库查询
+    etag = home_feed.etag(session.get('_user_id'))
+    if request.if_none_match.contains_weak(etag) and '_flashes' not in session:
+        response = make_response('', 304)
+    else:
+        response = make_response(render_template('index.html', feed_html=home_feed.render()))
+    response.set_etag(etag, weak=True)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
 
 @app.route('/login', methods=['GET', 'POST'])
 def login():
@@ -196,28 +604,31 @@ def login():
         if user and check_password_hash(user.password_hash, password):
             # 检查每日登录奖励
             today = datetime.now().date()
+            claimed = 0
             if user.last_login_date != today:
-                user.wanli_coins += 1
-                user.last_login_date = today
+                # 以 last_login_date 作条件，并发登录也只发一次奖励
+                table = User.__table__
+                claimed = db.session.execute(
+                    table.update()
+                    .where(table.c.id == user.id)
+                    .where(db.or_(table.c.last_login_date.is_(None), table.c.last_login_date != today))
+                    .values(last_login_date=today)
+                ).rowcount
+                if claimed:
+                    coin_ledger.grant(user.id, 1, 'daily_login')
                 db.session.commit()
+            if claimed:
                 flash(f'欢迎{user.username}同学的到来！获得1万里币奖励！')
             else:
                 flash(f'欢迎{user.username}同学的到来！')
             
+            _enqueue_geo_enrichment(user.id, _get_client_ip(request))
             if user.is_admin and not user.password_changed:
                 # 管理员首次登录，重定向到修改密码页面
                 login_user(user)
-                try:
-                    _update_user_geo_from_request(user)
-                except Exception:
-                    pass
                 return redirect(url_for('change_admin_password'))
             else:
                 login_user(user)
-                try:
-                    _update_user_geo_from_request(user)
-                except Exception:
-                    pass
                 if is_ajax:
                     return jsonify({'success': True, 'redirect_url': url_for('index')}), 200
                 return redirect(url_for('index'))
@@ -248,23 +659,22 @@ def register():
             flash('邮箱已存在')
             return render_template('register.html')
         
-        # 记录来源IP并定位
+        # 记录来源IP，定位交给后台任务
         try:
             ip = _get_client_ip(request)
         except Exception:
             ip = None
-        cc, rn = _geolocate_ip(ip) if ip else (None, None)
         user = User(
             username=username,
             email=email,
             password_hash=generate_password_hash(password),
             wanli_coins=10,  # 新用户默认10个万里币
-            register_ip=ip,
-            country_code=cc or None,
-            region_name=(rn or None)
+            register_ip=ip
         )
         db.session.add(user)
+        _region_stat_adjust(None, None, 1)
         db.session.commit()
+        _enqueue_geo_enrichment(user.id, ip)
         
         if is_ajax:
             return jsonify({'success': True, 'redirect_url': url_for('login')}), 200
@@ -279,6 +689,184 @@ def logout():
     logout_user()
     return redirect(url_for('index'))
 
+# ----------- 图片资源存储 -----------
+class AssetError(ValueError):
+    """上传的图片未通过校验，str(e) 可直接展示给用户"""
+
+class ContentAddressedStore:
+    """按内容哈希命名的图片存储：同一张图无论上传多少次只存一份，文件名不变即内容不变，可长期缓存。
+
+    variant_sizes 非空时由后台任务另存正方形缩略图 <哈希>_<边长>.webp（需要 ffmpeg，生成前或缺失时页面退回原图）。
+    """
+
+    CHUNK_SIZE = 64 * 1024
+    NAME_PATTERN = re.compile(r'^[0-9a-f]{32}\.[a-z]+$')
+    # 旧文件名可能没有扩展名（如 <uuid>_png），按文件头识别格式
+    MAGIC_NUMBERS = ((b'\x89PNG\r\n\x1a\n', 'png'), (b'\xff\xd8\xff', 'jpg'), (b'GIF87a', 'gif'), (b'GIF89a', 'gif'))
+    _stores = {}  # 后台任务按目录名找回对应的存储
+
+    def __init__(self, folder: str, allowed_extensions, label: str, max_bytes: int = 5 * 1024 * 1024, variant_sizes=()):
+        self.folder = folder
+        self.allowed_extensions = allowed_extensions
+        self.label = label
+        self.max_bytes = max_bytes
+        self.variant_sizes = tuple(variant_sizes)
+        self._known_variants = set()
+        self.key = os.path.basename(os.path.normpath(folder))
+        ContentAddressedStore._stores[self.key] = self
+
+    def save(self, file) -> str:
+        """校验并保存上传的文件，返回存储文件名；校验失败抛出 AssetError"""
+        if not file or file.filename == '':
+            raise AssetError('没有选择文件')
+        ext = file.filename.rsplit('.', 1)[1].lower() if '.' in file.filename else ''
+        if ext not in self.allowed_extensions:
+            raise AssetError(f"只支持 {', '.join(e.upper() for e in self.allowed_extensions)} 格式")
+        file.seek(0, 2)
+        file_size = file.tell()
+        file.seek(0)
+        if file_size > self.max_bytes:
+            raise AssetError(f'{self.label}文件不能超过{self.max_bytes // (1024 * 1024)}MB')
+        name = self._store(file.stream, ext)
+        # 缩略图交给后台任务生成，不占用上传请求
+        if self.variant_sizes and image_pipeline.available():
+            job_queue.enqueue('build_asset_variants', {'store': self.key, 'name': name},
+                              dedupe_key=f'variants:{self.key}:{name}')
+        return name
+
+    def import_file(self, path: str) -> str:
+        """把已有文件纳入存储并同步生成缩略图（用于迁移旧文件），不做大小限制"""
+        ext = os.path.splitext(path)[1].lstrip('.').lower()
+        with open(path, 'rb') as f:
+            if ext not in self.allowed_extensions:
+                ext = self._sniff_extension(f.read(16))
+                f.seek(0)
+            name = self._store(f, ext)
+        self.build_variants(name)
+        return name
+
+    def _sniff_extension(self, head: bytes) -> str:
+        for magic, ext in self.MAGIC_NUMBERS:
+            if head.startswith(magic):
+                return ext
+        if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+            return 'webp'
+        return self.allowed_extensions[0]
+
+    def _store(self, stream, ext: str) -> str:
+        ext = 'jpg' if ext == 'jpeg' else ext
+        digest = hashlib.sha256()
+        tmp_path = os.path.join(self.folder, f'.upload-{uuid.uuid4().hex}')
+        try:
+            # 边写临时文件边算哈希，大文件也不必整体读入内存
+            with open(tmp_path, 'wb') as out:
+                for chunk in iter(lambda: stream.read(self.CHUNK_SIZE), b''):
+                    digest.update(chunk)
+                    out.write(chunk)
+            name = f'{digest.hexdigest()[:32]}.{ext}'
+            if not os.path.exists(os.path.join(self.folder, name)):
+                os.replace(tmp_path, os.path.join(self.folder, name))
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return name
+
+    def _variant_name(self, name: str, size: int) -> str:
+        return f'{os.path.splitext(name)[0]}_{size}.webp'
+
+    def build_variants(self, name: str):
+        if not self.variant_sizes or not image_pipeline.available():
+            return
+        src = os.path.join(self.folder, name)
+        for size in self.variant_sizes:
+            dest = os.path.join(self.folder, self._variant_name(name, size))
+            if os.path.exists(dest):
+                continue
+            try:
+                image_pipeline.square(src, size, dest)
+            except Exception as e:
+                print(f"生成{self.label}缩略图失败 {name}@{size}: {e}")
+
+    def variant(self, name: str, size: int) -> str:
+        """返回最接近 size 的已生成缩略图文件名，没有则返回原文件名"""
+        if not self.NAME_PATTERN.match(name) or not self.variant_sizes:
+            return name
+        size = next((s for s in self.variant_sizes if s >= size), self.variant_sizes[-1])
+        variant = self._variant_name(name, size)
+        if variant in self._known_variants:
+            return variant
+        if os.path.exists(os.path.join(self.folder, variant)):
+            self._known_variants.add(variant)
+            return variant
+        return name
+
+avatar_store = ContentAddressedStore(app.config['AVATAR_FOLDER'], ('png', 'jpg', 'jpeg', 'gif'), '头像',
+                                     variant_sizes=app.config['AVATAR_SIZES'])
+site_asset_store = ContentAddressedStore(app.config['SITE_ASSET_FOLDER'], ('png', 'jpg', 'jpeg', 'gif', 'webp'), '背景图')
+
+@app.template_global()
+def avatar_url(avatar: str, size: int = 96) -> str:
+    """头像地址，size 为期望的像素边长（按 2 倍屏取值）"""
+    avatar = (avatar or '牛.png').strip()
+    return url_for('static', filename=f'avatars/{avatar_store.variant(avatar, size)}')
+
+@app.cli.command('migrate-avatars')
+def migrate_avatars_command():
+    """把旧的 uuid 命名头像迁移到内容寻址存储并生成缩略图"""
+    migrated = 0
+    for (avatar,) in db.session.query(User.avatar).distinct().all():
+        if not avatar or avatar_store.NAME_PATTERN.match(avatar):
+            continue
+        path = os.path.join(app.config['AVATAR_FOLDER'], avatar)
+        if not os.path.exists(path):
+            continue
+        name = avatar_store.import_file(path)
+        migrated += User.query.filter_by(avatar=avatar).update({'avatar': name}, synchronize_session=False)
+        db.session.commit()
+    home_feed.invalidate()
+    print(f"已迁移 {migrated} 个用户的头像")
+
+def _save_video_thumbnail(thumbnail_file):
+    """保存上传表单中的视频封面，未提供或格式不支持时返回 None"""
+    if not thumbnail_file or thumbnail_file.filename == '':
+        return None
+    # 检查封面文件类型
+    allowed_extensions = {'png', 'jpg', 'jpeg', 'gif'}
+    if '.' not in thumbnail_file.filename or thumbnail_file.filename.rsplit('.', 1)[1].lower() not in allowed_extensions:
+        return None
+    thumbnail_filename = secure_filename(thumbnail_file.filename)
+    thumbnail_unique_filename = f"{uuid.uuid4()}_{thumbnail_filename}"
+    thumbnail_path = os.path.join(app.config['THUMBNAIL_FOLDER'], thumbnail_unique_filename)
+    thumbnail_file.save(thumbnail_path)
+    print(f"保存封面到: {thumbnail_path}")
+    return thumbnail_unique_filename
+
+def _new_uploaded_video(unique_filename: str, thumbnail_filename) -> 'Video':
+    """按上传表单构造 Video 并加入会话，由调用方 commit"""
+    video = Video(
+        title=request.form.get('title'),
+        description=request.form.get('description'),
+        filename=unique_filename,
+        thumbnail=thumbnail_filename,
+        user_id=current_user.id
+    )
+    db.session.add(video)
+    return video
+
+def _create_uploaded_video(unique_filename: str, thumbnail_filename) -> 'Video':
+    """视频文件已落盘后创建 Video 记录（普通上传与分片上传共用）"""
+    video = _new_uploaded_video(unique_filename, thumbnail_filename)
+    db.session.commit()
+    _after_video_uploaded(video)
+    return video
+
+def _after_video_uploaded(video: 'Video'):
+    """新视频提交后刷新首页与搜索，并排队转码、封面任务"""
+    home_feed.invalidate()
+    search_index.update(video)
+    _enqueue_transcode(video)
+    _enqueue_image_jobs(video)
+
 @app.route('/upload', methods=['GET', 'POST'])
 @login_required
 def upload():
@@ -298,7 +886,7 @@ def upload():
             print(f"文件名: {file.filename}")
             
             # 自定义文件大小检查（500MB）
-            max_size = 500 * 1024 * 1024  # 500MB
+            max_size = app.config['VIDEO_MAX_SIZE']
             
             # 检查文件大小
             file.seek(0, 2)  # 移动到文件末尾
@@ -321,29 +909,8 @@ def upload():
                 file.save(file_path)
                 
                 # 处理视频封面
-                thumbnail_filename = None
-                if 'thumbnail' in request.files:
-                    thumbnail_file = request.files['thumbnail']
-                    if thumbnail_file.filename != '':
-                        # 检查封面文件类型
-                        allowed_extensions = {'png', 'jpg', 'jpeg', 'gif'}
-                        if '.' in thumbnail_file.filename and thumbnail_file.filename.rsplit('.', 1)[1].lower() in allowed_extensions:
-                            thumbnail_filename = secure_filename(thumbnail_file.filename)
-                            thumbnail_unique_filename = f"{uuid.uuid4()}_{thumbnail_filename}"
-                            thumbnail_path = os.path.join(app.config['THUMBNAIL_FOLDER'], thumbnail_unique_filename)
-                            thumbnail_file.save(thumbnail_path)
-                            thumbnail_filename = thumbnail_unique_filename
-                            print(f"保存封面到: {thumbnail_path}")
-                
-                video = Video(
-                    title=request.form.get('title'),
-                    description=request.form.get('description'),
-                    filename=unique_filename,
-                    thumbnail=thumbnail_filename,
-                    user_id=current_user.id
-                )
-                db.session.add(video)
-                db.session.commit()
+                thumbnail_filename = _save_video_thumbnail(request.files.get('thumbnail'))
+                _create_uploaded_video(unique_filename, thumbnail_filename)
                 
                 print("视频上传成功！")
                 flash('视频上传成功！')
@@ -355,42 +922,607 @@ def upload():
     
     return render_template('upload.html')
 
+# ----------- 播放量缓冲计数 -----------
+class BufferedCounter:
+    """计数聚合器（播放量、获赞数等）：每次计数只在内存累加并向本 worker 的追加日志写一行，
+    后台线程按 VIEW_FLUSH_INTERVAL 把日志轮转为一个批次，用一条批量
+    UPDATE <table> SET <column> = <column> + :n 写入数据库。
+
+    每个批次有唯一 ID，与增量在同一事务中写入 counter_flush_batch；worker 重启或崩溃后
+    残留的日志会被重新提交，已提交过的批次因主键冲突被跳过，因此不会重复计数。
+
+    rollup=(上级表, 上级列, 外键列) 时同一批次的增量再按外键汇总累加到上级行（如视频播放量汇总到作者）。
+    """
+
+    def __init__(self, name: str, table, column: str, folder: str, rollup=None):
+        self._name = name
+        self._table = table
+        self._column = column
+        self._folder = folder
+        self._rollup = rollup
+        self._lock = threading.Lock()
+        self._pending = {}  # 行 ID -> 尚未写库的增量（仅用于页面展示）
+        self._log = None
+        self._pid = None
+        self._flusher = None
+        self._last_prune = monotonic()
+
+    def record(self, row_id: int):
+        with self._lock:
+            self._ensure_started()
+            self._log.write(f'{row_id}\n')
+            self._pending[row_id] = self._pending.get(row_id, 0) + 1
+
+    def pending(self, row_id: int) -> int:
+        with self._lock:
+            return self._pending.get(row_id, 0)
+
+    def _log_path(self, pid: int) -> str:
+        return os.path.join(self._folder, f'{self._name}-{pid}.log')
+
+    def _ensure_started(self):
+        # fork 之后的第一次访问才打开日志和启动线程，每个 worker 各自一份
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._pending = {}
+        self._recover_orphans()
+        self._log = open(self._log_path(self._pid), 'a', buffering=1, encoding='utf-8')
+        self._flusher = threading.Thread(target=self._flush_loop, name=f'{self._name}-counter', daemon=True)
+        self._flusher.start()
+
+    def _recover_orphans(self):
+        """把已退出 worker 遗留的日志转成待提交批次"""
+        for path in glob.glob(os.path.join(self._folder, f'{self._name}-*.log')):
+            try:
+                pid = int(os.path.basename(path)[len(self._name) + 1:-len('.log')])
+            except ValueError:
+                continue
+            if pid != self._pid and _pid_alive(pid):
+                continue
+            self._rotate(path)
+
+    def _rotate(self, path: str):
+        target = os.path.join(self._folder, f'{self._name}-{uuid.uuid4()}.pending')
+        try:
+            os.replace(path, target)
+        except FileNotFoundError:
+            pass  # 已被其他 worker 接管
+
+    def _flush_loop(self):
+        while True:
+            sleep(app.config['VIEW_FLUSH_INTERVAL'])
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"计数 {self._name} 写入失败，将在下个周期重试: {e}")
+
+    def flush(self):
+        with self._lock:
+            if self._log is not None and self._log.tell() > 0:
+                self._log.close()
+                self._rotate(self._log_path(self._pid))
+                self._log = open(self._log_path(self._pid), 'a', buffering=1, encoding='utf-8')
+                flushed, self._pending = self._pending, {}
+            else:
+                flushed = {}
+        try:
+            with app.app_context():
+                for path in sorted(glob.glob(os.path.join(self._folder, f'{self._name}-*.pending'))):
+                    self._apply(path)
+                if monotonic() - self._last_prune > 3600:
+                    self._prune_batches()
+        except Exception:
+            # 写库失败：日志仍在，把增量还给页面展示，等待下次重试
+            with self._lock:
+                for row_id, n in flushed.items():
+                    self._pending[row_id] = self._pending.get(row_id, 0) + n
+            raise
+
+    def _apply(self, path: str):
+        batch_id = os.path.basename(path)[len(self._name) + 1:-len('.pending')]
+        counts = {}
+        try:
+            with open(path, encoding='utf-8') as f:
+                for line in f:
+                    line = line.strip()
+                    if line.isdigit():
+                        counts[int(line)] = counts.get(int(line), 0) + 1
+        except FileNotFoundError:
+            return
+        if counts:
+            table, column = self._table, self._table.c[self._column]
+            try:
+                db.session.add(CounterFlushBatch(id=batch_id))
+                db.session.flush()
+                db.session.execute(
+                    table.update()
+                    .where(table.c.id == db.bindparam('row_id'))
+                    .values({column: db.func.coalesce(column, 0) + db.bindparam('n')}),
+                    [{'row_id': row_id, 'n': n} for row_id, n in counts.items()]
+                )
+                if self._rollup is not None:
+                    self._apply_rollup(counts)
+                db.session.commit()
+            except IntegrityError:
+                # 该批次已由其他 worker 提交
+                db.session.rollback()
+            except Exception:
+                db.session.rollback()
+                raise
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def _apply_rollup(self, counts: dict):
+        parent, parent_column, foreign_key = self._rollup
+        totals = {}
+        for row_id, owner_id in db.session.execute(
+                db.select(self._table.c.id, self._table.c[foreign_key]).where(self._table.c.id.in_(list(counts)))):
+            totals[owner_id] = totals.get(owner_id, 0) + counts[row_id]
+        if totals:
+            column = parent.c[parent_column]
+            db.session.execute(
+                parent.update()
+                .where(parent.c.id == db.bindparam('row_id'))
+                .values({column: db.func.coalesce(column, 0) + db.bindparam('n')}),
+                [{'row_id': owner_id, 'n': n} for owner_id, n in totals.items()]
+            )
+
+    def _prune_batches(self):
+        # 批次记录只需覆盖日志可能残留的时间窗口
+        cutoff = datetime.utcnow() - timedelta(days=7)
+        CounterFlushBatch.query.filter(CounterFlushBatch.applied_at < cutoff).delete()
+        db.session.commit()
+        self._last_prune = monotonic()
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+view_counter = BufferedCounter('views', Video.__table__, 'views', app.config['VIEW_LOG_FOLDER'],
+                               rollup=(User.__table__, 'total_views', 'user_id'))
+like_counter = BufferedCounter('likes', User.__table__, 'received_likes', app.config['VIEW_LOG_FOLDER'])
+
+@atexit.register
+def _flush_counters_on_exit():
+    for counter in (view_counter, like_counter):
+        if counter._pid == os.getpid():
+            try:
+                counter.flush()
+            except Exception:
+                pass  # 日志保留，下次启动时恢复
+
+# ----------- 分片断点续传上传 -----------
+def _upload_part_path(upload_id: str) -> str:
+    return os.path.join(app.config['UPLOAD_FOLDER'], '.partial', f'{upload_id}.part')
+
+def _get_upload_session(upload_id: str) -> 'UploadSession':
+    upload = db.session.get(UploadSession, upload_id)
+    if upload is None or upload.user_id != current_user.id or upload.status != 'uploading':
+        abort(404)
+    return upload
+
+def _upload_session_json(upload: 'UploadSession'):
+    return {
+        'status': 'success',
+        'upload_id': upload.id,
+        'size': upload.size,
+        'received': upload.received,
+        'chunk_size': app.config['CHUNK_UPLOAD_SIZE'],
+    }
+
+def _cleanup_stale_uploads():
+    cutoff = datetime.utcnow() - timedelta(seconds=app.config['CHUNK_UPLOAD_EXPIRE'])
+    stale = (
+        UploadSession.query.filter(UploadSession.status == 'uploading', UploadSession.updated_at < cutoff)
+        .limit(20).all()
+    )
+    for upload in stale:
+        try:
+            os.remove(_upload_part_path(upload.id))
+        except FileNotFoundError:
+            pass
+        db.session.delete(upload)
+    if stale:
+        db.session.commit()
+
+@app.route('/upload/chunked/init', methods=['POST'])
+@login_required
+def upload_chunked_init():
+    """创建分片上传会话，返回 upload_id 与建议分片大小"""
+    filename = secure_filename(request.form.get('filename', ''))
+    size = request.form.get('size', type=int)
+    if not filename or not size or size <= 0:
+        return jsonify({'status': 'error', 'message': '没有选择文件'}), 400
+    max_size = app.config['VIDEO_MAX_SIZE']
+    if size > max_size:
+        return jsonify({'status': 'error', 'message': f'文件太大，最大支持 500MB，当前文件大小: {size // (1024*1024)}MB'}), 400
+    _cleanup_stale_uploads()
+    upload = UploadSession(id=str(uuid.uuid4()), user_id=current_user.id, filename=filename, size=size)
+    db.session.add(upload)
+    db.session.commit()
+    open(_upload_part_path(upload.id), 'wb').close()
+    return jsonify(_upload_session_json(upload))
+
+@app.route('/upload/chunked/<upload_id>', methods=['GET'])
+@login_required
+def upload_chunked_status(upload_id):
+    """查询已接收字节数，断线后从这里继续"""
+    return jsonify(_upload_session_json(_get_upload_session(upload_id)))
+
+@app.route('/upload/chunked/<upload_id>', methods=['PUT'])
+@login_required
+def upload_chunked_put(upload_id):
+    """写入一个分片：请求体为原始字节，?offset= 必须等于已接收字节数，
+    可选 X-Chunk-Sha256 头校验本分片内容。数据边读边写入 .part 文件，不在内存或临时文件中中转。
+    """
+    upload = _get_upload_session(upload_id)
+    offset = request.args.get('offset', type=int)
+    if offset != upload.received:
+        return jsonify(dict(_upload_session_json(upload), status='error', message='分片偏移不匹配')), 409
+    length = request.content_length or 0
+    if length <= 0 or length > app.config['CHUNK_UPLOAD_MAX_CHUNK'] or offset + length > upload.size:
+        return jsonify({'status': 'error', 'message': '分片大小无效'}), 400
+    expected = (request.headers.get('X-Chunk-Sha256') or '').strip().lower()
+
+    digest = hashlib.sha256()
+    written = 0
+    table = UploadSession.__table__
+    upload_id = upload.id
+    with open(_upload_part_path(upload_id), 'r+b') as f:
+        # 同一会话的分片串行写入
+        fcntl.flock(f, fcntl.LOCK_EX)
+        # 拿到锁后结束旧事务重新读取：等锁期间同一偏移的另一个请求可能已经提交，
+        # 此时不能再截断文件，否则会抹掉已确认的数据
+        db.session.rollback()
+        committed = db.session.execute(
+            db.select(table.c.received).where(table.c.id == upload_id)).scalar()
+        if committed != offset:
+            return jsonify({'status': 'error', 'message': '分片偏移不匹配', 'received': committed}), 409
+        # 丢弃上次中断时写了一半的数据（只截到已确认的长度）
+        f.truncate(committed)
+        f.seek(offset)
+        while written < length:
+            try:
+                data = request.stream.read(min(1024 * 1024, length - written))
+            except ClientDisconnected:
+                break  # 客户端中途断开，按数据不完整处理
+            if not data:
+                break
+            f.write(data)
+            digest.update(data)
+            written += len(data)
+        if written != length or (expected and digest.hexdigest() != expected):
+            f.truncate(offset)
+            return jsonify({'status': 'error', 'message': '分片数据不完整或校验失败', 'received': offset}), 400
+        f.flush()
+        os.fsync(f.fileno())
+        updated = db.session.execute(
+            table.update()
+            .where(table.c.id == upload_id).where(table.c.received == offset)
+            .values(received=offset + written, updated_at=datetime.utcnow())
+        ).rowcount
+        db.session.commit()
+    if not updated:
+        return jsonify({'status': 'error', 'message': '分片偏移不匹配'}), 409
+    return jsonify({'status': 'success', 'received': offset + written, 'sha256': digest.hexdigest()})
+
+@app.route('/upload/chunked/<upload_id>/complete', methods=['POST'])
+@login_required
+def upload_chunked_complete(upload_id):
+    """全部分片到齐后把 .part 文件改名为正式视频文件（同目录 rename，不复制），再创建 Video 记录。
+
+    先校验表单，再用条件 UPDATE 认领会话，重复或并发的 complete 只有一个能继续；
+    会话状态与 Video 在同一事务提交，提交失败时把文件改回 .part，客户端可以重试。
+    """
+    if not (request.form.get('title') or '').strip():
+        return jsonify({'status': 'error', 'message': '请填写视频标题'}), 400
+    upload = _get_upload_session(upload_id)
+    if upload.received != upload.size:
+        return jsonify(dict(_upload_session_json(upload), status='error', message='文件尚未上传完整')), 400
+    table = UploadSession.__table__
+    claimed = db.session.execute(
+        table.update().where(table.c.id == upload.id, table.c.status == 'uploading')
+        .values(status='completed', updated_at=datetime.utcnow())).rowcount
+    if not claimed:
+        db.session.rollback()
+        return jsonify({'status': 'error', 'message': '该上传已完成或正在处理'}), 409
+    part_path = _upload_part_path(upload.id)
+    unique_filename = f"{uuid.uuid4()}_{upload.filename}"
+    video_path = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
+    try:
+        os.replace(part_path, video_path)
+    except FileNotFoundError:
+        db.session.rollback()
+        return jsonify({'status': 'error', 'message': '上传文件已丢失，请重新上传'}), 410
+    thumbnail_filename = _save_video_thumbnail(request.files.get('thumbnail'))
+    try:
+        video = _new_uploaded_video(unique_filename, thumbnail_filename)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        os.replace(video_path, part_path)
+        if thumbnail_filename:
+            os.remove(os.path.join(app.config['THUMBNAIL_FOLDER'], thumbnail_filename))
+        raise
+    _after_video_uploaded(video)
+    return jsonify({'status': 'success', 'video_id': video.id, 'redirect_url': url_for('index')})
+
+# ----------- 视频文件分段传输 -----------
+def _iter_file_range(f, length: int, block_size: int = 256 * 1024):
+    try:
+        remaining = length
+        while remaining > 0:
+            data = f.read(min(block_size, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            yield data
+    finally:
+        f.close()
+
+@app.route('/media/uploads/<path:filename>')
+def serve_video_file(filename):
+    """视频文件：支持 Range/206、If-Range、ETag。
+
+    gunicorn 下把文件定位到起点后交给 wsgi.file_wrapper，并设置 Content-Length，
+    gunicorn 据此用 sendfile 零拷贝发送指定区间；配置 MEDIA_X_ACCEL_PREFIX 后
+    只返回 X-Accel-Redirect，由 nginx 发送文件，Python 进程不读视频字节。
+    """
+    if filename.startswith('.') or '/.' in filename:
+        abort(404)
+    path = safe_join(app.config['UPLOAD_FOLDER'], filename)
+    if not path or not os.path.isfile(path):
+        abort(404)
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+
+    prefix = app.config['MEDIA_X_ACCEL_PREFIX']
+    if prefix:
+        response = Response(mimetype=mimetype)
+        response.headers['X-Accel-Redirect'] = f"{prefix.rstrip('/')}/{quote(filename)}"
+        return response
+
+    st = os.stat(path)
+    size = st.st_size
+    etag = f'{st.st_mtime_ns:x}-{size:x}'
+    last_modified = datetime.utcfromtimestamp(int(st.st_mtime))
+    headers = {
+        'Accept-Ranges': 'bytes',
+        'Cache-Control': f"public, max-age={app.config['MEDIA_MAX_AGE']}",
+    }
+
+    def finish(response):
+        response.set_etag(etag)
+        response.last_modified = last_modified
+        response.headers.update(headers)
+        return response
+
+    if request.if_none_match.contains(etag):
+        return finish(Response(status=304))
+
+    start, length, status = 0, size, 200
+    if request.range:
+        if_range = request.if_range
+        # If-Range 不匹配（文件已变化）时返回完整文件
+        range_valid = (
+            (not if_range.etag and not if_range.date)
+            or (if_range.etag and if_range.etag == etag)
+            or (if_range.date and if_range.date.replace(tzinfo=None) >= last_modified)
+        )
+        if range_valid:
+            bounds = request.range.range_for_length(size)
+            if bounds is None:
+                response = Response(status=416)
+                response.headers['Content-Range'] = f'bytes */{size}'
+                return finish(response)
+            start, stop = bounds
+            length, status = stop - start, 206
+            headers['Content-Range'] = f'bytes {start}-{stop - 1}/{size}'
+
+    f = open(path, 'rb')
+    f.seek(start)
+    if 'wsgi.file_wrapper' in request.environ:
+        body = request.environ['wsgi.file_wrapper'](f, 256 * 1024)
+    else:
+        body = _iter_file_range(f, length)
+    response = Response(body, status=status, mimetype=mimetype, direct_passthrough=True)
+    response.content_length = length
+    return finish(response)
+
 @app.route('/video/<int:video_id>')
 def video(video_id):
     video = Video.query.get_or_404(video_id)
-    video.views += 1
-    db.session.commit()
+    view_counter.record(video.id)
+    # 页面展示 = 已落库播放量 + 本 worker 尚未写库的增量
+    view_count = (video.views or 0) + view_counter.pending(video.id)
     
-    comments = Comment.query.filter_by(video_id=video_id).order_by(Comment.created_at.desc()).all()
-    return render_template('video.html', video=video, comments=comments)
+    # 只渲染第一页评论，其余由页面滚动时通过 /video/<id>/comments 加载
+    comments, next_cursor = _comments_page(video.id)
+    is_following = video.user_id in follow_graph.following_among(
+        current_user.id if current_user.is_authenticated else None, [video.user_id])
+    return render_template('video.html', video=video, comments=comments, comments_next_cursor=next_cursor,
+                           view_count=view_count, is_following=is_following)
+
+def _comment_to_dict(c: 'Comment'):
+    return {
+        'id': c.id,
+        'content': c.content,
+        'author': c.author.username,
+        'author_avatar': avatar_url(c.author.avatar, 48),
+        'created_at': c.created_at.strftime('%Y-%m-%d %H:%M'),
+    }
+
+def _comments_page(video_id: int, cursor: str = None, limit: int = None):
+    """按 (created_at, id) 倒序取一页评论并预加载作者，返回 (评论列表, 下一页游标)"""
+    limit = limit or app.config['COMMENTS_PER_PAGE']
+    query = Comment.query.options(joinedload(Comment.author)).filter(Comment.video_id == video_id)
+    parsed = _parse_keyset_cursor(cursor)
+    if parsed:
+        created_at, row_id = parsed
+        query = query.filter(db.or_(
+            Comment.created_at < created_at,
+            db.and_(Comment.created_at == created_at, Comment.id < row_id),
+        ))
+    comments = query.order_by(Comment.created_at.desc(), Comment.id.desc()).limit(limit + 1).all()
+    next_cursor = None
+    if len(comments) > limit:
+        comments = comments[:limit]
+        next_cursor = _keyset_cursor(comments[-1].created_at, comments[-1].id)
+    return comments, next_cursor
+
+@app.route('/video/<int:video_id>/comments')
+def video_comments(video_id):
+    video = Video.query.get_or_404(video_id)
+    limit = min(max(request.args.get('limit', app.config['COMMENTS_PER_PAGE'], type=int), 1), 100)
+    comments, next_cursor = _comments_page(video.id, request.args.get('cursor'), limit)
+    return jsonify({
+        'status': 'success',
+        'comments': [_comment_to_dict(c) for c in comments],
+        'total': video.comment_count or 0,
+        'next_cursor': next_cursor,
+    })
 
 @app.route('/comment', methods=['POST'])
 @login_required
 def add_comment():
-    content = request.form.get('content')
-    video_id = request.form.get('video_id')
+    content = (request.form.get('content') or '').strip()
+    video_id = request.form.get('video_id', type=int)
     
     if content and video_id:
+        if db.session.get(Video, video_id) is None:
+            return jsonify({'status': 'error', 'message': '视频不存在'})
         comment = Comment(
             content=content,
             user_id=current_user.id,
             video_id=video_id
         )
         db.session.add(comment)
+        # 计数与评论在同一事务内原子累加，避免并发评论互相覆盖
+        table = Video.__table__
+        db.session.execute(table.update().where(table.c.id == video_id)
+                           .values(comment_count=db.func.coalesce(table.c.comment_count, 0) + 1))
         db.session.commit()
         
         return jsonify({
             'status': 'success',
-            'comment': {
-                'id': comment.id,
-                'content': comment.content,
-                'author': comment.author.username,
-                'created_at': comment.created_at.strftime('%Y-%m-%d %H:%M')
-            }
+            'comment': _comment_to_dict(comment)
         })
     
     return jsonify({'status': 'error', 'message': '评论内容不能为空'})
 
+def rebuild_comment_counts():
+    """按 comment 表重新统计每个视频的评论数，用于首次迁移或修复计数漂移"""
+    counts = (
+        db.session.query(db.func.count(Comment.id))
+        .filter(Comment.video_id == Video.id)
+        .scalar_subquery()
+    )
+    Video.query.update({Video.comment_count: counts}, synchronize_session=False)
+    db.session.commit()
+
+@app.cli.command('rebuild-comment-counts')
+def rebuild_comment_counts_command():
+    """重新统计视频评论数"""
+    rebuild_comment_counts()
+    home_feed.invalidate()
+    print("评论数已重新统计")
+
+# ----------- 弹幕分段缓存 -----------
+def _danmaku_to_dict(d: 'Danmaku'):
+    return {
+        'id': d.id,
+        'content': d.content,
+        'author': d.author.username if d.author else None,
+        'time': d.time,
+        'type': d.type,
+        'color': d.color
+    }
+
+def _danmaku_segment_of(t: float) -> int:
+    return max(int(t // app.config['DANMAKU_SEGMENT_SECONDS']), 0)
+
+class DanmakuSegmentCache:
+    """进程内 (video_id, 段号) -> 弹幕列表 的 LRU 缓存。
+
+    本进程新增弹幕直接追加到已缓存的段（正在从数据库加载的段会在加载完成后合并）；
+    其他 worker 的写入依赖 TTL 过期后重新加载。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._segments = OrderedDict()  # (video_id, seg) -> (loaded_at, [dict])
+        self._loading = {}  # (video_id, seg) -> [加载期间追加的弹幕]，key 存在表示有请求正在加载
+
+    def get(self, video_id: int, seg: int):
+        key = (video_id, seg)
+        with self._lock:
+            entry = self._segments.get(key)
+            if entry and monotonic() - entry[0] < app.config['DANMAKU_CACHE_TTL']:
+                self._segments.move_to_end(key)
+                return list(entry[1])
+            started = monotonic()
+            pending = self._loading.setdefault(key, [])
+        try:
+            items = self._load(video_id, seg)
+        except Exception:
+            with self._lock:
+                if self._loading.get(key) is pending:
+                    del self._loading[key]
+            raise
+        with self._lock:
+            if self._loading.get(key) is pending:
+                del self._loading[key]
+            entry = self._segments.get(key)
+            if entry and entry[0] >= started:
+                # 别的请求已经存入更新的结果
+                return list(entry[1])
+            loaded_ids = {d['id'] for d in items}
+            for item in pending:
+                if item['id'] not in loaded_ids:
+                    insort(items, item, key=lambda d: (d['time'], d['id']))
+            self._segments[key] = (monotonic(), items)
+            self._segments.move_to_end(key)
+            while len(self._segments) > app.config['DANMAKU_CACHE_MAX_SEGMENTS']:
+                self._segments.popitem(last=False)
+        return list(items)
+
+    def append(self, video_id: int, item: dict):
+        key = (video_id, _danmaku_segment_of(item['time']))
+        with self._lock:
+            entry = self._segments.get(key)
+            if entry:
+                insort(entry[1], item, key=lambda d: (d['time'], d['id']))
+            if key in self._loading:
+                self._loading[key].append(item)
+
+    def invalidate(self, video_id: int):
+        """视频删除后丢弃其所有缓存段"""
+        with self._lock:
+            for key in [k for k in self._segments if k[0] == video_id]:
+                del self._segments[key]
+
+    def _load(self, video_id: int, seg: int):
+        seconds = app.config['DANMAKU_SEGMENT_SECONDS']
+        query = (
+            Danmaku.query.options(joinedload(Danmaku.author))
+            .filter(Danmaku.video_id == video_id)
+            .filter(Danmaku.time < (seg + 1) * seconds)
+        )
+        # 第 0 段不设下限，早期写入的负时间弹幕归入第 0 段，与 _danmaku_segment_of 一致
+        if seg > 0:
+            query = query.filter(Danmaku.time >= seg * seconds)
+        rows = query.order_by(Danmaku.time, Danmaku.id).all()
+        return [_danmaku_to_dict(d) for d in rows]
+
+_danmaku_cache = DanmakuSegmentCache()
+
 @app.route('/danmaku', methods=['POST'])
 @login_required
 def add_danmaku():
@@ -403,47 +1535,241 @@ def add_danmaku():
     if content and video_id and time:
         try:
             time_float = float(time)
-            danmaku = Danmaku(
-                content=content,
-                user_id=current_user.id,
-                video_id=video_id,
-                time=time_float,
-                type=danmaku_type,
-                color=color
-            )   
-            db.session.add(danmaku)
-            db.session.commit()
-            
-            return jsonify({
-                'status': 'success',
-                'danmaku': {
-                    'id': danmaku.id,
-                    'content': danmaku.content,
-                    'author': danmaku.author.username,
-                    'time': danmaku.time,
-                    'type': danmaku.type,
-                    'color': danmaku.color
-                }
-            })
         except ValueError:
             return jsonify({'status': 'error', 'message': '时间格式错误'})
+        # nan/inf 也能通过 float()，写库会报错；负数不在播放时间轴上，一律拒绝
+        if not math.isfinite(time_float) or time_float < 0:
+            return jsonify({'status': 'error', 'message': '时间格式错误'})
+        danmaku = Danmaku(
+            content=content,
+            user_id=current_user.id,
+            video_id=video_id,
+            time=time_float,
+            type=danmaku_type,
+            color=color
+        )
+        db.session.add(danmaku)
+        db.session.commit()
+
+        danmaku_json = _danmaku_to_dict(danmaku)
+        _danmaku_cache.append(danmaku.video_id, danmaku_json)
+        try:
+            danmaku_broker.publish(danmaku.video_id, danmaku_json)
+        except Exception as e:
+            print(f"弹幕推送失败: {e}")
+        return jsonify({
+            'status': 'success',
+            'danmaku': danmaku_json
+        })
     
     return jsonify({'status': 'error', 'message': '弹幕内容不能为空'})
 
 @app.route('/danmaku/<int:video_id>')
 def get_danmaku(video_id):
-    danmakus = Danmaku.query.filter_by(video_id=video_id).order_by(Danmaku.time).all()
+    danmakus = (
+        Danmaku.query.options(joinedload(Danmaku.author))
+        .filter_by(video_id=video_id)
+        .order_by(Danmaku.time)
+        .all()
+    )
     return jsonify({
         'status': 'success',
-        'danmakus': [{
-            'id': d.id,
-            'content': d.content,
-            'author': d.author.username,
-            'time': d.time,
-            'type': d.type,
-            'color': d.color
-        } for d in danmakus]
+        'danmakus': [_danmaku_to_dict(d) for d in danmakus]
+    })
+
+@app.route('/danmaku/<int:video_id>/seg/<int:seg>')
+def get_danmaku_segment(video_id, seg):
+    """按时间分段获取弹幕，首屏只需第 0 段"""
+    return jsonify({
+        'status': 'success',
+        'segment': seg,
+        'segment_seconds': app.config['DANMAKU_SEGMENT_SECONDS'],
+        'danmakus': _danmaku_cache.get(video_id, seg)
+    })
+
+# ----------- 弹幕实时推送 -----------
+class LocalDanmakuBroker:
+    """进程内弹幕房间：按视频分房间，定时把一段时间内的新弹幕合并成一条消息分发给所有订阅者。
+
+    publish() 只做内存追加；分发由后台线程每 DANMAKU_PUSH_INTERVAL_MS 执行一次，
+    同一房间每个周期只序列化一次。订阅者队列有上限，慢客户端会丢弃旧批次而不是拖慢房间。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._rooms = {}    # video_id -> set(queue.Queue)
+        self._pending = {}  # video_id -> [dict]
+        self._subscribers = 0
+        self._flusher = None
+
+    def subscribe(self, video_id: int):
+        with self._lock:
+            if self._subscribers >= app.config['DANMAKU_PUSH_MAX_SUBSCRIBERS']:
+                return None
+            q = queue.Queue(maxsize=64)
+            self._rooms.setdefault(video_id, set()).add(q)
+            self._subscribers += 1
+            self._ensure_flusher()
+        return q
+
+    def unsubscribe(self, video_id: int, q):
+        with self._lock:
+            room = self._rooms.get(video_id)
+            if room and q in room:
+                room.discard(q)
+                self._subscribers -= 1
+                if not room:
+                    del self._rooms[video_id]
+
+    def publish(self, video_id: int, item: dict):
+        self._enqueue(video_id, item)
+
+    def _enqueue(self, video_id: int, item: dict):
+        with self._lock:
+            if video_id in self._rooms:
+                self._pending.setdefault(video_id, []).append(item)
+
+    def _ensure_flusher(self):
+        # 线程按需启动：gunicorn fork 之后才会创建，避免线程只存在于 master 进程
+        if self._flusher is None or not self._flusher.is_alive():
+            self._flusher = threading.Thread(target=self._flush_loop, name='danmaku-push', daemon=True)
+            self._flusher.start()
+
+    def _flush_loop(self):
+        interval = app.config['DANMAKU_PUSH_INTERVAL_MS'] / 1000.0
+        while True:
+            sleep(interval)
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            targets = {vid: list(self._rooms.get(vid, ())) for vid in pending}
+        for video_id, items in pending.items():
+            payload = json.dumps({'danmakus': items}, ensure_ascii=False)
+            for q in targets[video_id]:
+                try:
+                    q.put_nowait(payload)
+                except queue.Full:
+                    try:
+                        q.get_nowait()
+                        q.put_nowait(payload)
+                    except (queue.Empty, queue.Full):
+                        pass
+
+class RedisDanmakuBroker(LocalDanmakuBroker):
+    """通过 Redis pub/sub 在多个 worker（以及多台机器）之间共享弹幕房间。
+
+    发布走 Redis，每个 worker 用一个监听线程把消息转入本地房间，再按本地节奏合并分发。
+    """
+
+    CHANNEL_PREFIX = 'danmaku:'
+
+    def __init__(self, url: str):
+        super().__init__()
+        import redis  # 可选依赖，仅在配置 DANMAKU_BROKER_URL 时需要
+        self._redis = redis.Redis.from_url(url)
+        self._listener = None
+
+    def publish(self, video_id: int, item: dict):
+        self._redis.publish(f'{self.CHANNEL_PREFIX}{video_id}', json.dumps(item, ensure_ascii=False))
+
+    def _ensure_flusher(self):
+        super()._ensure_flusher()
+        if self._listener is None or not self._listener.is_alive():
+            self._listener = threading.Thread(target=self._listen_loop, name='danmaku-redis', daemon=True)
+            self._listener.start()
+
+    def _listen_loop(self):
+        while True:
+            try:
+                pubsub = self._redis.pubsub(ignore_subscribe_messages=True)
+                pubsub.psubscribe(f'{self.CHANNEL_PREFIX}*')
+                for message in pubsub.listen():
+                    channel = message['channel'].decode('utf-8')
+                    video_id = int(channel[len(self.CHANNEL_PREFIX):])
+                    self._enqueue(video_id, json.loads(message['data']))
+            except Exception as e:
+                print(f"弹幕 Redis 订阅断开，稍后重连: {e}")
+                sleep(1)
+
+def _create_danmaku_broker():
+    url = app.config['DANMAKU_BROKER_URL']
+    if url:
+        try:
+            return RedisDanmakuBroker(url)
+        except Exception as e:
+            print(f"弹幕 Redis 推送不可用，退回进程内推送: {e}")
+    return LocalDanmakuBroker()
+
+danmaku_broker = _create_danmaku_broker()
+
+@app.route('/danmaku/<int:video_id>/stream')
+def danmaku_stream(video_id):
+    """弹幕实时推送（Server-Sent Events），每条消息是一批新弹幕"""
+    q = danmaku_broker.subscribe(video_id)
+    if q is None:
+        return jsonify({'status': 'error', 'message': '实时弹幕连接数已满'}), 503
+
+    def generate():
+        deadline = monotonic() + app.config['DANMAKU_PUSH_MAX_SECONDS']
+        # 告知浏览器断线后的重连间隔
+        yield 'retry: 3000\n\n'
+        while monotonic() < deadline:
+            try:
+                payload = q.get(timeout=15)
+            except queue.Empty:
+                yield ': keepalive\n\n'
+                continue
+            yield f'data: {payload}\n\n'
+
+    response = Response(generate(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',  # 关闭 nginx 代理缓冲
     })
+    # 由服务器关闭响应时释放名额：生成器从未被迭代（客户端提前断开等）时 finally 不会执行
+    response.call_on_close(lambda: danmaku_broker.unsubscribe(video_id, q))
+    return response
+
+# ----------- 万里币账本 -----------
+class CoinLedger:
+    """万里币余额只用条件 UPDATE 修改，并在同一事务中记一笔流水。
+
+    扣款 UPDATE ... WHERE wanli_coins >= :n 不满足时影响 0 行，直接判定余额不足，
+    不会出现并发超扣；两个账户按 ID 顺序加锁，避免互相投币时死锁。
+    """
+
+    def transfer(self, from_user_id: int, to_user_id: int, amount: int) -> bool:
+        table = User.__table__
+        steps = [(from_user_id, -amount), (to_user_id, amount)]
+        try:
+            for user_id, delta in sorted(steps, key=lambda step: step[0]):
+                stmt = table.update().where(table.c.id == user_id)
+                if delta < 0:
+                    stmt = stmt.where(table.c.wanli_coins >= -delta)
+                result = db.session.execute(stmt.values(wanli_coins=table.c.wanli_coins + delta))
+                if result.rowcount != 1:
+                    db.session.rollback()
+                    return False
+            db.session.add(CoinTransaction(from_user_id=from_user_id, to_user_id=to_user_id,
+                                           amount=amount, kind='transfer'))
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        return True
+
+    def grant(self, user_id: int, amount: int, kind: str):
+        """系统发放（不提交，随调用方事务一起提交）"""
+        table = User.__table__
+        db.session.execute(table.update().where(table.c.id == user_id)
+                           .values(wanli_coins=db.func.coalesce(table.c.wanli_coins, 0) + amount))
+        db.session.add(CoinTransaction(to_user_id=user_id, amount=amount, kind=kind))
+
+    def balances(self, *user_ids):
+        return dict(db.session.query(User.id, User.wanli_coins).filter(User.id.in_(user_ids)).all())
+
+coin_ledger = CoinLedger()
 
 @app.route('/like_user/<int:user_id>', methods=['POST'])
 @login_required
@@ -453,13 +1779,13 @@ def like_user(user_id):
         return jsonify({'status': 'error', 'message': '不能给自己点赞'})
     
     target_user = User.query.get_or_404(user_id)
-    target_user.received_likes += 1
-    db.session.commit()
+    # 点赞数走缓冲计数，按批次写库，避免热门作者行锁争用
+    like_counter.record(target_user.id)
     
     return jsonify({
         'status': 'success',
         'message': '点赞成功！',
-        'received_likes': target_user.received_likes
+        'received_likes': (target_user.received_likes or 0) + like_counter.pending(target_user.id)
     })
 
 @app.route('/coin_user/<int:user_id>', methods=['POST'])
@@ -473,67 +1799,80 @@ def coin_user(user_id):
     if not coin_amount or coin_amount <= 0:
         return jsonify({'status': 'error', 'message': '投币数量必须大于0'})
     
-    if current_user.wanli_coins < coin_amount:
-        return jsonify({'status': 'error', 'message': f'万里币不足！您只有{current_user.wanli_coins}个万里币'})
-    
     target_user = User.query.get_or_404(user_id)
     
-    # 转移万里币
-    current_user.wanli_coins -= coin_amount
-    target_user.wanli_coins += coin_amount
-    db.session.commit()
+    # 转移万里币：余额判断与扣款在同一条条件 UPDATE 中完成
+    if not coin_ledger.transfer(current_user.id, target_user.id, coin_amount):
+        balance = coin_ledger.balances(current_user.id).get(current_user.id, 0)
+        return jsonify({'status': 'error', 'message': f'万里币不足！您只有{balance}个万里币'})
     
+    balances = coin_ledger.balances(current_user.id, target_user.id)
     return jsonify({
         'status': 'success',
         'message': f'投币成功！投出{coin_amount}个万里币',
-        'my_coins': current_user.wanli_coins,
-        'target_coins': target_user.wanli_coins
+        'my_coins': balances.get(current_user.id),
+        'target_coins': balances.get(target_user.id)
     })
 
 @app.route('/follow_user/<int:user_id>', methods=['POST'])
 @login_required
 def follow_user(user_id):
-    """关注用户"""
+    """关注用户；action=follow/unfollow 为幂等操作，不传时切换关注状态"""
     if current_user.id == user_id:
         return jsonify({'status': 'error', 'message': '不能关注自己'})
     
     target_user = User.query.get_or_404(user_id)
+    action = request.form.get('action') or (request.get_json(silent=True) or {}).get('action')
     
-    if current_user.following.filter_by(id=user_id).first():
-        # 取消关注
-        current_user.following.remove(target_user)
-        db.session.commit()
-        return jsonify({
-            'status': 'success',
-            'message': '取消关注成功',
-            'is_following': False
-        })
+    if action == 'follow':
+        changed = follow_graph.follow(current_user.id, target_user.id)
+        is_following = True
+    elif action == 'unfollow':
+        changed = follow_graph.unfollow(current_user.id, target_user.id)
+        is_following = False
     else:
-        # 关注
-        current_user.following.append(target_user)
-        db.session.commit()
-        return jsonify({
-            'status': 'success',
-            'message': '关注成功',
-            'is_following': True
-        })
+        # 切换：先尝试删除，没有可删的再插入，全程不先读后写
+        is_following = not follow_graph.unfollow(current_user.id, target_user.id)
+        changed = follow_graph.follow(current_user.id, target_user.id) if is_following else True
+    if changed:
+        timeline.on_follow_changed(current_user.id, target_user.id, is_following)
+    db.session.commit()
+    if changed:
+        if is_following:
+            timeline.on_followed(current_user.id, target_user.id)
+        timeline.check_author(target_user.id)
+    return jsonify({
+        'status': 'success',
+        'message': '关注成功' if is_following else '取消关注成功',
+        'is_following': is_following,
+        'followers_count': db.session.query(User.followers_count).filter(User.id == target_user.id).scalar() or 0
+    })
+
+@app.route('/follow_status')
+@login_required
+def follow_status():
+    """批量查询当前用户是否关注了 ?user_ids=1,2,3 中的用户"""
+    user_ids = [int(x) for x in request.args.get('user_ids', '').split(',') if x.strip().isdigit()][:200]
+    return jsonify({'status': 'success', 'following': sorted(follow_graph.following_among(current_user.id, user_ids))})
 
 @app.route('/triple_like/<int:video_id>', methods=['POST'])
 @login_required
 def triple_like(video_id):
     """三连功能"""
-    import json
-    
     video = Video.query.get_or_404(video_id)
-    triple_users = json.loads(video.triple_users)
     
-    if current_user.id in triple_users:
+    # 由主键判重，并发重复请求只有一个能插入成功
+    try:
+        with db.session.begin_nested():
+            db.session.execute(video_triple_likes.insert().values(
+                video_id=video.id, user_id=current_user.id, created_at=datetime.utcnow()))
+    except IntegrityError:
         return jsonify({'status': 'error', 'message': '您已经三连过了'})
     
-    # 添加三连
-    triple_users.append(current_user.id)
-    video.triple_likes += 1
-    video.triple_users = json.dumps(triple_users)
+    table = Video.__table__
+    db.session.execute(
+        table.update().where(table.c.id == video.id)
+        .values(triple_likes=db.func.coalesce(table.c.triple_likes, 0) + 1))
     db.session.commit()
     
     return jsonify({
@@ -542,41 +1881,525 @@ def triple_like(video_id):
         'triple_likes': video.triple_likes
     })
 
-@app.route('/admin')
-@login_required
-def admin():
-    if not current_user.is_admin:
-        flash('您没有管理员权限')
-        return redirect(url_for('index'))
-    
-    # 检查管理员是否已修改密码
-    if not current_user.password_changed:
-        return redirect(url_for('change_admin_password'))
-    
-    users = User.query.filter(User.id != current_user.id).all()
-    pending_videos = Video.query.filter_by(status='pending').all()
-    approved_videos = Video.query.filter_by(status='approved').all()
-    rejected_videos = Video.query.filter_by(status='rejected').all()
-    comments = Comment.query.all()
-    
-    return render_template('admin.html', 
-                         users=users, 
-                         pending_videos=pending_videos,
-                         approved_videos=approved_videos,
-                         rejected_videos=rejected_videos,
-                         comments=comments)
+def migrate_triple_users():
+    """把旧的 Video.triple_users JSON 列表迁移到 video_triple_likes，可重复执行"""
+    migrated = 0
+    videos = Video.query.filter(Video.triple_users.isnot(None), Video.triple_users.notin_(['', '[]'])).all()
+    for video in videos:
+        try:
+            user_ids = {int(uid) for uid in json.loads(video.triple_users)}
+        except (TypeError, ValueError):
+            print(f"视频 {video.id} 的三连数据无法解析，已跳过")
+            continue
+        existing = {
+            row[0] for row in db.session.query(video_triple_likes.c.user_id)
+            .filter(video_triple_likes.c.video_id == video.id).all()
+        }
+        valid = {row[0] for row in db.session.query(User.id).filter(User.id.in_(user_ids - existing)).all()}
+        if valid:
+            db.session.execute(video_triple_likes.insert(), [
+                {'video_id': video.id, 'user_id': uid, 'created_at': video.created_at or datetime.utcnow()}
+                for uid in valid
+            ])
+            migrated += len(valid)
+        video.triple_users = '[]'
+    db.session.commit()
+    return migrated
+
+@app.cli.command('migrate-triple-likes')
+def migrate_triple_likes_command():
+    """迁移旧版三连 JSON 数据"""
+    print(f"已迁移 {migrate_triple_users()} 条三连记录")
+
+@app.route('/admin')
+@login_required
+def admin():
+    if not current_user.is_admin:
+        flash('您没有管理员权限')
+        return redirect(url_for('index'))
+    
+    # 检查管理员是否已修改密码
+    if not current_user.password_changed:
+        return redirect(url_for('change_admin_password'))
+    
+    # 页面只渲染统计数字，各标签页的列表由前端按需请求 /admin/api/*
+    return render_template('admin.html', stats=_admin_stats())
+
+def _admin_stats():
+    """仪表盘统计：几条聚合查询，不加载任何列表"""
+    video_counts = dict(db.session.query(Video.status, db.func.count(Video.id)).group_by(Video.status).all())
+    return {
+        'users': User.query.filter(User.id != current_user.id).count(),
+        'pending': video_counts.get('pending', 0),
+        'approved': video_counts.get('approved', 0),
+        'rejected': video_counts.get('rejected', 0),
+        'comments': Comment.query.count(),
+    }
+
+def _admin_page(query, sort_columns: dict, default_sort: str, id_column):
+    """按 ?sort=&order=&page=&per_page= 排序分页（id 倒序兜底保证翻页稳定），返回 (本页记录, 分页信息)"""
+    column = sort_columns.get(request.args.get('sort'), sort_columns[default_sort])
+    ordering = column.asc() if request.args.get('order') == 'asc' else column.desc()
+    per_page = min(max(request.args.get('per_page', 20, type=int), 1), 100)
+    page = max(request.args.get('page', 1, type=int), 1)
+    total = query.order_by(None).count()
+    items = query.order_by(ordering, id_column.desc()).offset((page - 1) * per_page).limit(per_page).all()
+    return items, {'total': total, 'page': page, 'pages': (total + per_page - 1) // per_page}
+
+@app.route('/admin/api/stats')
+@login_required
+def admin_api_stats():
+    if not current_user.is_admin:
+        return jsonify({'status': 'error', 'message': '权限不足'}), 403
+    return jsonify({'status': 'success', 'stats': _admin_stats()})
+
+@app.route('/admin/api/db_pool')
+@login_required
+def admin_api_db_pool():
+    if not current_user.is_admin:
+        return jsonify({'status': 'error', 'message': '权限不足'}), 403
+    return jsonify({'status': 'success', 'pool': _db_pool_stats()})
+
+@app.route('/admin/api/videos')
+@login_required
+def admin_api_videos():
+    if not current_user.is_admin:
+        return jsonify({'status': 'error', 'message': '权限不足'}), 403
+    status = request.args.get('status', 'pending')
+    query = Video.query.options(joinedload(Video.author)).filter(Video.status == status)
+    keyword = request.args.get('q', '').strip()
+    if keyword:
+        query = query.filter(Video.title.contains(keyword, autoescape=True))
+    videos, page_info = _admin_page(query, {
+        'created_at': Video.created_at,
+        'reviewed_at': Video.reviewed_at,
+        'title': Video.title,
+        'views': Video.views,
+    }, 'created_at', Video.id)
+    return jsonify({
+        'status': 'success',
+        'videos': [{
+            'id': v.id,
+            'title': v.title,
+            'author': v.author.username,
+            'created_at': v.created_at.strftime('%Y-%m-%d %H:%M') if v.created_at else None,
+            'reviewed_at': v.reviewed_at.strftime('%Y-%m-%d %H:%M') if v.reviewed_at else None,
+            'review_comment': v.review_comment,
+            'views': v.views or 0,
+        } for v in videos],
+        **page_info,
+    })
+
+@app.route('/admin/api/users')
+@login_required
+def admin_api_users():
+    if not current_user.is_admin:
+        return jsonify({'status': 'error', 'message': '权限不足'}), 403
+    query = User.query.filter(User.id != current_user.id)
+    keyword = request.args.get('q', '').strip()
+    if keyword:
+        query = query.filter(db.or_(User.username.contains(keyword, autoescape=True),
+                                    User.email.contains(keyword, autoescape=True)))
+    active = request.args.get('active')
+    if active in ('0', '1'):
+        query = query.filter(User.is_active == (active == '1'))
+    users, page_info = _admin_page(query, {
+        'created_at': User.created_at,
+        'username': User.username,
+        'wanli_coins': User.wanli_coins,
+    }, 'created_at', User.id)
+    return jsonify({
+        'status': 'success',
+        'users': [{
+            'id': u.id,
+            'username': u.username,
+            'email': u.email,
+            'is_active': bool(u.is_active),
+            'created_at': u.created_at.strftime('%Y-%m-%d %H:%M') if u.created_at else None,
+        } for u in users],
+        **page_info,
+    })
+
+@app.route('/admin/geo')
+@login_required
+def admin_geo():
+    if not current_user.is_admin:
+        flash('您没有管理员权限')
+        return redirect(url_for('index'))
+    if not current_user.password_changed:
+        return redirect(url_for('change_admin_password'))
+    return render_template('admin_geo.html')
+
+# （已删除）世界地图页面
+
+# ----------- 关注关系 -----------
+class FollowGraph:
+    """关注关系的读写入口。
+
+    - 关注/取关直接 INSERT/DELETE follows，由主键判重，不先查再写；只有真正发生变化时才调整计数
+    - User.followers_count / following_count 与关系行在同一事务里原子增减，调用方负责 commit
+    - 列表按对方用户 id 倒序做游标分页
+    """
+
+    def follow(self, follower_id: int, followed_id: int) -> bool:
+        """返回是否新建了关注关系（已关注时返回 False）"""
+        try:
+            with db.session.begin_nested():
+                db.session.execute(follows.insert().values(follower_id=follower_id, followed_id=followed_id))
+        except IntegrityError:
+            return False
+        self._adjust(follower_id, followed_id, 1)
+        return True
+
+    def unfollow(self, follower_id: int, followed_id: int) -> bool:
+        """返回是否删除了关注关系（本就未关注时返回 False）"""
+        result = db.session.execute(follows.delete().where(
+            follows.c.follower_id == follower_id, follows.c.followed_id == followed_id))
+        if not result.rowcount:
+            return False
+        self._adjust(follower_id, followed_id, -1)
+        return True
+
+    def _adjust(self, follower_id: int, followed_id: int, delta: int):
+        table = User.__table__
+        db.session.execute(table.update().where(table.c.id == follower_id)
+                           .values(following_count=db.func.coalesce(table.c.following_count, 0) + delta))
+        db.session.execute(table.update().where(table.c.id == followed_id)
+                           .values(followers_count=db.func.coalesce(table.c.followers_count, 0) + delta))
+
+    def following_among(self, follower_id: int, user_ids) -> set:
+        """一次查询返回 user_ids 中被 follower_id 关注的那些"""
+        if not follower_id or not user_ids:
+            return set()
+        return {
+            row[0] for row in db.session.query(follows.c.followed_id)
+            .filter(follows.c.follower_id == follower_id, follows.c.followed_id.in_(list(user_ids))).all()
+        }
+
+    def _page(self, user_column, match_column, user_id: int, cursor=None, limit: int = 20):
+        query = User.query.join(follows, user_column == User.id).filter(match_column == user_id)
+        if cursor:
+            query = query.filter(User.id < cursor)
+        users = query.order_by(User.id.desc()).limit(limit + 1).all()
+        next_cursor = users[limit - 1].id if len(users) > limit else None
+        return users[:limit], next_cursor
+
+    def following_page(self, user_id: int, cursor=None, limit: int = 20):
+        """user_id 关注的人，返回 (用户列表, 下一页游标)"""
+        return self._page(follows.c.followed_id, follows.c.follower_id, user_id, cursor, limit)
+
+    def followers_page(self, user_id: int, cursor=None, limit: int = 20):
+        """关注 user_id 的人，返回 (用户列表, 下一页游标)"""
+        return self._page(follows.c.follower_id, follows.c.followed_id, user_id, cursor, limit)
+
+    def rebuild_counts(self):
+        """按 follows 表重新统计所有用户的关注数与粉丝数"""
+        followers = (db.session.query(db.func.count()).select_from(follows)
+                     .filter(follows.c.followed_id == User.id).scalar_subquery())
+        following = (db.session.query(db.func.count()).select_from(follows)
+                     .filter(follows.c.follower_id == User.id).scalar_subquery())
+        User.query.update({User.followers_count: followers, User.following_count: following},
+                          synchronize_session=False)
+        db.session.commit()
+
+follow_graph = FollowGraph()
+
+@app.cli.command('rebuild-follow-counts')
+def rebuild_follow_counts_command():
+    """重新统计用户关注数与粉丝数"""
+    follow_graph.rebuild_counts()
+    print("关注数与粉丝数已重新统计")
+
+# ----------- 创作者统计 -----------
+VIDEO_STATUSES = ('approved', 'pending', 'rejected')
+
+class CreatorStats:
+    """个人中心的统计数据：已过审视频数、总播放、获赞、粉丝。
+
+    四项都存在 user 行上增量维护：video_count 随审核/删除在调用方事务内调整，total_views 由播放量
+    批次按作者汇总，received_likes / followers_count 沿用各自的维护路径。个人中心只读这一行。
+    """
+
+    def _adjust(self, user_id: int, **values):
+        table = User.__table__
+        db.session.execute(table.update().where(table.c.id == user_id).values(
+            {table.c[name]: db.func.coalesce(table.c[name], 0) + delta for name, delta in values.items()}))
+
+    def on_status_change(self, video: 'Video', old_status: str):
+        """审核改变视频状态后调用，在调用方事务内执行"""
+        delta = int(video.status == 'approved') - int(old_status == 'approved')
+        if delta:
+            self._adjust(video.user_id, video_count=delta)
+
+    def on_delete(self, video: 'Video'):
+        """删除视频前调用，在调用方事务内执行；播放量以库中当前值为准"""
+        views = db.select(db.func.coalesce(Video.views, 0)).where(Video.id == video.id).scalar_subquery()
+        self._adjust(video.user_id, video_count=-int(video.status == 'approved'), total_views=-views)
+
+    def get(self, user: 'User') -> dict:
+        return {
+            'videos': user.video_count or 0,
+            'views': user.total_views or 0,
+            'likes': (user.received_likes or 0) + like_counter.pending(user.id),
+            'followers': user.followers_count or 0,
+        }
+
+    def status_counts(self, user_id: int) -> dict:
+        """一次分组查询返回各审核状态的视频数"""
+        counts = dict(
+            db.session.query(Video.status, db.func.count(Video.id))
+            .filter(Video.user_id == user_id).group_by(Video.status).all()
+        )
+        return {status: counts.get(status, 0) for status in VIDEO_STATUSES}
+
+    def videos_page(self, user_id: int, status: str, cursor: str = None, limit: int = 12):
+        """某审核状态下的视频，按上传时间倒序，返回 (本页视频, 下一页游标)"""
+        query = Video.query.filter(Video.user_id == user_id, Video.status == status)
+        parsed = _parse_keyset_cursor(cursor)
+        if parsed:
+            ts, last_id = parsed
+            query = query.filter(db.or_(Video.created_at < ts, db.and_(Video.created_at == ts, Video.id < last_id)))
+        videos = query.order_by(Video.created_at.desc(), Video.id.desc()).limit(limit + 1).all()
+        next_cursor = None
+        if len(videos) > limit:
+            videos = videos[:limit]
+            next_cursor = _keyset_cursor(videos[-1].created_at, videos[-1].id)
+        return videos, next_cursor
+
+    def rebuild(self):
+        """按 video 表重新统计所有用户的已过审视频数与总播放量"""
+        video_count = (db.session.query(db.func.count(Video.id))
+                       .filter(Video.user_id == User.id, Video.status == 'approved').scalar_subquery())
+        total_views = (db.session.query(db.func.coalesce(db.func.sum(Video.views), 0))
+                       .filter(Video.user_id == User.id).scalar_subquery())
+        User.query.update({User.video_count: video_count, User.total_views: total_views},
+                          synchronize_session=False)
+        db.session.commit()
+
+creator_stats = CreatorStats()
+
+@app.cli.command('rebuild-user-stats')
+def rebuild_user_stats_command():
+    """重新统计用户已过审视频数与总播放量"""
+    creator_stats.rebuild()
+    print("用户视频数与总播放量已重新统计")
+
+# ----------- 后台任务队列 -----------
+class JobQueue:
+    """基于数据库表的后台任务队列，多个 gunicorn worker 与独立的 flask run-jobs 进程可同时消费。
+
+    - enqueue() 在独立事务里插入一行，不影响调用方的会话；去重键冲突即视为已在排队
+    - 认领用条件 UPDATE（status='pending' 或执行超时），同一任务只会被一个消费者拿到
+    - 同类任务按 batch_size 成批交给处理函数；失败按指数退避重试，超过次数标记为 failed
+    - 执行期间由心跳线程定期刷新 locked_at，多小时的转码也不会被当成超时任务重复认领
+    - 任务按 lane 分通道，每个通道有自己的消费线程，转码这类长任务不会堵住地域补全、动态分发等短任务
+    - periodic() 注册的任务按时间片去重，每个时间片全局只执行一次，执行后自动排下一片
+    """
+
+    def __init__(self):
+        self._handlers = {}  # kind -> (fn, batch_size)
+        self._lanes = {}  # kind -> 通道名
+        self._periodic = {}  # kind -> 间隔秒数
+        self._wake = {}  # 通道名 -> threading.Event
+        self._pid = None
+        self._last_cleanup = monotonic()
+
+    def handler(self, kind: str, batch_size: int = 1, lane: str = 'default'):
+        def decorator(fn):
+            self._handlers[kind] = (fn, batch_size)
+            self._lanes[kind] = lane
+            self._wake.setdefault(lane, threading.Event())
+            return fn
+        return decorator
+
+    def lanes(self):
+        return sorted(set(self._lanes.values()))
+
+    def periodic(self, kind: str, interval: float):
+        self._periodic[kind] = interval
+
+    def schedule_periodic(self, kind: str) -> bool:
+        """在下一个时间片开始时执行一次；各进程重复调用由去重键合并"""
+        interval = max(self._periodic[kind], 1)
+        now = datetime.utcnow().timestamp()
+        slot = int(now // interval) + 1
+        return self.enqueue(kind, {}, dedupe_key=f'{kind}:{slot}', delay=slot * interval - now)
+
+    def enqueue(self, kind: str, payload: dict, dedupe_key: str = None, delay: float = 0) -> bool:
+        table = BackgroundJob.__table__
+        now = datetime.utcnow()
+        try:
+            with db.engine.begin() as conn:
+                conn.execute(table.insert().values(
+                    kind=kind, payload=json.dumps(payload), dedupe_key=dedupe_key, status='pending',
+                    attempts=0, run_after=now + timedelta(seconds=delay), created_at=now, updated_at=now))
+        except IntegrityError:
+            return False
+        self.ensure_workers()
+        if kind in self._lanes:
+            self._wake[self._lanes[kind]].set()
+        return True
+
+    def ensure_workers(self):
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        for kind in self._periodic:
+            self.schedule_periodic(kind)
+        for lane in self.lanes():
+            for i in range(app.config['JOB_WORKER_THREADS']):
+                threading.Thread(target=self.work_forever, args=(lane,), name=f'job-{lane}-{i}', daemon=True).start()
+
+    def run_standalone(self, lanes=None):
+        """flask run-jobs 入口：每个通道一个消费线程。先占住本进程，之后的 enqueue 不会再起 JOB_WORKER_THREADS 个线程"""
+        self._pid = os.getpid()
+        for kind in self._periodic:
+            self.schedule_periodic(kind)
+        threads = [
+            threading.Thread(target=self.work_forever, args=(lane,), name=f'job-{lane}', daemon=True)
+            for lane in (lanes or self.lanes())
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def work_forever(self, lane: str):
+        wake = self._wake[lane]
+        while True:
+            try:
+                processed = self.run_once(lane)
+            except Exception as e:
+                print(f"后台任务轮询失败（{lane}）: {e}")
+                processed = 0
+            if not processed:
+                wake.wait(app.config['JOB_POLL_INTERVAL'])
+                wake.clear()
+
+    def run_once(self, lane: str = None) -> int:
+        """认领并执行一批同类任务（lane 为空时不限通道），返回处理的任务数"""
+        with app.app_context():
+            jobs = self._claim_batch(lane)
+            if not jobs:
+                self._maybe_cleanup()
+                return 0
+            kind, worker = jobs[0].kind, jobs[0].locked_by
+            # 处理函数提交后 ORM 对象会过期，结束时只用认领时的快照
+            claimed = [(job.id, job.attempts) for job in jobs]
+            fn, _ = self._handlers[kind]
+            stop = threading.Event()
+            threading.Thread(target=self._heartbeat, args=([job_id for job_id, _ in claimed], worker, stop),
+                             name='job-heartbeat', daemon=True).start()
+            try:
+                fn([json.loads(job.payload or '{}') for job in jobs])
+            except Exception as e:
+                db.session.rollback()
+                self._finish(kind, claimed, worker, error=e)
+            else:
+                self._finish(kind, claimed, worker)
+            finally:
+                stop.set()
+            if kind in self._periodic:
+                self.schedule_periodic(kind)
+            return len(claimed)
+
+    def _claim_batch(self, lane: str = None):
+        kinds = [kind for kind in self._handlers if lane is None or self._lanes[kind] == lane]
+        table = BackgroundJob.__table__
+        now = datetime.utcnow()
+        stale = now - timedelta(seconds=app.config['JOB_LOCK_TIMEOUT'])
+        claimable = db.or_(
+            db.and_(table.c.status == 'pending', table.c.run_after <= now),
+            db.and_(table.c.status == 'running', table.c.locked_at < stale),
+        )
+        first = (
+            BackgroundJob.query.filter(claimable)
+            .filter(BackgroundJob.kind.in_(kinds))
+            .order_by(BackgroundJob.id).first()
+        )
+        if first is None:
+            return []
+        _, batch_size = self._handlers[first.kind]
+        candidates = [
+            row[0] for row in db.session.query(BackgroundJob.id)
+            .filter(claimable).filter(BackgroundJob.kind == first.kind)
+            .order_by(BackgroundJob.id).limit(batch_size).all()
+        ]
+        worker = f'{os.getpid()}:{threading.get_ident()}'
+        claimed = []
+        for job_id in candidates:
+            result = db.session.execute(
+                table.update()
+                .where(table.c.id == job_id).where(claimable)
+                .values(status='running', locked_by=worker, locked_at=now,
+                        attempts=table.c.attempts + 1, updated_at=now))
+            if result.rowcount == 1:
+                claimed.append(job_id)
+        db.session.commit()
+        if not claimed:
+            return []
+        return BackgroundJob.query.filter(BackgroundJob.id.in_(claimed)).order_by(BackgroundJob.id).all()
 
-@app.route('/admin/geo')
-@login_required
-def admin_geo():
-    if not current_user.is_admin:
-        flash('您没有管理员权限')
-        return redirect(url_for('index'))
-    if not current_user.password_changed:
-        return redirect(url_for('change_admin_password'))
-    return render_template('admin_geo.html')
+    def _heartbeat(self, job_ids, worker: str, stop: threading.Event):
+        table = BackgroundJob.__table__
+        interval = max(app.config['JOB_LOCK_TIMEOUT'] / 3, 1)
+        with app.app_context():
+            while not stop.wait(interval):
+                try:
+                    with db.engine.begin() as conn:
+                        conn.execute(
+                            table.update()
+                            .where(table.c.id.in_(job_ids), table.c.status == 'running', table.c.locked_by == worker)
+                            .values(locked_at=datetime.utcnow()))
+                except Exception as e:
+                    print(f"后台任务心跳失败: {e}")
 
-# （已删除）世界地图页面
+    def _finish(self, kind: str, claimed, worker: str, error: Exception = None):
+        """按认领时的 (id, attempts) 写回结果；条件 UPDATE 只改仍由本 worker 持有的任务，
+        心跳停滞期间被其他消费者重新认领的任务不会被覆盖"""
+        table = BackgroundJob.__table__
+        now = datetime.utcnow()
+        for job_id, attempts in claimed:
+            values = {'updated_at': now, 'locked_by': None}
+            if error is None:
+                values.update(status='done', dedupe_key=None, last_error=None)
+            elif attempts >= app.config['JOB_MAX_ATTEMPTS']:
+                values.update(status='failed', dedupe_key=None, last_error=str(error))
+                print(f"后台任务 {kind}#{job_id} 多次失败，已放弃: {error}")
+            else:
+                values.update(status='pending', run_after=now + timedelta(seconds=5 * 2 ** attempts),
+                              last_error=str(error))
+            result = db.session.execute(
+                table.update()
+                .where(table.c.id == job_id, table.c.status == 'running', table.c.locked_by == worker)
+                .values(**values))
+            if not result.rowcount:
+                print(f"后台任务 {kind}#{job_id} 已被其他消费者接管，忽略本次结果")
+        db.session.commit()
+
+    def _maybe_cleanup(self):
+        if monotonic() - self._last_cleanup < 3600:
+            return
+        self._last_cleanup = monotonic()
+        cutoff = datetime.utcnow() - timedelta(days=1)
+        BackgroundJob.query.filter(BackgroundJob.status == 'done', BackgroundJob.updated_at < cutoff).delete()
+        db.session.commit()
+
+job_queue = JobQueue()
+
+@app.before_request
+def _start_job_workers():
+    job_queue.ensure_workers()
+
+@app.cli.command('run-jobs')
+@click.option('--lane', 'lanes', multiple=True, help='只消费指定通道（可重复），默认全部通道各一个线程')
+def run_jobs_command(lanes):
+    """以独立进程消费后台任务（可配合 JOB_WORKER_THREADS=0 使用）"""
+    unknown = set(lanes) - set(job_queue.lanes())
+    if unknown:
+        raise click.BadParameter(f"未知通道: {', '.join(sorted(unknown))}（可选 {', '.join(job_queue.lanes())}）")
+    print(f"后台任务进程已启动，通道: {', '.join(lanes or job_queue.lanes())}")
+    job_queue.run_standalone(list(lanes))
 
 # ----------- 工具：基于客户端IP更新用户国家/区域 -----------
 def _get_client_ip(req):
@@ -585,72 +2408,810 @@ def _get_client_ip(req):
         return xff.split(',')[0].strip()
     return req.remote_addr
 
-def _geolocate_ip(ip: str):
-    try:
-        # 简单外部服务（开发用途）：ipapi.co
-        import json as _json
-        from urllib.request import urlopen as _urlopen
+# 英文省份名 -> 中文，便于与 ECharts 中国地图名称匹配（关键字包含判断，覆盖自治州/自治区/特别行政区等变体）
+_CN_REGION_MAPPING = [
+    ('beijing', '北京'), ('tianjin', '天津'), ('hebei', '河北'), ('shanxi', '山西'),
+    ('inner mongolia', '内蒙古'), ('neimenggu', '内蒙古'),
+    ('liaoning', '辽宁'), ('jilin', '吉林'), ('heilongjiang', '黑龙江'),
+    ('shanghai', '上海'), ('jiangsu', '江苏'), ('zhejiang', '浙江'), ('anhui', '安徽'),
+    ('fujian', '福建'), ('jiangxi', '江西'), ('shandong', '山东'), ('henan', '河南'),
+    ('hubei', '湖北'), ('hunan', '湖南'), ('guangdong', '广东'),
+    ('guangxi', '广西'), ('guangxi zhuang', '广西'),
+    ('hainan', '海南'), ('chongqing', '重庆'), ('sichuan', '四川'), ('guizhou', '贵州'),
+    ('yunnan', '云南'), ('tibet', '西藏'), ('xizang', '西藏'), ('shaanxi', '陕西'),
+    ('gansu', '甘肃'), ('qinghai', '青海'), ('ningxia', '宁夏'), ('xinjiang', '新疆'),
+    ('hong kong', '香港'), ('macau', '澳门'), ('macao', '澳门'), ('taiwan', '台湾')
+]
+
+def _normalize_region(country_code, region):
+    if country_code == 'CN' and region:
+        region_lower = region.lower()
+        for key, zh in _CN_REGION_MAPPING:
+            if key in region_lower:
+                return zh
+    return region or None
+
+class GeoIpDatabase:
+    """本地 IP 段库：mmap 只读映射，按起始地址二分查找，前面加一层 LRU。
+
+    文件格式（大端）：
+      头部 24 字节：magic(8) 记录数(u32) 区域名数(u32) 区域名表偏移(u32) 保留(u32)
+      记录 36 字节：起始 IP(16) 结束 IP(16) 国家代码(2) 区域名下标(u16，0xFFFF 表示无)
+      区域名表：每项为 长度(u16) + UTF-8 文本
+    IPv4 统一按 IPv4-mapped IPv6 存放，记录按起始地址升序排列。
+    """
+
+    MAGIC = b'WLGEO1\0\0'
+    HEADER = struct.Struct('>8sIIII')
+    RECORD = struct.Struct('>16s16s2sH')
+    NO_REGION = 0xFFFF
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._mm = None
+        self._count = 0
+        self._regions = []
+        self._stamp = None
+        self._checked_at = 0.0
+        self._cached_lookup = lru_cache(maxsize=app.config['GEOIP_CACHE_SIZE'])(self._lookup)
+
+    def lookup(self, ip: str):
+        """返回 (country_code, region)，查不到时为 (None, None)"""
         if not ip or ip.startswith('127.') or ip == '::1':
             return None, None
-        resp = _urlopen(f'https://ipapi.co/{ip}/json/', timeout=2)
-        data = _json.loads(resp.read().decode('utf-8'))
-        country_code = (data.get('country_code') or '').upper() or None
-        # 中国场景优先拿省份
-        region = data.get('region') or data.get('province') or data.get('city') or None
-        # 将英文省份名映射为中文，便于与 ECharts 中国地图名称匹配
-        if country_code == 'CN' and region:
-            region_lower = region.lower()
-            # 关键字包含判断（覆盖自治州/自治区/特别行政区等变体）
-            mapping = [
-                ('beijing', '北京'), ('tianjin', '天津'), ('hebei', '河北'), ('shanxi', '山西'),
-                ('inner mongolia', '内蒙古'), ('neimenggu', '内蒙古'),
-                ('liaoning', '辽宁'), ('jilin', '吉林'), ('heilongjiang', '黑龙江'),
-                ('shanghai', '上海'), ('jiangsu', '江苏'), ('zhejiang', '浙江'), ('anhui', '安徽'),
-                ('fujian', '福建'), ('jiangxi', '江西'), ('shandong', '山东'), ('henan', '河南'),
-                ('hubei', '湖北'), ('hunan', '湖南'), ('guangdong', '广东'),
-                ('guangxi', '广西'), ('guangxi zhuang', '广西'),
-                ('hainan', '海南'), ('chongqing', '重庆'), ('sichuan', '四川'), ('guizhou', '贵州'),
-                ('yunnan', '云南'), ('tibet', '西藏'), ('xizang', '西藏'), ('shaanxi', '陕西'),
-                ('gansu', '甘肃'), ('qinghai', '青海'), ('ningxia', '宁夏'), ('xinjiang', '新疆'),
-                ('hong kong', '香港'), ('macau', '澳门'), ('macao', '澳门'), ('taiwan', '台湾')
-            ]
-            mapped = None
-            for key, zh in mapping:
-                if key in region_lower:
-                    mapped = zh
-                    break
-            if mapped:
-                region = mapped
+        self._maybe_reload()
+        return self._cached_lookup(ip)
+
+    def _maybe_reload(self):
+        # 每个 worker 只加载一次；之后每分钟 stat 一次，数据文件被替换时重新映射
+        now = monotonic()
+        if self._stamp is not None and now - self._checked_at < 60:
+            return
+        with self._lock:
+            self._checked_at = now
+            try:
+                st = os.stat(self.path)
+            except FileNotFoundError:
+                return
+            stamp = (st.st_ino, st.st_mtime_ns, st.st_size)
+            if stamp == self._stamp:
+                return
+            with open(self.path, 'rb') as f:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, count, region_count, regions_offset, _ = self.HEADER.unpack_from(mm, 0)
+            if magic != self.MAGIC:
+                mm.close()
+                print(f"IP 库文件格式错误: {self.path}")
+                return
+            regions, offset = [], regions_offset
+            for _ in range(region_count):
+                (length,) = struct.unpack_from('>H', mm, offset)
+                regions.append(mm[offset + 2:offset + 2 + length].decode('utf-8'))
+                offset += 2 + length
+            old = self._mm
+            self._mm, self._count, self._regions, self._stamp = mm, count, regions, stamp
+            self._cached_lookup.cache_clear()
+            if old is not None:
+                old.close()
+
+    def _lookup(self, ip: str):
+        mm = self._mm
+        if mm is None:
+            return None, None
+        try:
+            key = _ip_key(ip)
+        except ValueError:
+            return None, None
+        size, base = self.RECORD.size, self.HEADER.size
+        # 找最后一个 起始地址 <= key 的记录
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if mm[base + mid * size:base + mid * size + 16] <= key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == 0:
+            return None, None
+        start, end, cc, region_idx = self.RECORD.unpack_from(mm, base + (lo - 1) * size)
+        if key > end:
+            return None, None
+        country_code = cc.decode('ascii').strip() or None
+        region = self._regions[region_idx] if region_idx != self.NO_REGION else None
         return country_code, region
+
+    @classmethod
+    def build(cls, rows, path: str) -> int:
+        """由 (start_ip, end_ip, country_code, region) 生成数据文件，原子替换旧文件"""
+        regions, region_index, records = [], {}, []
+        for start_ip, end_ip, cc, region in rows:
+            cc = (cc or '').strip().upper()[:2]
+            region = _normalize_region(cc, (region or '').strip())
+            if region and region not in region_index:
+                region_index[region] = len(regions)
+                regions.append(region)
+            records.append((_ip_key(start_ip), _ip_key(end_ip), cc.encode('ascii').ljust(2),
+                            region_index[region] if region else cls.NO_REGION))
+        records.sort(key=lambda r: r[0])
+        blob = b''.join(struct.pack('>H', len(name.encode('utf-8'))) + name.encode('utf-8') for name in regions)
+        regions_offset = cls.HEADER.size + cls.RECORD.size * len(records)
+        tmp = f'{path}.{os.getpid()}.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(cls.HEADER.pack(cls.MAGIC, len(records), len(regions), regions_offset, 0))
+            for record in records:
+                f.write(cls.RECORD.pack(*record))
+            f.write(blob)
+        os.replace(tmp, path)
+        return len(records)
+
+def _ip_key(ip: str) -> bytes:
+    addr = ipaddress.ip_address(ip.strip())
+    if addr.version == 4:
+        addr = ipaddress.IPv6Address(f'::ffff:{addr}')
+    return addr.packed
+
+geoip = GeoIpDatabase(app.config['GEOIP_DB_PATH'])
+
+def _geolocate_ip(ip: str):
+    try:
+        return geoip.lookup(ip)
     except Exception:
         return None, None
 
-def _update_user_geo_from_request(user: 'User'):
+@app.cli.command('load-geoip')
+@click.argument('source')
+def load_geoip_command(source):
+    """从 CSV（可为 .gz）刷新本地 IP 库。
+
+    支持两种列格式：start_ip,end_ip,country_code,region，
+    或 DB-IP city lite：ip_start,ip_end,continent,country,stateprov,city,...
+    """
+    opener = gzip.open if source.endswith('.gz') else open
+    skipped = 0
+
+    def rows():
+        nonlocal skipped
+        with opener(source, 'rt', encoding='utf-8', newline='') as f:
+            for row in csv.reader(f):
+                if len(row) < 3 or row[0].startswith('#'):
+                    continue
+                # 表头或其他首列不是 IP 的行直接跳过
+                try:
+                    ipaddress.ip_address(row[0].strip())
+                    ipaddress.ip_address(row[1].strip())
+                except ValueError:
+                    skipped += 1
+                    continue
+                if len(row) >= 6:
+                    yield row[0], row[1], row[3], row[4]
+                else:
+                    yield row[0], row[1], row[2], row[3] if len(row) > 3 else None
+
+    count = GeoIpDatabase.build(rows(), app.config['GEOIP_DB_PATH'])
+    print(f"IP 库已更新：{count} 条记录 -> {app.config['GEOIP_DB_PATH']}" + (f"（跳过 {skipped} 行非 IP 数据）" if skipped else ''))
+
+def _enqueue_geo_enrichment(user_id: int, ip: str):
+    """登录/注册只排队，IP 定位与用户更新由后台任务完成"""
+    if not ip:
+        return
     try:
-        ip = _get_client_ip(request)
-        cc, rn = _geolocate_ip(ip)
-        updated = False
+        job_queue.enqueue('enrich_user_geo', {'user_id': user_id, 'ip': ip},
+                          dedupe_key=f'geo:{user_id}:{ip}')
+    except Exception as e:
+        print(f"地域任务排队失败: {e}")
+
+@job_queue.handler('enrich_user_geo', batch_size=100)
+def _enrich_user_geo(payloads):
+    # 同一用户只取最后一次的 IP，整批一次提交
+    latest_ip = {}
+    for payload in payloads:
+        latest_ip[payload['user_id']] = payload['ip']
+    users = User.query.filter(User.id.in_(list(latest_ip))).all()
+    for user in users:
+        cc, rn = _geolocate_ip(latest_ip[user.id])
+        old_key = _region_key(user.country_code, user.region_name)
         if cc and user.country_code != cc:
             user.country_code = cc
-            updated = True
         if rn and user.region_name != rn:
             user.region_name = rn
-            updated = True
-        if updated:
-            db.session.commit()
+        _region_stat_move(old_key, _region_key(user.country_code, user.region_name))
+    db.session.commit()
+
+# ----------- HLS 转码 -----------
+class FfmpegHlsEncoder:
+    """用 ffmpeg 把源视频切成多档码率的 HLS，每档一个子目录，最后写主播放列表"""
+
+    def available(self) -> bool:
+        return shutil.which(app.config['FFMPEG_BIN']) is not None
+
+    def probe_size(self, src: str):
+        """返回源视频 (宽, 高)，探测失败时返回 (None, None)"""
+        try:
+            out = subprocess.run(
+                [app.config['FFPROBE_BIN'], '-v', 'error', '-select_streams', 'v:0',
+                 '-show_entries', 'stream=width,height', '-of', 'csv=p=0', src],
+                capture_output=True, text=True, timeout=60, check=True).stdout
+            width, height = out.strip().splitlines()[0].split(',')[:2]
+            return int(width), int(height)
+        except Exception:
+            return None, None
+
+    def encode(self, src: str, out_dir: str):
+        """返回生成的档位列表 [(宽, 高, 码率kbps)]，宽度按源视频比例计算，未知时为 None"""
+        source_width, source_height = self.probe_size(src)
+        renditions = [r for r in app.config['HLS_RENDITIONS'] if not source_height or r[0] <= source_height]
+        renditions = renditions or app.config['HLS_RENDITIONS'][:1]
+        result = []
+        for height, kbps in renditions:
+            rendition_dir = os.path.join(out_dir, f'{height}p')
+            os.makedirs(rendition_dir, exist_ok=True)
+            subprocess.run([
+                app.config['FFMPEG_BIN'], '-y', '-v', 'error', '-i', src,
+                '-map', '0:v:0', '-map', '0:a:0?',
+                '-vf', f'scale=-2:{height}',
+                '-c:v', 'libx264', '-preset', 'veryfast', '-profile:v', 'main',
+                '-b:v', f'{kbps}k', '-maxrate', f'{int(kbps * 1.07)}k', '-bufsize', f'{kbps * 2}k',
+                '-g', '48', '-keyint_min', '48', '-sc_threshold', '0',
+                '-c:a', 'aac', '-b:a', '128k', '-ac', '2',
+                '-f', 'hls', '-hls_time', '6', '-hls_playlist_type', 'vod',
+                '-hls_segment_filename', os.path.join(rendition_dir, 'seg_%04d.ts'),
+                os.path.join(rendition_dir, 'index.m3u8'),
+            ], check=True, capture_output=True, timeout=app.config['TRANSCODE_TIMEOUT'])
+            # 与 scale=-2:高 一致：按源比例缩放后取偶数
+            width = round(source_width * height / source_height / 2) * 2 if source_width and source_height else None
+            result.append((width, height, kbps))
+        return result
+
+def _write_master_playlist(out_dir: str, renditions):
+    lines = ['#EXTM3U', '#EXT-X-VERSION:3']
+    for width, height, kbps in renditions:
+        bandwidth = (kbps + 128) * 1000
+        # RESOLUTION 是可选属性，源尺寸未知时不写，避免给竖屏等非 16:9 视频报错误的分辨率
+        resolution = f',RESOLUTION={width}x{height}' if width else ''
+        lines.append(f'#EXT-X-STREAM-INF:BANDWIDTH={bandwidth}{resolution}')
+        lines.append(f'{height}p/index.m3u8')
+    with open(os.path.join(out_dir, 'master.m3u8'), 'w', encoding='utf-8') as f:
+        f.write('\n'.join(lines) + '\n')
+
+hls_encoder = FfmpegHlsEncoder()
+
+def _hls_dir(video_id: int) -> str:
+    return os.path.join(app.config['HLS_FOLDER'], str(video_id))
+
+def _enqueue_transcode(video: 'Video'):
+    if not hls_encoder.available():
+        return
+    if job_queue.enqueue('transcode_video', {'video_id': video.id}, dedupe_key=f'transcode:{video.id}'):
+        table = Video.__table__
+        db.session.execute(table.update().where(table.c.id == video.id).values(processing_status='queued'))
+        db.session.commit()
+
+@job_queue.handler('transcode_video', lane='transcode')
+def _transcode_video(payloads):
+    video_id = payloads[0]['video_id']
+    video = db.session.get(Video, video_id)
+    if video is None:
+        return
+    video.processing_status = 'processing'
+    db.session.commit()
+    src = os.path.join(app.config['UPLOAD_FOLDER'], video.filename)
+    # 先输出到临时目录，完成后整体替换，播放器不会读到半成品
+    tmp_dir = f'{_hls_dir(video_id)}.tmp-{uuid.uuid4().hex[:8]}'
+    try:
+        renditions = hls_encoder.encode(src, tmp_dir)
+        _write_master_playlist(tmp_dir, renditions)
+        shutil.rmtree(_hls_dir(video_id), ignore_errors=True)
+        os.replace(tmp_dir, _hls_dir(video_id))
     except Exception:
-        db.session.rollback()
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        video.processing_status = 'failed'
+        db.session.commit()
+        raise
+    video.processing_status = 'ready'
+    video.hls_master = f'{video_id}/master.m3u8'
+    db.session.commit()
+
+@app.route('/video/<int:video_id>/processing')
+def video_processing_status(video_id):
+    video = Video.query.get_or_404(video_id)
+    return jsonify({
+        'status': 'success',
+        'processing_status': video.processing_status,
+        'hls_url': url_for('static', filename=f'hls/{video.hls_master}') if video.hls_master else None,
+    })
+
+# ----------- 封面缩放与拖动预览图 -----------
+class FfmpegImagePipeline:
+    """用 ffmpeg 截取封面帧、生成多尺寸 JPEG/WebP 封面，以及拖动进度条时的预览雪碧图"""
+
+    def available(self) -> bool:
+        return shutil.which(app.config['FFMPEG_BIN']) is not None
+
+    def _run(self, args):
+        subprocess.run([app.config['FFMPEG_BIN'], '-y', '-v', 'error', *args],
+                       check=True, capture_output=True, timeout=app.config['TRANSCODE_TIMEOUT'])
+
+    def _probe(self, src: str, entries: str):
+        try:
+            out = subprocess.run(
+                [app.config['FFPROBE_BIN'], '-v', 'error', '-select_streams', 'v:0',
+                 '-show_entries', entries, '-of', 'csv=p=0', src],
+                capture_output=True, text=True, timeout=60, check=True).stdout
+            return float(out.strip().splitlines()[0])
+        except Exception:
+            return None
+
+    def extract_poster(self, src: str, dest: str):
+        # 避开片头黑屏：取 10% 处（最多 30 秒）的一帧
+        duration = self._probe(src, 'format=duration')
+        offset = min(duration * 0.1, 30) if duration else 0
+        self._run(['-ss', f'{offset:.2f}', '-i', src, '-frames:v', '1', '-q:v', '2', dest])
+
+    def resize(self, src: str, out_dir: str):
+        """返回生成的宽度列表（升序），不会把小图放大"""
+        source_width = self._probe(src, 'stream=width')
+        widths = [w for w in app.config['THUMBNAIL_WIDTHS'] if not source_width or w <= source_width]
+        # 原图比所有档位都窄时只按原宽度出一档
+        widths = widths or [int(source_width)]
+        os.makedirs(out_dir, exist_ok=True)
+        for width in widths:
+            scale = f'scale={width}:-2'
+            self._run([
+                '-i', src,
+                '-vf', scale, '-frames:v', '1', '-q:v', '3', os.path.join(out_dir, f'w{width}.jpg'),
+                '-vf', scale, '-frames:v', '1', '-c:v', 'libwebp', '-quality', '80', os.path.join(out_dir, f'w{width}.webp'),
+            ])
+        return widths
+
+    def square(self, src: str, size: int, dest: str):
+        """居中裁成 size x size 的 WebP，先写临时文件再替换，避免读到半张图"""
+        tmp_dest = f'{dest}.tmp.webp'
+        self._run(['-i', src, '-vf', f'scale={size}:{size}:force_original_aspect_ratio=increase,crop={size}:{size}',
+                   '-frames:v', '1', '-c:v', 'libwebp', '-quality', '85', tmp_dest])
+        os.replace(tmp_dest, dest)
+
+    def sprite(self, src: str, dest: str):
+        """把整段视频按固定间隔截帧拼成一张图，返回前端定位所需的信息"""
+        duration = self._probe(src, 'format=duration')
+        if not duration:
+            return None
+        interval = max(app.config['SPRITE_INTERVAL'], math.ceil(duration / app.config['SPRITE_MAX_TILES']))
+        count = max(1, math.ceil(duration / interval))
+        columns = min(count, app.config['SPRITE_COLUMNS'])
+        rows = math.ceil(count / columns)
+        tile_w, tile_h = app.config['SPRITE_TILE_SIZE']
+        vf = (f'fps=1/{interval},scale={tile_w}:{tile_h}:force_original_aspect_ratio=decrease,'
+              f'pad={tile_w}:{tile_h}:(ow-iw)/2:(oh-ih)/2,tile={columns}x{rows}')
+        # 只解码关键帧，长视频也能很快完成
+        self._run(['-skip_frame', 'nokey', '-i', src, '-vf', vf, '-frames:v', '1', '-q:v', '5', dest])
+        return {'interval': interval, 'count': count, 'columns': columns, 'width': tile_w, 'height': tile_h}
+
+image_pipeline = FfmpegImagePipeline()
+
+def _thumbnail_variant_dir(thumbnail: str) -> str:
+    # 以封面文件名区分目录，换封面后 URL 随之变化，不受静态文件长缓存影响
+    return os.path.join(app.config['THUMBNAIL_FOLDER'], 'variants', os.path.splitext(thumbnail)[0])
+
+def _enqueue_image_jobs(video: 'Video'):
+    if not image_pipeline.available():
+        return
+    job_queue.enqueue('generate_video_images', {'video_id': video.id, 'thumbnail': video.thumbnail},
+                      dedupe_key=f'images:{video.id}:{(video.thumbnail or "")[:36]}')
+
+@job_queue.handler('build_asset_variants')
+def _build_asset_variants(payloads):
+    for p in payloads:
+        store = ContentAddressedStore._stores.get(p['store'])
+        if store is not None:
+            store.build_variants(p['name'])
+
+@job_queue.handler('generate_video_images')
+def _generate_video_images(payloads):
+    payload = payloads[0]
+    video = db.session.get(Video, payload['video_id'])
+    if video is None or video.thumbnail != payload.get('thumbnail'):
+        return  # 视频已删除，或封面已被替换（新封面有自己的任务）
+    src = os.path.join(app.config['UPLOAD_FOLDER'], video.filename)
+    thumbnail = video.thumbnail
+    values = {}
+    if not thumbnail:
+        thumbnail = f"{uuid.uuid4()}_poster.jpg"
+        image_pipeline.extract_poster(src, os.path.join(app.config['THUMBNAIL_FOLDER'], thumbnail))
+        values['thumbnail'] = thumbnail
+    widths = image_pipeline.resize(os.path.join(app.config['THUMBNAIL_FOLDER'], thumbnail),
+                                   _thumbnail_variant_dir(thumbnail))
+    values['thumbnail_widths'] = ','.join(str(w) for w in widths)
+    if not video.preview_sprite:
+        sprite_name = f'{video.id}.jpg'
+        sprite = image_pipeline.sprite(src, os.path.join(app.config['THUMBNAIL_FOLDER'], 'sprites', sprite_name))
+        if sprite:
+            values['preview_sprite'] = json.dumps(dict(sprite, file=sprite_name))
+    # 条件更新：处理期间用户若上传了新封面，不覆盖
+    table = Video.__table__
+    same_thumbnail = table.c.thumbnail.is_(None) if payload.get('thumbnail') is None else table.c.thumbnail == payload['thumbnail']
+    db.session.execute(table.update().where(table.c.id == video.id).where(same_thumbnail).values(**values))
+    db.session.commit()
+    home_feed.invalidate()
+
+def _thumbnail_widths(video) -> list:
+    return [int(w) for w in (video.thumbnail_widths or '').split(',') if w]
+
+@app.template_global()
+def thumbnail_url(video, width: int = None, default: str = '壁纸.png') -> str:
+    """封面地址；给出 width 且已生成缩放图时返回不小于该宽度的最接近一档"""
+    if not video.thumbnail:
+        return url_for('static', filename=f'thumbnails/{default}')
+    widths = _thumbnail_widths(video)
+    if width and widths:
+        chosen = next((w for w in widths if w >= width), widths[-1])
+        stem = os.path.splitext(video.thumbnail)[0]
+        return url_for('static', filename=f'thumbnails/variants/{stem}/w{chosen}.jpg')
+    return url_for('static', filename=f'thumbnails/{video.thumbnail}')
+
+@app.template_global()
+def thumbnail_srcset(video, fmt: str = 'jpg') -> str:
+    """生成 srcset 字符串，缩放图尚未生成时返回空串（模板只用 src）"""
+    widths = _thumbnail_widths(video)
+    if not video.thumbnail or not widths:
+        return ''
+    stem = os.path.splitext(video.thumbnail)[0]
+    return ', '.join(
+        f"{url_for('static', filename=f'thumbnails/variants/{stem}/w{w}.{fmt}')} {w}w" for w in widths)
+
+# ----------- 关注动态流 -----------
+class TimelineService:
+    """“关注”动态流。
+
+    普通作者的视频过审后由后台任务写入每个粉丝的收件箱（fan-out-on-write）；
+    粉丝数超过 TIMELINE_FANOUT_LIMIT 的作者登记为大V，不写收件箱，读取时按作者直接查视频再合并。
+    每个用户关注的大V另存在 timeline_big_follow 中，读取时不必扫描全部关注关系；
+    两路都按 (发布时间, 视频id) 倒序取 page_size+1 条，读取开销与关注人数无关。
+    """
+
+    def _is_big_author(self, author_id: int) -> bool:
+        return db.session.get(TimelineBigAuthor, author_id) is not None
+
+    def on_approved(self, video: 'Video'):
+        """视频过审后调用（需在 commit 之后）；是否写收件箱由任务执行时按作者当前状态决定"""
+        job_queue.enqueue('timeline_fanout', {'video_id': video.id}, dedupe_key=f'timeline_fanout:{video.id}')
+
+    def on_follow_changed(self, follower_id: int, followed_id: int, is_following: bool):
+        """关注关系变化后维护收件箱与大V关注列表，在调用方事务内执行"""
+        if not is_following:
+            self.remove_author(follower_id, followed_id)
+            TimelineBigFollow.query.filter(TimelineBigFollow.user_id == follower_id,
+                                           TimelineBigFollow.author_id == followed_id).delete(synchronize_session=False)
+            return
+        try:
+            with db.session.begin_nested():
+                db.session.execute(TimelineBigFollow.__table__.insert().from_select(
+                    ['user_id', 'author_id'],
+                    db.select(db.literal(follower_id), TimelineBigAuthor.author_id)
+                    .where(TimelineBigAuthor.author_id == followed_id)))
+        except IntegrityError:
+            pass  # 大V登记任务已经写入
+
+    def on_followed(self, follower_id: int, followed_id: int):
+        """新关注后补齐对方最近的视频（需在 commit 之后调用）"""
+        if not self._is_big_author(followed_id):
+            job_queue.enqueue('timeline_backfill', {'follower_id': follower_id, 'followed_id': followed_id},
+                              dedupe_key=f'timeline_backfill:{follower_id}:{followed_id}')
+
+    def check_author(self, author_id: int):
+        """粉丝数越过阈值（任一方向）时排队切换该作者的分发方式（需在 commit 之后调用）"""
+        followers = db.session.query(User.followers_count).filter(User.id == author_id).scalar() or 0
+        if (followers > app.config['TIMELINE_FANOUT_LIMIT']) != self._is_big_author(author_id):
+            job_queue.enqueue('timeline_author_mode', {'author_id': author_id},
+                              dedupe_key=f'timeline_author_mode:{author_id}')
+
+    def sync_author_mode(self, author_id: int):
+        """按当前粉丝数登记或移除大V，在调用方事务内执行"""
+        followers = db.session.query(User.followers_count).filter(User.id == author_id).scalar() or 0
+        is_big = followers > app.config['TIMELINE_FANOUT_LIMIT']
+        if is_big == self._is_big_author(author_id):
+            return
+        TimelineBigFollow.query.filter(TimelineBigFollow.author_id == author_id).delete(synchronize_session=False)
+        if is_big:
+            db.session.add(TimelineBigAuthor(author_id=author_id))
+            db.session.execute(TimelineBigFollow.__table__.insert().from_select(
+                ['user_id', 'author_id'],
+                db.select(follows.c.follower_id, follows.c.followed_id).where(follows.c.followed_id == author_id)))
+            return
+        # 回落到阈值以下：作为大V期间发布的视频从未写入收件箱，给每个粉丝补齐最近的视频
+        TimelineEntry.query.filter(TimelineEntry.author_id == author_id).delete(synchronize_session=False)
+        recent = (
+            db.select(Video.id, Video.user_id, Video.reviewed_at)
+            .where(Video.user_id == author_id, Video.status == 'approved', Video.reviewed_at.isnot(None))
+            .order_by(Video.reviewed_at.desc(), Video.id.desc())
+            .limit(app.config['TIMELINE_BACKFILL'])
+            .subquery()
+        )
+        self._insert_from(
+            db.select(follows.c.follower_id, recent.c.id, recent.c.user_id, recent.c.reviewed_at)
+            .join_from(follows, recent, follows.c.followed_id == recent.c.user_id))
+        TimelineBigAuthor.query.filter(TimelineBigAuthor.author_id == author_id).delete(synchronize_session=False)
+
+    def remove_video(self, video_id: int):
+        """视频被拒绝或删除时从所有收件箱移除，在调用方事务内执行"""
+        TimelineEntry.query.filter(TimelineEntry.video_id == video_id).delete(synchronize_session=False)
+
+    def remove_author(self, user_id: int, author_id: int):
+        """取关后清掉该作者在收件箱里的视频，在调用方事务内执行"""
+        TimelineEntry.query.filter(TimelineEntry.user_id == user_id,
+                                   TimelineEntry.author_id == author_id).delete(synchronize_session=False)
+
+    def _insert_from(self, select):
+        # 先删后插，任务重试或重复执行都不会产生重复行
+        db.session.execute(TimelineEntry.__table__.insert().from_select(
+            ['user_id', 'video_id', 'author_id', 'published_at'], select))
+
+    def fanout(self, video: 'Video'):
+        self.remove_video(video.id)
+        self._insert_from(
+            db.select(follows.c.follower_id, db.literal(video.id), db.literal(video.user_id),
+                      db.literal(video.reviewed_at or video.created_at))
+            .where(follows.c.followed_id == video.user_id))
+
+    def backfill(self, follower_id: int, followed_id: int):
+        self.remove_author(follower_id, followed_id)
+        # 只在关注关系仍然存在时补齐，避免与随后的取关竞争
+        still_following = db.exists().where(follows.c.follower_id == follower_id, follows.c.followed_id == followed_id)
+        recent = (
+            db.select(db.literal(follower_id), Video.id, Video.user_id, Video.reviewed_at)
+            .where(Video.user_id == followed_id, Video.status == 'approved', Video.reviewed_at.isnot(None), still_following)
+            .order_by(Video.reviewed_at.desc(), Video.id.desc())
+            .limit(app.config['TIMELINE_BACKFILL'])
+        )
+        self._insert_from(recent)
+
+    def page(self, user_id: int, cursor: str = None, limit: int = 20):
+        """返回 (本页视频, 下一页游标)"""
+        parsed = _parse_keyset_cursor(cursor)
+
+        def after_cursor(query, published, video_id):
+            if not parsed:
+                return query
+            ts, last_id = parsed
+            return query.filter(db.or_(published < ts, db.and_(published == ts, video_id < last_id)))
+
+        inbox = after_cursor(
+            db.session.query(TimelineEntry.video_id, TimelineEntry.published_at)
+            .filter(TimelineEntry.user_id == user_id),
+            TimelineEntry.published_at, TimelineEntry.video_id)
+        rows = inbox.order_by(TimelineEntry.published_at.desc(), TimelineEntry.video_id.desc()).limit(limit + 1).all()
+
+        # 读时合并：关注的大V数量有限，直接按作者查最近的视频
+        big_authors = [
+            row[0] for row in db.session.query(TimelineBigFollow.author_id)
+            .filter(TimelineBigFollow.user_id == user_id).all()
+        ]
+        if big_authors:
+            pulled = after_cursor(
+                db.session.query(Video.id, Video.reviewed_at)
+                .filter(Video.user_id.in_(big_authors), Video.status == 'approved', Video.reviewed_at.isnot(None)),
+                Video.reviewed_at, Video.id)
+            rows += pulled.order_by(Video.reviewed_at.desc(), Video.id.desc()).limit(limit + 1).all()
+
+        # 作者登记为大V前写入的收件箱与读时合并可能重叠，按视频去重
+        merged = sorted({video_id: published for video_id, published in rows}.items(),
+                        key=lambda item: (item[1], item[0]), reverse=True)
+        next_cursor = None
+        if len(merged) > limit:
+            merged = merged[:limit]
+            next_cursor = _keyset_cursor(merged[-1][1], merged[-1][0])
+        ids = [video_id for video_id, _ in merged]
+        videos = {
+            v.id: v for v in Video.query.options(joinedload(Video.author))
+            .filter(Video.id.in_(ids), Video.status == 'approved').all()
+        } if ids else {}
+        return [videos[i] for i in ids if i in videos], next_cursor
+
+timeline = TimelineService()
+
+@job_queue.handler('timeline_fanout', batch_size=20)
+def _timeline_fanout(payloads):
+    big_authors = db.select(TimelineBigAuthor.author_id)
+    videos = Video.query.filter(Video.id.in_([p['video_id'] for p in payloads]), Video.status == 'approved',
+                                Video.user_id.not_in(big_authors)).all()
+    for video in videos:
+        timeline.fanout(video)
+    db.session.commit()
+
+@job_queue.handler('timeline_backfill', batch_size=50)
+def _timeline_backfill(payloads):
+    for p in payloads:
+        timeline.backfill(p['follower_id'], p['followed_id'])
+    db.session.commit()
+
+@job_queue.handler('timeline_author_mode')
+def _timeline_author_mode(payloads):
+    for p in payloads:
+        timeline.sync_author_mode(p['author_id'])
+    db.session.commit()
+
+@app.cli.command('rebuild-timeline')
+def rebuild_timeline_command():
+    """按现有关注关系重建所有收件箱与大V关注列表（首次上线或数据修复时使用）"""
+    limit = app.config['TIMELINE_FANOUT_LIMIT']
+    TimelineEntry.query.delete()
+    TimelineBigFollow.query.delete()
+    TimelineBigAuthor.query.delete()
+    db.session.execute(TimelineBigAuthor.__table__.insert().from_select(
+        ['author_id'], db.select(User.id).where(User.followers_count > limit)))
+    db.session.execute(TimelineBigFollow.__table__.insert().from_select(
+        ['user_id', 'author_id'],
+        db.select(follows.c.follower_id, follows.c.followed_id)
+        .join(User, User.id == follows.c.followed_id).where(User.followers_count > limit)))
+    pairs = (
+        db.session.query(follows.c.follower_id, follows.c.followed_id)
+        .join(User, User.id == follows.c.followed_id)
+        .filter(User.followers_count <= limit)
+        .all()
+    )
+    for i, (follower_id, followed_id) in enumerate(pairs, 1):
+        timeline.backfill(follower_id, followed_id)
+        if i % 500 == 0:
+            db.session.commit()
+    db.session.commit()
+    print(f"已重建 {len(pairs)} 条关注关系的动态收件箱")
+
+@app.route('/following_feed')
+@login_required
+def following_feed():
+    videos, next_cursor = timeline.page(current_user.id, request.args.get('cursor'), app.config['TIMELINE_PAGE_SIZE'])
+    feed_html = render_template('_feed_cards.html', videos=videos)
+    return render_template('index.html', feed_html=feed_html, feed_tab='following', next_cursor=next_cursor)
+
+# ----------- 热门排行 -----------
+class HotRanking:
+    """热门排行。
+
+    热度 = (各项互动按 HOT_WEIGHTS 加权求和 + 1) / (发布后小时数 + 2) ^ HOT_GRAVITY。
+    后台周期任务用一条聚合查询取出窗口内所有视频的计数，算分后 executemany 批量写回 video.hot_score，
+    滑出窗口或已下架的视频整体清零；读取只走 ix_video_status_hot 的范围扫描。
+    """
+
+    def refresh(self) -> int:
+        """重算窗口内所有过审视频的热度，返回参与计算的视频数"""
+        now = datetime.utcnow()
+        since = now - timedelta(days=app.config['HOT_WINDOW_DAYS'])
+        weights, gravity = app.config['HOT_WEIGHTS'], app.config['HOT_GRAVITY']
+        table = Video.__table__
+        published = db.func.coalesce(table.c.reviewed_at, table.c.created_at)
+        danmaku_count = (
+            db.select(db.func.count(Danmaku.id)).where(Danmaku.video_id == table.c.id).scalar_subquery()
+        )
+        rows = db.session.execute(
+            db.select(table.c.id, table.c.views, table.c.likes, table.c.triple_likes,
+                      table.c.comment_count, published, danmaku_count)
+            .where(table.c.status == 'approved', published >= since)
+        ).all()
+        scores = []
+        for video_id, views, likes, triple_likes, comments, published_at, danmaku in rows:
+            engagement = (
+                (views or 0) * weights['views'] + (likes or 0) * weights['likes']
+                + (triple_likes or 0) * weights['triple_likes'] + (comments or 0) * weights['comments']
+                + (danmaku or 0) * weights['danmaku']
+            )
+            age_hours = max((now - published_at).total_seconds() / 3600, 0)
+            scores.append({'row_id': video_id, 'score': (engagement + 1) / (age_hours + 2) ** gravity})
+        if scores:
+            db.session.execute(
+                table.update().where(table.c.id == db.bindparam('row_id')).values(hot_score=db.bindparam('score')),
+                scores)
+        db.session.execute(
+            table.update()
+            .where(table.c.hot_score > 0)
+            .where(db.or_(table.c.status != 'approved', published < since))
+            .values(hot_score=0))
+        db.session.commit()
+        return len(scores)
+
+    def page(self, page: int, per_page: int):
+        """返回 (本页视频, 是否有下一页)"""
+        videos = (
+            Video.query.options(joinedload(Video.author))
+            .filter(Video.status == 'approved', Video.hot_score > 0)
+            .order_by(Video.hot_score.desc(), Video.id.desc())
+            .offset((page - 1) * per_page)
+            .limit(per_page + 1)
+            .all()
+        )
+        return videos[:per_page], len(videos) > per_page
+
+hot_ranking = HotRanking()
+
+job_queue.periodic('refresh_hot_scores', app.config['HOT_SCORE_INTERVAL'])
+
+@job_queue.handler('refresh_hot_scores')
+def _refresh_hot_scores(payloads):
+    hot_ranking.refresh()
+
+@app.cli.command('rebuild-hot-scores')
+def rebuild_hot_scores_command():
+    """立即重算热门排行（首次上线或调整权重后使用）"""
+    print(f"已重算 {hot_ranking.refresh()} 个视频的热度")
+
+@app.route('/trending')
+def trending():
+    # 排行每个周期才变化一次，只开放前 HOT_MAX_PAGES 页
+    page = min(max(request.args.get('page', 1, type=int), 1), app.config['HOT_MAX_PAGES'])
+    videos, has_next = hot_ranking.page(page, app.config['HOT_PAGE_SIZE'])
+    feed_html = render_template('_feed_cards.html', videos=videos)
+    next_page = page + 1 if has_next and page < app.config['HOT_MAX_PAGES'] else None
+    return render_template('index.html', feed_html=feed_html, feed_tab='hot', next_page=next_page)
+
+# ----------- 用户地域汇总 -----------
+def _region_key(country_code, region_name):
+    return (country_code or '', region_name or '')
+
+def _region_stat_adjust(country_code, region_name, delta: int):
+    """在当前事务中调整某个 (国家, 省份) 的人数，不存在时插入"""
+    cc, rn = _region_key(country_code, region_name)
+    table = UserRegionStat.__table__
+    match = db.and_(table.c.country_code == cc, table.c.region_name == rn)
+    result = db.session.execute(table.update().where(match).values(count=table.c.count + delta))
+    if result.rowcount:
+        return
+    try:
+        with db.session.begin_nested():
+            db.session.execute(table.insert().values(country_code=cc, region_name=rn, count=delta))
+    except IntegrityError:
+        # 并发插入了同一行，改为累加
+        db.session.execute(table.update().where(match).values(count=table.c.count + delta))
+
+def _region_stat_move(old_key, new_key):
+    if old_key != new_key:
+        _region_stat_adjust(*old_key, -1)
+        _region_stat_adjust(*new_key, 1)
+
+def rebuild_region_stats():
+    """按 user 表重新汇总，用于修复计数漂移"""
+    rows = (
+        db.session.query(User.country_code, User.region_name, db.func.count(User.id))
+        .group_by(User.country_code, User.region_name)
+        .all()
+    )
+    totals = {}
+    for cc, rn, count in rows:
+        key = _region_key(cc, rn)
+        totals[key] = totals.get(key, 0) + int(count or 0)
+    UserRegionStat.query.delete()
+    db.session.add_all(UserRegionStat(country_code=cc, region_name=rn, count=n) for (cc, rn), n in totals.items())
+    get_site_settings().region_stats_built_at = datetime.utcnow()
+    db.session.commit()
+    return len(totals)
+
+_region_stats_checked = False
+
+def _ensure_region_stats():
+    # 上线后首次读取时从 user 表全量生成一次。不能以“汇总表为空”判断：
+    # 注册、地域补全等增量写入可能先于首次读取发生，只覆盖了部分用户
+    global _region_stats_checked
+    if _region_stats_checked:
+        return
+    if get_site_settings().region_stats_built_at is None:
+        rebuild_region_stats()
+    _region_stats_checked = True
+
+@app.cli.command('rebuild-region-stats')
+def rebuild_region_stats_command():
+    """重建用户地域分布汇总表"""
+    count = rebuild_region_stats()
+    print(f"地域汇总已重建：{count} 个区域")
 
 @app.route('/admin/analytics/user_regions')
 @login_required
 def analytics_user_regions():
     if not current_user.is_admin:
         return jsonify({'status': 'error', 'message': '权限不足'}), 403
-    # 统计每个国家的用户数量（忽略空）
+    # 统计每个国家的用户数量（忽略空），读取地域汇总表
+    _ensure_region_stats()
     results = (
-        db.session.query(User.country_code, db.func.count(User.id))
-        .filter(User.country_code.isnot(None))
-        .group_by(User.country_code)
+        db.session.query(UserRegionStat.country_code, db.func.sum(UserRegionStat.count))
+        .filter(UserRegionStat.country_code != '')
+        .group_by(UserRegionStat.country_code)
         .all()
     )
     data = [
@@ -659,23 +3220,47 @@ def analytics_user_regions():
             'count': int(count or 0),
         }
         for code, count in results
-        if code
+        if code and int(count or 0) > 0
     ]
     return jsonify({'status': 'success', 'data': data})
 
+def _keyset_cursor(created_at, row_id) -> str:
+    return f"{created_at.isoformat()}_{row_id}"
+
+def _parse_keyset_cursor(cursor: str):
+    try:
+        created_at, row_id = cursor.rsplit('_', 1)
+        return datetime.fromisoformat(created_at), int(row_id)
+    except (AttributeError, ValueError):
+        return None
+
+def _region_users_page(query):
+    """按 (created_at, id) 倒序做游标分页，返回 (本页用户, 总数, 下一页游标)"""
+    limit = min(max(request.args.get('limit', 50, type=int), 1), 200)
+    total = query.order_by(None).count()
+    cursor = _parse_keyset_cursor(request.args.get('cursor'))
+    if cursor:
+        created_at, row_id = cursor
+        query = query.filter(db.or_(
+            User.created_at < created_at,
+            db.and_(User.created_at == created_at, User.id < row_id),
+        ))
+    users = query.order_by(User.created_at.desc(), User.id.desc()).limit(limit + 1).all()
+    next_cursor = None
+    if len(users) > limit:
+        users = users[:limit]
+        next_cursor = _keyset_cursor(users[-1].created_at, users[-1].id)
+    return users, total, next_cursor
+
 @app.route('/admin/analytics/user_regions/<country_code>')
 @login_required
 def analytics_user_region_users(country_code: str):
     if not current_user.is_admin:
         return jsonify({'status': 'error', 'message': '权限不足'}), 403
     code = (country_code or '').upper()
-    users = User.query.filter(User.country_code == code).order_by(User.created_at.desc()).all()
+    users, total, next_cursor = _region_users_page(User.query.filter(User.country_code == code))
     users_json = []
     for u in users:
-        try:
-            followers_count = u.followers.count()
-        except Exception:
-            followers_count = 0
         users_json.append({
             'id': u.id,
             'username': u.username,
@@ -683,10 +3268,11 @@ def analytics_user_region_users(country_code: str):
             'created_at': u.created_at.strftime('%Y-%m-%d %H:%M') if u.created_at else None,
             'wanli_coins': u.wanli_coins,
             'received_likes': u.received_likes,
-            'followers': followers_count,
+            'followers': u.followers_count or 0,
             'region_name': u.region_name,
         })
-    return jsonify({'status': 'success', 'users': users_json, 'country_code': code})
+    return jsonify({'status': 'success', 'users': users_json, 'country_code': code,
+                    'total': total, 'next_cursor': next_cursor})
 
 # 中国省级分布与详情（用于中国地图）
 @app.route('/admin/analytics/user_regions_cn')
@@ -694,13 +3280,12 @@ def analytics_user_region_users(country_code: str):
 def analytics_user_regions_cn():
     if not current_user.is_admin:
         return jsonify({'status': 'error', 'message': '权限不足'}), 403
-    # 已知省份统计
+    # 已知省份统计（国家为中国或未知），读取地域汇总表
+    _ensure_region_stats()
     results = (
-        db.session.query(User.region_name, db.func.count(User.id))
-        .filter(User.region_name.isnot(None))
-        .filter(User.region_name != '')
-        .filter(db.or_(User.country_code == 'CN', User.country_code.is_(None)))
-        .group_by(User.region_name)
+        db.session.query(UserRegionStat.region_name, db.func.sum(UserRegionStat.count))
+        .filter(UserRegionStat.country_code.in_(['CN', '']))
+        .group_by(UserRegionStat.region_name)
         .all()
     )
     data = [
@@ -709,15 +3294,10 @@ def analytics_user_regions_cn():
             'count': int(count or 0),
         }
         for name, count in results
-        if name
+        if name and int(count or 0) > 0
     ]
     # 未填写省份的人数（视为“未知”）
-    unknown_count = (
-        db.session.query(db.func.count(User.id))
-        .filter(db.or_(User.country_code == 'CN', User.country_code.is_(None)))
-        .filter(db.or_(User.region_name.is_(None), User.region_name == ''))
-        .scalar()
-    )
+    unknown_count = sum(int(count or 0) for name, count in results if not name)
     if unknown_count and int(unknown_count) > 0:
         data.append({'region_name': '未知', 'count': int(unknown_count)})
     return jsonify({'status': 'success', 'data': data})
@@ -733,13 +3313,9 @@ def analytics_user_regions_cn_users(region_name: str):
         query = query.filter(db.or_(User.region_name.is_(None), User.region_name == ''))
     else:
         query = query.filter(User.region_name == name)
-    users = query.order_by(User.created_at.desc()).all()
+    users, total, next_cursor = _region_users_page(query)
     users_json = []
     for u in users:
-        try:
-            followers_count = u.followers.count()
-        except Exception:
-            followers_count = 0
         users_json.append({
             'id': u.id,
             'username': u.username,
@@ -747,11 +3323,12 @@ def analytics_user_regions_cn_users(region_name: str):
             'created_at': u.created_at.strftime('%Y-%m-%d %H:%M') if u.created_at else None,
             'wanli_coins': u.wanli_coins,
             'received_likes': u.received_likes,
-            'followers': followers_count,
+            'followers': u.followers_count or 0,
             'region_name': u.region_name,
             'register_ip': u.register_ip,
         })
-    return jsonify({'status': 'success', 'users': users_json, 'region_name': name})
+    return jsonify({'status': 'success', 'users': users_json, 'region_name': name,
+                    'total': total, 'next_cursor': next_cursor})
 
 @app.route('/admin/settings', methods=['GET', 'POST'])
 @login_required
@@ -777,6 +3354,7 @@ def admin_settings():
         if color2:
             settings.homepage_bg_color2 = color2
         db.session.commit()
+        site_settings_cache.bump()
         flash('站点设置已保存')
         return redirect(url_for('admin_settings'))
 
@@ -788,24 +3366,13 @@ def admin_settings_upload_bg():
     if not current_user.is_admin:
         return jsonify({'status': 'error', 'message': '权限不足'}), 403
     settings = get_site_settings()
-    if 'bg' not in request.files:
-        return jsonify({'status': 'error', 'message': '未选择文件'}), 400
-    file = request.files['bg']
-    if file.filename == '':
-        return jsonify({'status': 'error', 'message': '未选择文件'}), 400
-    allowed = {'png', 'jpg', 'jpeg', 'gif', 'webp'}
-    if '.' not in file.filename or file.filename.rsplit('.', 1)[1].lower() not in allowed:
-        return jsonify({'status': 'error', 'message': '仅支持 png/jpg/jpeg/gif/webp'}), 400
-    # 限制大小 5MB
-    file.seek(0, 2); size = file.tell(); file.seek(0)
-    if size > 5 * 1024 * 1024:
-        return jsonify({'status': 'error', 'message': '文件不能超过5MB'}), 400
-    filename = secure_filename(file.filename)
-    unique = f"{uuid.uuid4()}_{filename}"
-    path = os.path.join(app.config['SITE_ASSET_FOLDER'], unique)
-    file.save(path)
+    try:
+        unique = site_asset_store.save(request.files.get('bg'))
+    except AssetError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
     settings.homepage_bg_image = unique
     db.session.commit()
+    site_settings_cache.bump()
     return jsonify({'status': 'success', 'filename': unique})
 
 @app.route('/admin/settings/reset_bg', methods=['POST'])
@@ -816,8 +3383,18 @@ def admin_settings_reset_bg():
     settings = get_site_settings()
     settings.homepage_bg_image = None
     db.session.commit()
+    site_settings_cache.bump()
     return jsonify({'status': 'success'})
 
+def _delete_video_record(video: 'Video'):
+    """在调用方事务内删除视频及引用它的行（评论、弹幕、三连记录、动态收件箱），并扣减作者统计"""
+    creator_stats.on_delete(video)
+    timeline.remove_video(video.id)
+    Comment.query.filter(Comment.video_id == video.id).delete(synchronize_session=False)
+    Danmaku.query.filter(Danmaku.video_id == video.id).delete(synchronize_session=False)
+    db.session.execute(video_triple_likes.delete().where(video_triple_likes.c.video_id == video.id))
+    db.session.delete(video)
+
 @app.route('/admin/delete_video/<int:video_id>', methods=['POST'])
 @login_required
 def delete_video(video_id):
@@ -825,8 +3402,11 @@ def delete_video(video_id):
         return jsonify({'status': 'error', 'message': '权限不足'})
     
     video = Video.query.get_or_404(video_id)
-    db.session.delete(video)
+    _delete_video_record(video)
     db.session.commit()
+    home_feed.invalidate()
+    search_index.remove(video_id)
+    _danmaku_cache.invalidate(video_id)
     
     return jsonify({'status': 'success'})
 
@@ -840,19 +3420,28 @@ def review_video(video_id):
     action = request.form.get('action')  # approve 或 reject
     comment = request.form.get('comment', '')
     
+    old_status = video.status
     if action == 'approve':
         video.status = 'approved'
         video.review_comment = comment
         video.reviewed_by = current_user.id
         video.reviewed_at = datetime.utcnow()
+        creator_stats.on_status_change(video, old_status)
         db.session.commit()
+        home_feed.invalidate()
+        search_index.update(video)
+        timeline.on_approved(video)
         return jsonify({'status': 'success', 'message': '视频审核通过'})
     elif action == 'reject':
         video.status = 'rejected'
         video.review_comment = comment
         video.reviewed_by = current_user.id
         video.reviewed_at = datetime.utcnow()
+        creator_stats.on_status_change(video, old_status)
+        timeline.remove_video(video.id)
         db.session.commit()
+        home_feed.invalidate()
+        search_index.update(video)
         return jsonify({'status': 'success', 'message': '视频审核拒绝'})
     else:
         return jsonify({'status': 'error', 'message': '无效的操作'})
@@ -924,29 +3513,39 @@ def delete_user(user_id):
 @app.route('/profile')
 @login_required
 def profile():
-    # 获取用户的所有视频，按状态分组
-    pending_videos = Video.query.filter_by(user_id=current_user.id, status='pending').all()
-    approved_videos = Video.query.filter_by(user_id=current_user.id, status='approved').all()
-    rejected_videos = Video.query.filter_by(user_id=current_user.id, status='rejected').all()
-    
-    return render_template('profile.html', 
-                         pending_videos=pending_videos,
-                         approved_videos=approved_videos,
-                         rejected_videos=rejected_videos)
+    # 统计数字直接取 user 行；视频列表只查当前状态的一页
+    status = request.args.get('status')
+    if status not in VIDEO_STATUSES:
+        status = 'approved'
+    videos, next_cursor = creator_stats.videos_page(
+        current_user.id, status, request.args.get('cursor'), app.config['PROFILE_PAGE_SIZE'])
+    return render_template('profile.html',
+                         stats=creator_stats.get(current_user),
+                         status_counts=creator_stats.status_counts(current_user.id),
+                         status=status,
+                         videos=videos,
+                         next_cursor=next_cursor,
+                         following_count=current_user.following_count or 0,
+                         followers_count=current_user.followers_count or 0)
 
 @app.route('/following')
 @login_required
 def following():
     """关注列表页面"""
-    following_users = current_user.following.all()
-    return render_template('following.html', following_users=following_users)
+    following_users, next_cursor = follow_graph.following_page(
+        current_user.id, request.args.get('cursor', type=int), app.config['FOLLOW_PAGE_SIZE'])
+    return render_template('following.html', following_users=following_users, next_cursor=next_cursor)
 
 @app.route('/followers')
 @login_required
 def followers():
     """粉丝列表页面"""
-    followers_users = current_user.followers.all()
-    return render_template('followers.html', followers_users=followers_users)
+    followers_users, next_cursor = follow_graph.followers_page(
+        current_user.id, request.args.get('cursor', type=int), app.config['FOLLOW_PAGE_SIZE'])
+    # 一次查出当前用户回关了其中哪些人
+    followed_back = follow_graph.following_among(current_user.id, [u.id for u in followers_users])
+    return render_template('followers.html', followers_users=followers_users,
+                           followed_back=followed_back, next_cursor=next_cursor)
 
 @app.route('/edit_profile', methods=['GET', 'POST'])
 @login_required
@@ -972,31 +3571,17 @@ def edit_profile():
         current_user.username = username
         current_user.email = email
         
-        # 处理头像上传
-        if 'avatar' in request.files:
-            avatar_file = request.files['avatar']
-            if avatar_file.filename != '':
-                # 检查文件类型
-                allowed_extensions = {'png', 'jpg', 'jpeg', 'gif'}
-                if '.' in avatar_file.filename and avatar_file.filename.rsplit('.', 1)[1].lower() in allowed_extensions:
-                    # 检查文件大小（最大5MB）
-                    avatar_file.seek(0, 2)
-                    file_size = avatar_file.tell()
-                    avatar_file.seek(0)
-                    
-                    if file_size > 5 * 1024 * 1024:  # 5MB
-                        flash('头像文件不能超过5MB')
-                        return render_template('edit_profile.html')
-                    
-                    # 生成唯一文件名
-                    filename = secure_filename(avatar_file.filename)
-                    unique_filename = f"{uuid.uuid4()}_{filename}"
-                    file_path = os.path.join(app.config['AVATAR_FOLDER'], unique_filename)
-                    
-                    avatar_file.save(file_path)
-                    current_user.avatar = unique_filename
+        # 处理头像上传（未选择文件时保持原头像）
+        avatar_file = request.files.get('avatar')
+        if avatar_file and avatar_file.filename != '':
+            try:
+                current_user.avatar = avatar_store.save(avatar_file)
+            except AssetError as e:
+                flash(str(e))
+                return render_template('edit_profile.html')
         
         db.session.commit()
+        home_feed.invalidate()
         flash('个人资料更新成功！')
         return redirect(url_for('profile'))
     
@@ -1006,36 +3591,15 @@ def edit_profile():
 @login_required
 def upload_avatar():
     try:
-        if 'avatar' not in request.files:
-            return jsonify({'status': 'error', 'message': '没有选择文件'})
-        
-        file = request.files['avatar']
-        if file.filename == '':
-            return jsonify({'status': 'error', 'message': '没有选择文件'})
-        
-        # 检查文件类型
-        allowed_extensions = {'png', 'jpg', 'jpeg', 'gif'}
-        if '.' not in file.filename or file.filename.rsplit('.', 1)[1].lower() not in allowed_extensions:
-            return jsonify({'status': 'error', 'message': '只支持 PNG, JPG, JPEG, GIF 格式'})
-        
-        # 检查文件大小（最大5MB）
-        file.seek(0, 2)
-        file_size = file.tell()
-        file.seek(0)
-        
-        if file_size > 5 * 1024 * 1024:  # 5MB
-            return jsonify({'status': 'error', 'message': '头像文件不能超过5MB'})
-        
-        # 生成唯一文件名
-        filename = secure_filename(file.filename)
-        unique_filename = f"{uuid.uuid4()}_{filename}"
-        file_path = os.path.join(app.config['AVATAR_FOLDER'], unique_filename)
-        
-        file.save(file_path)
+        try:
+            unique_filename = avatar_store.save(request.files.get('avatar'))
+        except AssetError as e:
+            return jsonify({'status': 'error', 'message': str(e)})
         
         # 更新用户头像
         current_user.avatar = unique_filename
         db.session.commit()
+        home_feed.invalidate()
         
         return jsonify({'status': 'success', 'message': '头像上传成功', 'filename': unique_filename})
         
@@ -1080,9 +3644,14 @@ def upload_thumbnail():
         
         file.save(file_path)
         
-        # 更新视频封面
+        # 更新视频封面，旧封面的缩放图随之作废
+        if video.thumbnail:
+            shutil.rmtree(_thumbnail_variant_dir(video.thumbnail), ignore_errors=True)
         video.thumbnail = unique_filename
+        video.thumbnail_widths = None
         db.session.commit()
+        home_feed.invalidate()
+        _enqueue_image_jobs(video)
         
         return jsonify({'status': 'success', 'message': '封面更新成功', 'filename': unique_filename})
         
@@ -1099,25 +3668,38 @@ def user_delete_video(video_id):
         if video.user_id != current_user.id and not current_user.is_admin:
             return jsonify({'status': 'error', 'message': '权限不足'})
         
+        filename, thumbnail = video.filename, video.thumbnail
+
+        # 先删除数据库记录，提交成功后再删文件，避免记录还在而文件已丢
+        _delete_video_record(video)
+        db.session.commit()
+        home_feed.invalidate()
+        search_index.remove(video_id)
+        _danmaku_cache.invalidate(video_id)
+
         # 删除视频文件
-        if video.filename:
-            video_path = os.path.join(app.config['UPLOAD_FOLDER'], video.filename)
+        if filename:
+            video_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
             if os.path.exists(video_path):
                 os.remove(video_path)
         
         # 删除封面文件
-        if video.thumbnail:
-            thumbnail_path = os.path.join(app.config['THUMBNAIL_FOLDER'], video.thumbnail)
+        if thumbnail:
+            thumbnail_path = os.path.join(app.config['THUMBNAIL_FOLDER'], thumbnail)
             if os.path.exists(thumbnail_path):
                 os.remove(thumbnail_path)
+            shutil.rmtree(_thumbnail_variant_dir(thumbnail), ignore_errors=True)
+        sprite_path = os.path.join(app.config['THUMBNAIL_FOLDER'], 'sprites', f'{video_id}.jpg')
+        if os.path.exists(sprite_path):
+            os.remove(sprite_path)
         
-        # 删除数据库记录
-        db.session.delete(video)
-        db.session.commit()
+        # 删除转码输出
+        shutil.rmtree(_hls_dir(video_id), ignore_errors=True)
         
         return jsonify({'status': 'success', 'message': '视频删除成功'})
         
     except Exception as e:
+        db.session.rollback()
         return jsonify({'status': 'error', 'message': f'删除失败：{str(e)}'})
 
 @app.route('/change_admin_password', methods=['GET', 'POST'])
@@ -1158,14 +3740,279 @@ def change_admin_password():
     
     return render_template('change_admin_password.html')
 
+# ----------- 全文搜索 -----------
+_CJK_RE = re.compile(r'[\u3400-\u9fff\uf900-\ufaff]+')
+_WORD_RE = re.compile(r'[0-9a-z]+')
+
+def _search_tokens(text: str, query: bool = False):
+    """分词：英文/数字按单词，中文连续片段切成二元组。
+
+    建索引时每个汉字另存一个单字，单字查询（如“猫”）也能命中“小猫咪”；
+    查询时只有单字片段才用单字，多字片段仍用二元组。
+    """
+    text = (text or '').lower()
+    tokens = _WORD_RE.findall(text)
+    for run in _CJK_RE.findall(text):
+        if len(run) == 1:
+            tokens.append(run)
+            continue
+        if not query:
+            tokens.extend(run)
+        tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return tokens
+
+class PythonSearchIndex:
+    """纯 Python 倒排索引（开发环境兜底）：token -> {video_id: 词频}，标题权重加倍。
+
+    每个 worker 各持一份；其他 worker 更新后通过版本号发现并整体重建。
+    """
+
+    name = 'python'
+    TITLE_WEIGHT = 2
+
+    def __init__(self):
+        self.version = VersionStamp('search_index')
+        self._lock = threading.Lock()
+        self._postings = {}  # token -> {video_id: weight}
+        self._docs = {}      # video_id -> set(token)
+        self._built_version = None
+
+    def update(self, video: 'Video'):
+        self._ensure_built()
+        with self._lock:
+            self._remove_locked(video.id)
+            if video.status == 'approved':
+                self._add_locked(video)
+            self._built_version = self.version.bump()
+
+    def remove(self, video_id: int):
+        self._ensure_built()
+        with self._lock:
+            self._remove_locked(video_id)
+            self._built_version = self.version.bump()
+
+    def rebuild(self):
+        videos = Video.query.filter_by(status='approved').all()
+        with self._lock:
+            self._postings, self._docs = {}, {}
+            for video in videos:
+                self._add_locked(video)
+            self._built_version = self.version.current()
+
+    def search(self, query: str, page: int, per_page: int):
+        tokens = set(_search_tokens(query, query=True))
+        if not tokens:
+            return [], 0
+        self._ensure_built()
+        with self._lock:
+            postings = [self._postings.get(t, {}) for t in tokens]
+            if not all(postings):
+                return [], 0
+            # 所有词都命中才算匹配，按 tf-idf 排序
+            ids = set.intersection(*(set(p) for p in postings))
+            total_docs = max(len(self._docs), 1)
+            scores = {}
+            for p in postings:
+                idf = 1.0 + math.log(total_docs / len(p))
+                for vid in ids:
+                    scores[vid] = scores.get(vid, 0.0) + p[vid] * idf
+        ranked = sorted(ids, key=lambda vid: (-scores[vid], -vid))
+        start = (page - 1) * per_page
+        return ranked[start:start + per_page], len(ranked)
+
+    def _ensure_built(self):
+        if self._built_version != self.version.current():
+            self.rebuild()
+
+    def _add_locked(self, video):
+        weights = {}
+        for token in _search_tokens(video.title):
+            weights[token] = weights.get(token, 0) + self.TITLE_WEIGHT
+        for token in _search_tokens(video.description):
+            weights[token] = weights.get(token, 0) + 1
+        for token, weight in weights.items():
+            self._postings.setdefault(token, {})[video.id] = weight
+        self._docs[video.id] = set(weights)
+
+    def _remove_locked(self, video_id):
+        for token in self._docs.pop(video_id, ()):
+            posting = self._postings.get(token)
+            if posting:
+                posting.pop(video_id, None)
+                if not posting:
+                    del self._postings[token]
+
+class SqliteFtsSearchIndex:
+    """SQLite FTS5：索引中存放预先切好的单字与二元组，bm25 排序"""
+
+    name = 'fts5'
+    TABLE = 'video_fts_v2'  # 分词方式变化时换表名，启动时丢弃旧表并重建
+    LEGACY_TABLES = ('video_fts',)
+
+    def __init__(self):
+        with db.engine.begin() as conn:
+            for legacy in self.LEGACY_TABLES:
+                conn.exec_driver_sql(f"DROP TABLE IF EXISTS {legacy}")
+            existed = conn.exec_driver_sql(
+                "SELECT 1 FROM sqlite_master WHERE name = ?", (self.TABLE,)).first() is not None
+            conn.exec_driver_sql(
+                f"CREATE VIRTUAL TABLE IF NOT EXISTS {self.TABLE} USING fts5(title, description)")
+        if not existed:
+            self.rebuild()
+
+    def update(self, video: 'Video'):
+        with db.engine.begin() as conn:
+            conn.exec_driver_sql(f"DELETE FROM {self.TABLE} WHERE rowid = ?", (video.id,))
+            if video.status == 'approved':
+                conn.exec_driver_sql(
+                    f"INSERT INTO {self.TABLE} (rowid, title, description) VALUES (?, ?, ?)",
+                    (video.id, ' '.join(_search_tokens(video.title)),
+                     ' '.join(_search_tokens(video.description))))
+
+    def remove(self, video_id: int):
+        with db.engine.begin() as conn:
+            conn.exec_driver_sql(f"DELETE FROM {self.TABLE} WHERE rowid = ?", (video_id,))
+
+    def rebuild(self):
+        rows = [
+            (v.id, ' '.join(_search_tokens(v.title)), ' '.join(_search_tokens(v.description)))
+            for v in Video.query.filter_by(status='approved').all()
+        ]
+        with db.engine.begin() as conn:
+            conn.exec_driver_sql(f"DELETE FROM {self.TABLE}")
+            if rows:
+                conn.exec_driver_sql(
+                    f"INSERT INTO {self.TABLE} (rowid, title, description) VALUES (?, ?, ?)", rows)
+
+    def search(self, query: str, page: int, per_page: int):
+        tokens = sorted(set(_search_tokens(query, query=True)))
+        if not tokens:
+            return [], 0
+        match = ' AND '.join(f'"{t}"' for t in tokens)
+        with db.engine.connect() as conn:
+            fts = self.TABLE
+            total = conn.exec_driver_sql(
+                f"SELECT COUNT(*) FROM {fts} JOIN video ON video.id = {fts}.rowid "
+                f"WHERE {fts} MATCH ? AND video.status = 'approved'", (match,)).scalar()
+            ids = [row[0] for row in conn.exec_driver_sql(
+                f"SELECT {fts}.rowid FROM {fts} JOIN video ON video.id = {fts}.rowid "
+                f"WHERE {fts} MATCH ? AND video.status = 'approved' "
+                f"ORDER BY bm25({fts}, 2.0, 1.0), {fts}.rowid DESC LIMIT ? OFFSET ?",
+                (match, per_page, (page - 1) * per_page))]
+        return ids, int(total or 0)
+
+class MysqlFulltextSearchIndex:
+    """MySQL FULLTEXT（ngram 解析器，自动处理中文）；索引随 video 表自动维护"""
+
+    name = 'mysql'
+
+    def __init__(self):
+        with db.engine.begin() as conn:
+            exists = conn.exec_driver_sql(
+                "SELECT COUNT(*) FROM information_schema.statistics WHERE table_schema = DATABASE() "
+                "AND table_name = 'video' AND index_name = 'ft_video_title_description'").scalar()
+            if not exists:
+                conn.exec_driver_sql(
+                    "ALTER TABLE video ADD FULLTEXT INDEX ft_video_title_description "
+                    "(title, description) WITH PARSER ngram")
+
+    def update(self, video: 'Video'):
+        pass
+
+    def remove(self, video_id: int):
+        pass
+
+    def rebuild(self):
+        with db.engine.begin() as conn:
+            conn.exec_driver_sql("OPTIMIZE TABLE video")
+
+    def search(self, query: str, page: int, per_page: int):
+        words = [w for w in re.split(r'[\s+\-<>()~*"@]+', query) if w]
+        if not words:
+            return [], 0
+        # ngram 默认按两个字切分，单字查询需用前缀通配才能命中
+        match = ' '.join(f'+{w}*' if len(w) == 1 else f'+{w}' for w in words)
+        relevance = db.text("MATCH (video.title, video.description) AGAINST (:q IN BOOLEAN MODE)")
+        base = (
+            db.session.query(Video.id)
+            .filter(Video.status == 'approved')
+            .filter(relevance)
+            .params(q=match)
+        )
+        total = base.count()
+        ids = [row[0] for row in base.order_by(db.desc(relevance), Video.id.desc())
+               .limit(per_page).offset((page - 1) * per_page).all()]
+        return ids, total
+
+class SearchService:
+    """按配置选择搜索后端；索引维护失败不影响主流程"""
+
+    def __init__(self):
+        self._backend = None
+        self._lock = threading.Lock()
+
+    @property
+    def backend(self):
+        if self._backend is None:
+            with self._lock:
+                if self._backend is None:
+                    self._backend = self._create_backend()
+        return self._backend
+
+    def _create_backend(self):
+        choice = app.config['SEARCH_BACKEND']
+        dialect = db.engine.dialect.name
+        if choice == 'auto':
+            choice = {'mysql': 'mysql', 'sqlite': 'fts5'}.get(dialect, 'python')
+        try:
+            if choice == 'mysql':
+                return MysqlFulltextSearchIndex()
+            if choice == 'fts5':
+                return SqliteFtsSearchIndex()
+        except Exception as e:
+            print(f"搜索后端 {choice} 不可用，使用 Python 倒排索引: {e}")
+        return PythonSearchIndex()
+
+    def update(self, video: 'Video'):
+        try:
+            self.backend.update(video)
+        except Exception as e:
+            print(f"搜索索引更新失败: {e}")
+
+    def remove(self, video_id: int):
+        try:
+            self.backend.remove(video_id)
+        except Exception as e:
+            print(f"搜索索引删除失败: {e}")
+
+    def search(self, query: str, page: int = 1, per_page: int = 20):
+        """返回 (按相关度排序的 Video 列表, 总数)"""
+        ids, total = self.backend.search(query, page, per_page)
+        if not ids:
+            return [], total
+        videos = {v.id: v for v in Video.query.options(joinedload(Video.author)).filter(Video.id.in_(ids)).all()}
+        return [videos[i] for i in ids if i in videos], total
+
+search_index = SearchService()
+
+@app.cli.command('rebuild-search-index')
+def rebuild_search_index_command():
+    """重建视频全文搜索索引"""
+    search_index.backend.rebuild()
+    print(f"搜索索引已重建（后端：{search_index.backend.name}）")
+
 @app.route('/search')
 def search():
-    query = request.args.get('q', '')
+    query = request.args.get('q', '').strip()
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = app.config['SEARCH_PER_PAGE']
     if query:
-        videos = Video.query.filter(Video.title.contains(query)).all()
+        videos, total = search_index.search(query, page, per_page)
     else:
-        videos = []
-    return render_template('search.html', videos=videos, query=query)
+        videos, total = [], 0
+    pages = (total + per_page - 1) // per_page
+    return render_template('search.html', videos=videos, query=query,
+                           page=page, pages=pages, total=total)
 
 @app.errorhandler(413)
 def too_large(e):
@@ -1186,9 +4033,52 @@ if __name__ == '__main__':
                     conn.execute(text("ALTER TABLE user ADD COLUMN region_name VARCHAR(100)"))
                 if 'register_ip' not in cols:
                     conn.execute(text("ALTER TABLE user ADD COLUMN register_ip VARCHAR(64)"))
+                conn.execute(text("CREATE INDEX IF NOT EXISTS ix_danmaku_video_time ON danmaku (video_id, time)"))
+                setting_cols = {row[1] for row in conn.exec_driver_sql("PRAGMA table_info('site_setting')")}
+                if 'region_stats_built_at' not in setting_cols:
+                    conn.execute(text("ALTER TABLE site_setting ADD COLUMN region_stats_built_at DATETIME"))
+                video_cols = {row[1] for row in conn.exec_driver_sql("PRAGMA table_info('video')")}
+                if 'processing_status' not in video_cols:
+                    conn.execute(text("ALTER TABLE video ADD COLUMN processing_status VARCHAR(20) DEFAULT 'none'"))
+                if 'hls_master' not in video_cols:
+                    conn.execute(text("ALTER TABLE video ADD COLUMN hls_master VARCHAR(200)"))
+                if 'thumbnail_widths' not in video_cols:
+                    conn.execute(text("ALTER TABLE video ADD COLUMN thumbnail_widths VARCHAR(50)"))
+                if 'preview_sprite' not in video_cols:
+                    conn.execute(text("ALTER TABLE video ADD COLUMN preview_sprite TEXT"))
+                if 'comment_count' not in video_cols:
+                    conn.execute(text("ALTER TABLE video ADD COLUMN comment_count INTEGER DEFAULT 0"))
+                    conn.execute(text(
+                        "UPDATE video SET comment_count = "
+                        "(SELECT COUNT(*) FROM comment WHERE comment.video_id = video.id)"))
+                conn.execute(text("CREATE INDEX IF NOT EXISTS ix_comment_video_created ON comment (video_id, created_at, id)"))
+                conn.execute(text("CREATE INDEX IF NOT EXISTS ix_follows_followed ON follows (followed_id, follower_id)"))
+                conn.execute(text("CREATE INDEX IF NOT EXISTS ix_video_author_status_reviewed ON video (user_id, status, reviewed_at)"))
+                if 'hot_score' not in video_cols:
+                    conn.execute(text("ALTER TABLE video ADD COLUMN hot_score FLOAT DEFAULT 0"))
+                conn.execute(text("CREATE INDEX IF NOT EXISTS ix_video_status_hot ON video (status, hot_score, id)"))
+                conn.execute(text("CREATE INDEX IF NOT EXISTS ix_video_author_status_created ON video (user_id, status, created_at, id)"))
+                if 'video_count' not in cols:
+                    conn.execute(text("ALTER TABLE user ADD COLUMN video_count INTEGER DEFAULT 0"))
+                    conn.execute(text("ALTER TABLE user ADD COLUMN total_views INTEGER DEFAULT 0"))
+                    conn.execute(text(
+                        "UPDATE user SET "
+                        "video_count = (SELECT COUNT(*) FROM video WHERE video.user_id = user.id AND video.status = 'approved'), "
+                        "total_views = (SELECT COALESCE(SUM(views), 0) FROM video WHERE video.user_id = user.id)"))
+                if 'followers_count' not in cols:
+                    conn.execute(text("ALTER TABLE user ADD COLUMN followers_count INTEGER DEFAULT 0"))
+                    conn.execute(text("ALTER TABLE user ADD COLUMN following_count INTEGER DEFAULT 0"))
+                    conn.execute(text(
+                        "UPDATE user SET "
+                        "followers_count = (SELECT COUNT(*) FROM follows WHERE follows.followed_id = user.id), "
+                        "following_count = (SELECT COUNT(*) FROM follows WHERE follows.follower_id = user.id)"))
         except Exception as _e:
             # 避免因少数环境不兼容而阻断启动（开发环境可忽略）
             pass
+        try:
+            migrate_triple_users()
+        except Exception as _e:
+            print(f"三连数据迁移失败: {_e}")
         # 创建默认管理员账户
         if not User.query.filter_by(username='admin').first():
             admin = User(
@@ -1199,6 +4089,7 @@ if __name__ == '__main__':
                 password_changed=False  # 首次登录需要修改密码
             )
             db.session.add(admin)
+            _region_stat_adjust(None, None, 1)
             db.session.commit()
     # 允许通过环境变量配置运行参数，避免端口被占用
     debug_env = os.getenv('FLASK_DEBUG', os.getenv('DEBUG', '1')).lower() in ('1', 'true', 'yes', 'on')
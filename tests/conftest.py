@@ -0,0 +1,49 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# main.py 在导入时读取配置并建目录，必须先把数据库、instance 和上传目录指到临时位置
+_TMP = tempfile.mkdtemp(prefix='wanli-test-')
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(_TMP, 'test.db')
+os.environ['FLASK_INSTANCE_PATH'] = os.path.join(_TMP, 'instance')
+os.environ['JOB_WORKER_THREADS'] = '0'
+os.environ['QUERY_COUNT_HEADER'] = '1'
+os.environ['FEED_CACHE_TTL'] = '3600'  # 避免首页缓存在两次测量之间过期
+os.chdir(_TMP)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+from werkzeug.security import generate_password_hash  # noqa: E402
+
+
+@pytest.fixture()
+def app():
+    main.app.config['TESTING'] = True
+    with main.app.app_context():
+        main.db.drop_all()
+        main.db.create_all()
+    yield main.app
+
+
+@pytest.fixture()
+def make_user(app):
+    def make_user(username, is_admin=False):
+        with app.app_context():
+            user = main.User(username=username, email=f'{username}@example.com',
+                             password_hash=generate_password_hash('pw'),
+                             is_admin=is_admin, password_changed=True)
+            main.db.session.add(user)
+            main.db.session.commit()
+            return user.id
+    return make_user
+
+
+@pytest.fixture()
+def login(app):
+    def login(username):
+        client = app.test_client()
+        client.post('/login', data={'username': username, 'password': 'pw'})
+        return client
+    return login
@@ -0,0 +1,107 @@
+"""分片上传：断点续传与重复分片不能破坏已确认的数据"""
+import fcntl
+import hashlib
+import os
+import threading
+import time
+
+import main
+
+CHUNK = 64 * 1024
+
+
+def source_bytes(size=3 * CHUNK + 123):
+    return bytes((i * 7 + i // 251) % 256 for i in range(size))
+
+
+def start(client, data):
+    r = client.post('/upload/chunked/init', data={'filename': 'clip.mp4', 'size': len(data)})
+    assert r.status_code == 200
+    return r.get_json()['upload_id']
+
+
+def put(client, upload_id, data, offset, sha=None):
+    headers = {'X-Chunk-Sha256': sha} if sha else {}
+    return client.put(f'/upload/chunked/{upload_id}?offset={offset}', data=data, headers=headers)
+
+
+def complete(app, client, upload_id):
+    r = client.post(f'/upload/chunked/{upload_id}/complete', data={'title': 'clip'})
+    assert r.status_code == 200, r.get_json()
+    with app.app_context():
+        video = main.Video.query.order_by(main.Video.id.desc()).first()
+        with open(os.path.join(app.config['UPLOAD_FOLDER'], video.filename), 'rb') as f:
+            return f.read()
+
+
+def test_duplicate_put_at_committed_offset_is_rejected(app, make_user, login):
+    make_user('uploader')
+    client = login('uploader')
+    data = source_bytes()
+    upload_id = start(client, data)
+
+    assert put(client, upload_id, data[:CHUNK], 0).status_code == 200
+    # 客户端没收到响应而重试同一个分片，以及重试时数据损坏
+    assert put(client, upload_id, data[:CHUNK], 0).status_code == 409
+    assert put(client, upload_id, b'x' * CHUNK, 0, sha='0' * 64).status_code == 409
+    assert client.get(f'/upload/chunked/{upload_id}').get_json()['received'] == CHUNK
+
+    for offset in range(CHUNK, len(data), CHUNK):
+        chunk = data[offset:offset + CHUNK]
+        assert put(client, upload_id, chunk, offset, sha=hashlib.sha256(chunk).hexdigest()).status_code == 200
+    assert complete(app, client, upload_id) == data
+
+
+def test_retry_waiting_on_lock_does_not_truncate_committed_chunk(app, make_user, login):
+    make_user('uploader')
+    client = login('uploader')
+    data = source_bytes()
+    upload_id = start(client, data)
+    statuses = []
+
+    def retry():
+        # 重试请求的分片在传输中损坏，校验失败
+        statuses.append(put(login('uploader'), upload_id, b'x' * CHUNK, 0, sha='0' * 64).status_code)
+
+    # 模拟第一个请求持有文件锁：重试在此期间通过偏移预检并在锁上等待，
+    # 第一个请求写完分片并提交 received 后才放锁
+    with open(main._upload_part_path(upload_id), 'r+b') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        thread = threading.Thread(target=retry)
+        thread.start()
+        time.sleep(0.5)
+        f.write(data[:CHUNK])
+        f.flush()
+        with app.app_context():
+            main.UploadSession.query.filter_by(id=upload_id).update({'received': CHUNK})
+            main.db.session.commit()
+        fcntl.flock(f, fcntl.LOCK_UN)
+    thread.join()
+
+    assert statuses == [409]
+    assert os.path.getsize(main._upload_part_path(upload_id)) == CHUNK
+    for offset in range(CHUNK, len(data), CHUNK):
+        assert put(client, upload_id, data[offset:offset + CHUNK], offset).status_code == 200
+    assert complete(app, client, upload_id) == data
+
+
+def test_resume_after_disconnect_mid_chunk(app, make_user, login):
+    make_user('uploader')
+    client = login('uploader')
+    data = source_bytes()
+    upload_id = start(client, data)
+    assert put(client, upload_id, data[:CHUNK], 0).status_code == 200
+
+    # 连接在分片中途断开：声明的长度比实际收到的多
+    r = client.put(f'/upload/chunked/{upload_id}?offset={CHUNK}', data=data[CHUNK:CHUNK + 1000],
+                   environ_overrides={'CONTENT_LENGTH': str(CHUNK)})
+    assert r.status_code == 400
+    assert r.get_json()['received'] == CHUNK
+    assert os.path.getsize(main._upload_part_path(upload_id)) == CHUNK
+
+    # 客户端查询进度后从已确认的位置继续
+    offset = client.get(f'/upload/chunked/{upload_id}').get_json()['received']
+    assert offset == CHUNK
+    for offset in range(offset, len(data), CHUNK):
+        assert put(client, upload_id, data[offset:offset + CHUNK], offset).status_code == 200
+    assert complete(app, client, upload_id) == data
@@ -0,0 +1,63 @@
+"""万里币：余额不足不扣款，并发投币不超扣"""
+import threading
+
+import main
+
+
+def balances(app, *user_ids):
+    with app.app_context():
+        return [main.db.session.get(main.User, user_id).wanli_coins for user_id in user_ids]
+
+
+def run_all(threads):
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(timeout=30)
+    assert not any(t.is_alive() for t in threads)
+
+
+def test_overdraft_is_rejected(app, make_user, login):
+    sender, receiver = make_user('sender'), make_user('receiver')
+    client = login('sender')  # 登录会发放每日奖励
+    coins, received = balances(app, sender, receiver)
+    r = client.post(f'/coin_user/{receiver}', data={'amount': coins + 1})
+    assert r.get_json() == {'status': 'error', 'message': f'万里币不足！您只有{coins}个万里币'}
+    assert balances(app, sender, receiver) == [coins, received]
+    r = client.post(f'/coin_user/{receiver}', data={'amount': coins})
+    assert r.get_json()['my_coins'] == 0
+    assert balances(app, sender, receiver) == [0, received + coins]
+    with app.app_context():
+        assert main.CoinTransaction.query.filter_by(kind='transfer').count() == 1
+
+
+def test_concurrent_transfers_never_overdraw(app, make_user, login):
+    sender, receiver = make_user('sender'), make_user('receiver')
+    clients = [login('sender') for _ in range(8)]
+    coins, received = balances(app, sender, receiver)
+    results = []
+
+    def send(client):
+        for _ in range(3):
+            results.append(client.post(f'/coin_user/{receiver}', data={'amount': 1}).get_json()['status'])
+
+    assert len(clients) * 3 > coins
+    run_all([threading.Thread(target=send, args=(c,)) for c in clients])
+
+    assert results.count('success') == coins
+    assert balances(app, sender, receiver) == [0, received + coins]
+    with app.app_context():
+        assert main.CoinTransaction.query.filter_by(kind='transfer').count() == coins
+
+
+def test_mutual_transfers_do_not_deadlock(app, make_user, login):
+    a, b = make_user('a'), make_user('b')
+    pairs = [(login('a'), b), (login('b'), a)] * 3
+    total = sum(balances(app, a, b))
+
+    def send(client, target):
+        for _ in range(3):
+            client.post(f'/coin_user/{target}', data={'amount': 1})
+
+    run_all([threading.Thread(target=send, args=pair) for pair in pairs])
+    assert sum(balances(app, a, b)) == total
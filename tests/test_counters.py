@@ -0,0 +1,41 @@
+"""缓冲计数：批次重放幂等"""
+import pytest
+
+import main
+
+
+@pytest.fixture()
+def video_id(app, make_user):
+    author_id = make_user('author')
+    with app.app_context():
+        video = main.Video(title='v', filename='v.mp4', user_id=author_id, status='approved', views=5)
+        main.db.session.add(video)
+        main.db.session.commit()
+        return video.id
+
+
+def totals(app, video_id):
+    with app.app_context():
+        video = main.db.session.get(main.Video, video_id)
+        return video.views, video.author.total_views or 0
+
+
+def test_replayed_batch_is_applied_once(app, video_id, tmp_path):
+    counter = main.BufferedCounter('test_views', main.Video.__table__, 'views', str(tmp_path),
+                                   rollup=(main.User.__table__, 'total_views', 'user_id'))
+    batch = tmp_path / 'test_views-batch-1.pending'
+    lines = f'{video_id}\n' * 3 + 'garbage\n'
+    batch.write_text(lines)
+    counter.flush()
+    assert not batch.exists()
+    assert totals(app, video_id) == (8, 3)
+
+    # 提交后、删除文件前崩溃：重启后同一批次再次提交，应被跳过
+    batch.write_text(lines)
+    counter.flush()
+    assert not batch.exists()
+    assert totals(app, video_id) == (8, 3)
+
+    (tmp_path / 'test_views-batch-2.pending').write_text(f'{video_id}\n')
+    counter.flush()
+    assert totals(app, video_id) == (9, 4)
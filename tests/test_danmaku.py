@@ -0,0 +1,46 @@
+"""弹幕：时间校验与分段缓存"""
+import pytest
+
+import main
+
+
+@pytest.fixture()
+def video_id(app, make_user):
+    user_id = make_user('viewer')
+    with app.app_context():
+        video = main.Video(title='v', filename='v.mp4', user_id=user_id, status='approved')
+        main.db.session.add(video)
+        main.db.session.commit()
+        main._danmaku_cache.invalidate(video.id)
+        return video.id
+
+
+@pytest.mark.parametrize('time', ['-1', 'nan', 'inf', '-inf', 'abc'])
+def test_invalid_time_is_rejected(app, login, video_id, time):
+    client = login('viewer')
+    r = client.post('/danmaku', data={'content': 'hi', 'video_id': video_id, 'time': time})
+    assert r.status_code == 200
+    assert r.get_json() == {'status': 'error', 'message': '时间格式错误'}
+    with app.app_context():
+        assert main.Danmaku.query.count() == 0
+
+
+def test_append_during_load_is_kept(app, login, video_id, monkeypatch):
+    client = login('viewer')
+    load = main.DanmakuSegmentCache._load
+
+    def slow_load(self, vid, seg):
+        items = load(self, vid, seg)
+        # 读库之后、写入缓存之前，本进程又发了一条弹幕
+        monkeypatch.setattr(main.DanmakuSegmentCache, '_load', load)
+        client.post('/danmaku', data={'content': 'late', 'video_id': vid, 'time': '3'})
+        return items
+
+    monkeypatch.setattr(main.DanmakuSegmentCache, '_load', slow_load)
+    r = client.get(f'/danmaku/{video_id}/seg/0')
+    assert [d['content'] for d in r.get_json()['danmakus']] == ['late']
+
+    # 之后的读取命中缓存，不再访问数据库
+    monkeypatch.setattr(main.DanmakuSegmentCache, '_load', lambda *args: pytest.fail('cache miss'))
+    r = client.get(f'/danmaku/{video_id}/seg/0')
+    assert [d['content'] for d in r.get_json()['danmakus']] == ['late']
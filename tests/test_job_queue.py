@@ -0,0 +1,86 @@
+"""后台任务队列：认领、结束与重试"""
+from datetime import datetime, timedelta
+
+import pytest
+
+import main
+
+
+@pytest.fixture()
+def register(app, monkeypatch):
+    """临时注册任务类型，测试结束后移除"""
+    monkeypatch.setattr(main.job_queue, '_handlers', dict(main.job_queue._handlers))
+    monkeypatch.setattr(main.job_queue, '_lanes', dict(main.job_queue._lanes))
+
+    def register(kind, fn, **kwargs):
+        main.job_queue.handler(kind, **kwargs)(fn)
+    return register
+
+
+def job(app, kind):
+    with app.app_context():
+        return main.BackgroundJob.query.filter_by(kind=kind).one()
+
+
+def test_finish_does_not_overwrite_job_reclaimed_by_another_worker(app, register):
+    def handler(payloads):
+        # 心跳停滞期间任务被判定超时，另一个消费者重新认领
+        table = main.BackgroundJob.__table__
+        main.db.session.execute(table.update().where(table.c.kind == 'test_reclaim')
+                                .values(locked_by='other:1', attempts=table.c.attempts + 1))
+        main.db.session.commit()
+
+    register('test_reclaim', handler)
+    with app.app_context():
+        main.job_queue.enqueue('test_reclaim', {})
+        assert main.job_queue.run_once() == 1
+    reclaimed = job(app, 'test_reclaim')
+    assert (reclaimed.status, reclaimed.locked_by, reclaimed.attempts) == ('running', 'other:1', 2)
+
+
+def test_failed_job_backs_off_then_gives_up(app, register):
+    calls = []
+
+    def handler(payloads):
+        calls.append(payloads)
+        raise RuntimeError('boom')
+
+    register('test_retry', handler)
+    with app.app_context():
+        assert main.job_queue.enqueue('test_retry', {'n': 1}, dedupe_key='test_retry:1')
+        assert not main.job_queue.enqueue('test_retry', {'n': 1}, dedupe_key='test_retry:1')
+        assert main.job_queue.run_once() == 1
+    failed = job(app, 'test_retry')
+    assert (failed.status, failed.attempts, failed.last_error, failed.locked_by) == ('pending', 1, 'boom', None)
+    delay = (failed.run_after - failed.updated_at).total_seconds()
+    assert delay == pytest.approx(10, abs=1)
+
+    with app.app_context():
+        # 退避期内不会被再次认领
+        assert main.job_queue.run_once() == 0
+        for attempt in range(2, app.config['JOB_MAX_ATTEMPTS'] + 1):
+            main.BackgroundJob.query.update({'run_after': datetime.utcnow() - timedelta(seconds=1)})
+            main.db.session.commit()
+            assert main.job_queue.run_once() == 1
+            retried = main.BackgroundJob.query.one()
+            assert retried.attempts == attempt
+            if retried.status == 'pending':
+                assert (retried.run_after - retried.updated_at).total_seconds() == pytest.approx(5 * 2 ** attempt, abs=1)
+    given_up = job(app, 'test_retry')
+    assert (given_up.status, given_up.dedupe_key) == ('failed', None)
+    assert len(calls) == app.config['JOB_MAX_ATTEMPTS']
+    with app.app_context():
+        # 放弃后去重键释放，可以重新排队
+        assert main.job_queue.enqueue('test_retry', {'n': 1}, dedupe_key='test_retry:1')
+
+
+def test_jobs_of_one_kind_are_batched(app, register):
+    batches = []
+    register('test_batch', lambda payloads: batches.append([p['n'] for p in payloads]), batch_size=3)
+    with app.app_context():
+        for n in range(5):
+            main.job_queue.enqueue('test_batch', {'n': n})
+        while main.job_queue.run_once():
+            pass
+        assert {j.status for j in main.BackgroundJob.query.filter_by(kind='test_batch')} == {'done'}
+    assert batches == [[0, 1, 2], [3, 4]]
@@ -0,0 +1,60 @@
+"""视频文件分段传输：Range/206/416、If-Range、ETag"""
+import os
+
+import pytest
+
+import main
+
+DATA = bytes(range(256)) * 40
+
+
+@pytest.fixture()
+def client(app):
+    with open(os.path.join(app.config['UPLOAD_FOLDER'], 'range.mp4'), 'wb') as f:
+        f.write(DATA)
+    return app.test_client()
+
+
+def get(client, **headers):
+    return client.get('/media/uploads/range.mp4', headers=headers)
+
+
+def test_full_file(client):
+    r = get(client)
+    assert r.status_code == 200
+    assert r.headers['Accept-Ranges'] == 'bytes'
+    assert r.content_length == len(DATA)
+    assert r.data == DATA
+
+
+@pytest.mark.parametrize('header, start, stop', [
+    ('bytes=0-99', 0, 100),
+    ('bytes=1000-', 1000, len(DATA)),
+    ('bytes=-500', len(DATA) - 500, len(DATA)),
+    ('bytes=10000-20000', 10000, len(DATA)),
+])
+def test_range_returns_206(client, header, start, stop):
+    r = get(client, Range=header)
+    assert r.status_code == 206
+    assert r.headers['Content-Range'] == f'bytes {start}-{stop - 1}/{len(DATA)}'
+    assert r.content_length == stop - start
+    assert r.data == DATA[start:stop]
+
+
+def test_unsatisfiable_range_returns_416(client):
+    r = get(client, Range=f'bytes={len(DATA)}-')
+    assert r.status_code == 416
+    assert r.headers['Content-Range'] == f'bytes */{len(DATA)}'
+
+
+def test_if_range_and_etag(client):
+    etag = get(client).headers['ETag']
+    assert get(client, Range='bytes=0-9', **{'If-Range': etag}).status_code == 206
+    # 文件已变化（ETag 不匹配）时忽略 Range，返回完整文件
+    r = get(client, Range='bytes=0-9', **{'If-Range': '"stale"'})
+    assert r.status_code == 200 and r.data == DATA
+    assert get(client, **{'If-None-Match': etag}).status_code == 304
+
+
+def test_hidden_files_are_not_served(client):
+    assert client.get('/media/uploads/.partial/x.part').status_code == 404
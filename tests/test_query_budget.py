@@ -0,0 +1,87 @@
+"""每个主要页面的 SQL 条数预算：超出预算或条数随数据量增长（N+1）时测试失败。"""
+from datetime import datetime, timedelta
+
+import pytest
+from werkzeug.security import generate_password_hash
+
+import main
+
+# (路径, 登录用户, 允许的最多 SQL 条数)；路径中的 {video_id} 为种子数据里的第一个视频。
+# 预算按当前实现收紧，新增查询时请先确认不是 N+1，再有意识地调整这里
+ROUTE_BUDGETS = [
+    ('/', None, 1),
+    ('/', 'viewer', 2),
+    ('/trending', 'viewer', 2),
+    ('/following_feed', 'viewer', 4),
+    ('/video/{video_id}', 'viewer', 4),
+    ('/video/{video_id}/comments', None, 2),
+    ('/search?q=video', None, 3),
+    ('/profile', 'author0', 3),
+    ('/following', 'viewer', 2),
+    ('/followers', 'author0', 3),
+    ('/follow_status?user_ids={author_ids}', 'viewer', 2),
+    ('/admin', 'boss', 4),
+    ('/admin/api/stats', 'boss', 4),
+    ('/admin/api/videos?status=approved', 'boss', 3),
+    ('/admin/api/users', 'boss', 3),
+]
+
+
+def seed(start, count, viewer_id):
+    """新增 count 个作者，每人一个已过审视频（含评论、弹幕）并与 viewer 互相关注，返回作者与视频 id"""
+    author_ids, video_ids = [], []
+    now = datetime.utcnow()
+    password_hash = generate_password_hash('pw')
+    for i in range(start, start + count):
+        author = main.User(username=f'author{i}', email=f'author{i}@example.com',
+                           password_hash=password_hash, password_changed=True)
+        main.db.session.add(author)
+        main.db.session.flush()
+        author_id = author.id
+        video = main.Video(title=f'video {i}', description='seed', filename=f'{i}.mp4', user_id=author_id,
+                           status='approved', reviewed_at=now - timedelta(minutes=i), views=i, hot_score=i + 1)
+        main.db.session.add(video)
+        main.db.session.flush()
+        for j in range(2):
+            main.db.session.add(main.Comment(content=f'comment {j}', user_id=viewer_id, video_id=video.id))
+        main.db.session.add(main.Danmaku(content='hi', user_id=viewer_id, video_id=video.id, time=1.0))
+        main.db.session.add(main.Video(title=f'pending {i}', filename=f'p{i}.mp4', user_id=author_id))
+        main.follow_graph.follow(viewer_id, author_id)
+        main.follow_graph.follow(author_id, viewer_id)
+        main.db.session.flush()
+        main.timeline.fanout(video)
+        author_ids.append(author_id)
+        video_ids.append(video.id)
+    main.db.session.commit()
+    return author_ids, video_ids
+
+
+@pytest.fixture()
+def site(app, make_user):
+    viewer_id = make_user('viewer')
+    make_user('boss', is_admin=True)
+    with app.app_context():
+        author_ids, video_ids = seed(0, 3, viewer_id)
+    return {'viewer_id': viewer_id, 'author_ids': author_ids, 'video_ids': video_ids}
+
+
+def query_count(app, login, path, username, site):
+    client = login(username) if username else app.test_client()
+    url = path.format(video_id=site['video_ids'][0], author_ids=','.join(map(str, site['author_ids'])))
+    client.get(url)  # 预热：首次请求会创建站点设置、建立连接池等
+    response = client.get(url)
+    assert response.status_code == 200, url
+    return int(response.headers['X-Query-Count'])
+
+
+@pytest.mark.parametrize('path, username, budget', ROUTE_BUDGETS)
+def test_route_within_query_budget(app, login, site, path, username, budget):
+    assert query_count(app, login, path, username, site) <= budget
+
+
+@pytest.mark.parametrize('path, username, budget', ROUTE_BUDGETS)
+def test_query_count_does_not_grow_with_rows(app, login, site, path, username, budget):
+    before = query_count(app, login, path, username, site)
+    with app.app_context():
+        seed(3, 7, site['viewer_id'])
+    assert query_count(app, login, path, username, site) == before
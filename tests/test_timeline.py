@@ -0,0 +1,95 @@
+"""关注动态：写扩散、大V读时合并与阈值切换"""
+from datetime import datetime, timedelta
+
+import pytest
+
+import main
+
+
+@pytest.fixture()
+def users(app, make_user, monkeypatch):
+    monkeypatch.setitem(app.config, 'TIMELINE_FANOUT_LIMIT', 2)
+    return {name: make_user(name) for name in ('star', 'small', 'a', 'b', 'c')}
+
+
+def run_jobs(app):
+    with app.app_context():
+        while main.job_queue.run_once():
+            pass
+
+
+def follow(login, follower, author_id, action='follow'):
+    r = login(follower).post(f'/follow_user/{author_id}', data={'action': action})
+    assert r.get_json()['status'] == 'success'
+
+
+def post(app, author_id, title, minutes_ago):
+    with app.app_context():
+        video = main.Video(title=title, filename=f'{title}.mp4', user_id=author_id, status='approved',
+                           reviewed_at=datetime.utcnow() - timedelta(minutes=minutes_ago))
+        main.db.session.add(video)
+        main.db.session.commit()
+        main.timeline.on_approved(video)
+    run_jobs(app)
+
+
+def feed(app, user_id, limit=10):
+    titles, cursor = [], None
+    with app.app_context():
+        while True:
+            videos, cursor = main.timeline.page(user_id, cursor, limit)
+            titles += [v.title for v in videos]
+            if not cursor:
+                return titles
+
+
+def inbox_titles(app, user_id):
+    with app.app_context():
+        return sorted(title for (title,) in main.db.session.query(main.Video.title)
+                      .join(main.TimelineEntry, main.TimelineEntry.video_id == main.Video.id)
+                      .filter(main.TimelineEntry.user_id == user_id))
+
+
+def test_fanout_backfill_and_unfollow(app, login, users):
+    post(app, users['small'], 'old', 30)
+    follow(login, 'a', users['small'])
+    run_jobs(app)
+    post(app, users['small'], 'new', 10)
+    assert inbox_titles(app, users['a']) == ['new', 'old']
+    assert feed(app, users['a'], limit=1) == ['new', 'old']
+
+    follow(login, 'a', users['small'], 'unfollow')
+    assert inbox_titles(app, users['a']) == []
+    assert feed(app, users['a']) == []
+
+
+def test_big_author_is_merged_at_read_time_and_backfilled_when_dropping_below_limit(app, login, users):
+    star, small = users['star'], users['small']
+    follow(login, 'a', small)
+    for name in ('a', 'b', 'c'):
+        follow(login, name, star)
+    run_jobs(app)
+    with app.app_context():
+        assert main.db.session.get(main.TimelineBigAuthor, star) is not None
+        assert main.TimelineBigFollow.query.filter_by(user_id=users['a']).count() == 1
+
+    post(app, star, 'star-1', 20)
+    post(app, small, 'small-1', 15)
+    post(app, star, 'star-2', 5)
+    # 大V的视频不写收件箱，读取时按时间与普通作者的合并
+    assert inbox_titles(app, users['a']) == ['small-1']
+    assert feed(app, users['a'], limit=2) == ['star-2', 'small-1', 'star-1']
+    assert feed(app, users['b']) == ['star-2', 'star-1']
+
+    # 粉丝回落到阈值以内：作为大V期间发布的视频补进收件箱
+    follow(login, 'c', star, 'unfollow')
+    run_jobs(app)
+    with app.app_context():
+        assert main.db.session.get(main.TimelineBigAuthor, star) is None
+        assert main.TimelineBigFollow.query.count() == 0
+    assert inbox_titles(app, users['a']) == ['small-1', 'star-1', 'star-2']
+    assert inbox_titles(app, users['c']) == []
+    assert feed(app, users['b']) == ['star-2', 'star-1']
+
+    post(app, star, 'star-3', 1)
+    assert feed(app, users['a']) == ['star-3', 'star-2', 'small-1', 'star-1']
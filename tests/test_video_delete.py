@@ -0,0 +1,52 @@
+"""删除视频：引用它的行一并删除，文件在提交成功后才删除"""
+import os
+
+import pytest
+
+import main
+
+
+@pytest.fixture()
+def video(app, make_user, login):
+    """一个已过审、带评论/弹幕/三连的视频，返回 (视频 id, 视频文件路径)"""
+    author_id = make_user('author')
+    make_user('fan')
+    with app.app_context():
+        video = main.Video(title='v', filename='delete-me.mp4', user_id=author_id, status='approved')
+        main.db.session.add(video)
+        main.db.session.commit()
+        video_id = video.id
+    path = os.path.join(app.config['UPLOAD_FOLDER'], 'delete-me.mp4')
+    with open(path, 'wb') as f:
+        f.write(b'video')
+    fan = login('fan')
+    assert fan.post('/comment', data={'content': 'nice', 'video_id': video_id}).get_json()['status'] == 'success'
+    assert fan.post('/danmaku', data={'content': 'hi', 'video_id': video_id, 'time': '1'}).get_json()['status'] == 'success'
+    assert fan.post(f'/triple_like/{video_id}').get_json()['status'] == 'success'
+    return video_id, path
+
+
+def test_owner_can_delete_video_with_comments(app, login, video):
+    video_id, path = video
+    r = login('author').post(f'/user/delete_video/{video_id}')
+    assert r.get_json()['status'] == 'success', r.get_json()
+    with app.app_context():
+        assert main.db.session.get(main.Video, video_id) is None
+        assert main.Comment.query.filter_by(video_id=video_id).count() == 0
+        assert main.Danmaku.query.filter_by(video_id=video_id).count() == 0
+        assert main.db.session.execute(main.db.select(main.db.func.count()).select_from(main.video_triple_likes)).scalar() == 0
+    assert not os.path.exists(path)
+
+
+def test_failed_delete_keeps_files(app, login, video, monkeypatch):
+    video_id, path = video
+
+    def broken(video):
+        raise RuntimeError('boom')
+
+    monkeypatch.setattr(main, '_delete_video_record', broken)
+    r = login('author').post(f'/user/delete_video/{video_id}')
+    assert r.get_json()['status'] == 'error'
+    with app.app_context():
+        assert main.db.session.get(main.Video, video_id) is not None
+    assert os.path.exists(path)